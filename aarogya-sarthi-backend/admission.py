@@ -0,0 +1,248 @@
+"""
+Admission control in front of the conversation flow.
+
+Every incoming message takes a token from its number's message bucket; expensive steps (Gemini
+turns, clinic searches, outbreak checks) also take one from the number's much smaller AI bucket
+and reserve a slot in the global budget of each upstream they call. A number that floods the bot
+is told to wait instead of draining the shared Gemini and Places quotas, and because menus and
+other static replies only need the message bucket, they keep working while AI turns are held back.
+
+Buckets and slots live in process memory, or with ADMISSION_BACKEND=sqlite in a WAL-mode SQLite
+file shared by every worker on the host, so limits hold across workers.
+"""
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from cache import TTLCache
+from rate_limit import TokenBucket
+
+load_dotenv()
+
+# --- Admission Configuration ---
+ADMISSION_BACKEND = os.environ.get("ADMISSION_BACKEND", os.environ.get("STATE_STORE_BACKEND", "memory"))
+ADMISSION_PATH = os.environ.get("ADMISSION_PATH", "admission.db")
+# Per number: tokens per second and bucket size, for all messages and for expensive (AI) steps. 0 = unlimited.
+NUMBER_MESSAGE_RATE = float(os.environ.get("NUMBER_MESSAGE_RATE", 0.5))
+NUMBER_MESSAGE_BURST = float(os.environ.get("NUMBER_MESSAGE_BURST", 10))
+NUMBER_AI_RATE = float(os.environ.get("NUMBER_AI_RATE", 0.1))
+NUMBER_AI_BURST = float(os.environ.get("NUMBER_AI_BURST", 3))
+# Requests allowed to be waiting on each upstream at once, across the host, e.g. "gemini=8,places=4,who=2".
+UPSTREAM_BUDGETS = os.environ.get("UPSTREAM_BUDGETS", "gemini=8,places=4,who=2")
+# A slot held by a worker that died is reclaimed after this many seconds.
+ADMISSION_SLOT_LEASE = float(os.environ.get("ADMISSION_SLOT_LEASE", 60))
+ADMISSION_MAX_NUMBERS = int(os.environ.get("ADMISSION_MAX_NUMBERS", 100000))
+
+
+def parse_budgets(text):
+    """Parses "gemini=8,places=4" into {'gemini': 8, 'places': 4}."""
+    budgets = {}
+    for item in filter(None, (text or '').split(',')):
+        name, _, value = item.partition('=')
+        budgets[name.strip()] = int(value)
+    return budgets
+
+
+# --- Stores ---
+class MemoryAdmissionStore:
+    """Process-local buckets (idle ones are evicted once they would have refilled) and slot counters."""
+
+    def __init__(self, maxsize=ADMISSION_MAX_NUMBERS):
+        self._buckets = TTLCache(maxsize, ttl=3600)
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+            # A bucket left alone for burst / rate seconds is full again, so it can be forgotten.
+            self._buckets.set(key, bucket, ttl=burst / rate)
+        return bucket.try_acquire()
+
+    def acquire_slot(self, upstream, limit):
+        with self._lock:
+            if self._slots.get(upstream, 0) >= limit:
+                return None
+            self._slots[upstream] = self._slots.get(upstream, 0) + 1
+        return upstream
+
+    def release_slot(self, upstream, token):
+        with self._lock:
+            self._slots[upstream] -= 1
+
+    def in_use(self):
+        with self._lock:
+            return dict(self._slots)
+
+
+class SQLiteAdmissionStore:
+    """Buckets and slots shared by the worker processes on the host through a WAL-mode SQLite file."""
+
+    def __init__(self, path=ADMISSION_PATH, lease=ADMISSION_SLOT_LEASE):
+        self.path = path
+        self.lease = lease
+        self._local = threading.local()
+        self._last_purge = 0.0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS admission_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS admission_slots ("
+            "token TEXT PRIMARY KEY, upstream TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, updated_at FROM admission_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= 1
+            conn.execute(
+                "INSERT INTO admission_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, tokens - 1 if allowed else tokens, now)
+            )
+        self._purge_idle(now)
+        return allowed
+
+    def acquire_slot(self, upstream, limit):
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM admission_slots WHERE upstream = ? AND expires_at <= ?", (upstream, now))
+            (in_use,) = conn.execute("SELECT count(*) FROM admission_slots WHERE upstream = ?", (upstream,)).fetchone()
+            if in_use >= limit:
+                return None
+            conn.execute(
+                "INSERT INTO admission_slots (token, upstream, expires_at) VALUES (?, ?, ?)", (token, upstream, now + self.lease)
+            )
+        return token
+
+    def release_slot(self, upstream, token):
+        self._conn().execute("DELETE FROM admission_slots WHERE token = ?", (token,))
+
+    def in_use(self):
+        rows = self._conn().execute(
+            "SELECT upstream, count(*) FROM admission_slots WHERE expires_at > ? GROUP BY upstream", (time.time(),)
+        ).fetchall()
+        return dict(rows)
+
+    def _purge_idle(self, now):
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        # An hour idle refills any bucket configured here, so the row carries no information.
+        self._conn().execute("DELETE FROM admission_buckets WHERE updated_at <= ?", (now - 3600,))
+
+
+# --- Controller ---
+class AdmissionController:
+    """Applies the per-number buckets and per-upstream budgets on top of a store."""
+
+    def __init__(self, store, message_rate=NUMBER_MESSAGE_RATE, message_burst=NUMBER_MESSAGE_BURST,
+                 ai_rate=NUMBER_AI_RATE, ai_burst=NUMBER_AI_BURST, budgets=None):
+        self.store = store
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.ai_rate = ai_rate
+        self.ai_burst = ai_burst
+        self.budgets = parse_budgets(UPSTREAM_BUDGETS) if budgets is None else budgets
+        self._stats_lock = threading.Lock()
+        self._rejected = {}
+
+    def _reject(self, reason):
+        with self._stats_lock:
+            self._rejected[reason] = self._rejected.get(reason, 0) + 1
+
+    def stats(self):
+        """Returns rejection counts by reason and the upstream slots currently in use."""
+        with self._stats_lock:
+            rejected = dict(self._rejected)
+        return {'rejected': rejected, 'in_use': self.store.in_use()}
+
+    def _take(self, kind, number, rate, burst):
+        if rate <= 0 or not number:
+            return True
+        if self.store.take(f"{kind}:{number}", rate, burst):
+            return True
+        self._reject(f"{kind}_rate")
+        return False
+
+    def allow_message(self, number):
+        """Takes a token from the number's message bucket; False means the number must wait."""
+        return self._take('message', number, self.message_rate, self.message_burst)
+
+    @contextmanager
+    def upstreams(self, *names):
+        """Reserves a slot in each upstream's budget for the block; yields False (holding nothing) if one is full."""
+        held = []
+        admitted = True
+        for name in names:
+            limit = self.budgets.get(name)
+            if not limit:
+                continue
+            token = self.store.acquire_slot(name, limit)
+            if token is None:
+                self._reject(f"{name}_busy")
+                admitted = False
+                break
+            held.append((name, token))
+        if not admitted:
+            self._release(held)
+            held = []
+        try:
+            yield admitted
+        finally:
+            self._release(held)
+
+    def _release(self, held):
+        for name, token in held:
+            try:
+                self.store.release_slot(name, token)
+            except Exception as e:
+                logging.error(f"Could not release {name} admission slot: {e}")
+
+    @contextmanager
+    def expensive(self, number, *upstreams):
+        """Admits an expensive step: the upstream budgets first, then a token from the number's AI bucket."""
+        with self.upstreams(*upstreams) as admitted:
+            yield admitted and self._take('ai', number, self.ai_rate, self.ai_burst)
+
+
+def create_admission_controller():
+    """Builds the controller on the store selected by ADMISSION_BACKEND."""
+    if ADMISSION_BACKEND == 'sqlite':
+        return AdmissionController(SQLiteAdmissionStore())
+    if ADMISSION_BACKEND != 'memory':
+        logging.warning(f"Unknown ADMISSION_BACKEND '{ADMISSION_BACKEND}', falling back to memory.")
+    return AdmissionController(MemoryAdmissionStore())
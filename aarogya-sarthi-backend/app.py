@@ -1,19 +1,38 @@
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
 from twilio.twiml.messaging_response import MessagingResponse
 import logging
 import os
+import uuid
+from datetime import date
 from dotenv import load_dotenv
 
-from database import get_user, add_user, delete_user
+from database import get_user, get_cached_user, add_user, delete_user, get_pool_stats
 from location_data import STATES_AND_DISTRICTS
-from symptom_checker import handle_symptom_checker
-from vaccination_reminders import handle_vaccination_reminders
-from outbreak_alerts import get_outbreak_alert
-from preventive_healthcare_tips import get_preventive_tips
+from symptom_checker import handle_symptom_checker, get_context_stats
+from vaccination_reminders import handle_vaccination_reminders, find_nearby_centers
+import vaccination_schedule    # registers the plan_vaccinations job
+from outbreak_alerts import get_outbreak_alert, find_outbreak_alert, mark_outbreak_alert_seen, start_feed_refresher, on_new_alert
+from outbreak_broadcast import OUTBREAK_BROADCAST, broadcast_in_background
+from preventive_healthcare_tips import get_preventive_tips, prepare_tips
+from state_store import create_state_store
+from idempotency import create_idempotency_cache, STILL_RUNNING
+from admission import create_admission_controller
+from enrichment import run_enrichments, get_enrichment_stats
+from job_queue import job_handler, enqueue, get_job_queue
+from twilio_sender import get_sender
+from district_search import build_district_search
+from conversation import Conversation, ConversationMachine, TwimlReply, list_paginated, prerender_messages, EMPTY_TWIML
+from gemini_services import get_gemini_client, GEMINI_STREAMING
+from streaming import SegmentSender
+from metrics import request_scope, set_lang, stage_timer, register_collector, render_metrics
 
 load_dotenv()
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
+if OUTBREAK_BROADCAST:
+    # Registered before the refresher starts, so the first feed fetch is not missed.
+    on_new_alert(broadcast_in_background)
+start_feed_refresher()
 
 
 # --- Language & Message Data (remains the same) ---
@@ -35,7 +54,8 @@ MESSAGES = {
         'invalid_gender': "Invalid selection. Please reply with 1, 2, or 3.",
         'ask_state': "Which state do you live in? Please reply with the number for your state.",
         'invalid_state': "Invalid selection. Please choose a number from the list.",
-        'ask_district': "And which district? Please reply with the number for your district.",
+        'ask_district': "And which district? Please reply with the number for your district, or type its name.",
+        'district_suggestions': "Did you mean one of these? Please reply with the number:",
         'invalid_district': "Invalid selection. Please choose a number from the list for your state.",
         'registered': "You are now registered! Thank you.",
         'welcome_back': "Welcome back to Aarogya Sarthi, {name}! How can I help you today?",
@@ -48,7 +68,9 @@ MESSAGES = {
         'symptom_checker_start': "You've selected the Symptom Checker. Please describe your symptoms. To exit at any time, just say 'exit'.",
         'exit_message': "Thank you for using Aarogya Sarthi. Have a healthy day!",
         'outbreak_alert_intro': "⚠️ Health Alert for your area:",
-        'preventive_tips_intro': "🌿 Health Tip for your area:"
+        'preventive_tips_intro': "🌿 Health Tip for your area:",
+        'preventive_tips_header': "{title} for {district}",
+        'please_wait': "You're sending messages faster than I can keep up with. Please wait a minute and try again. ⏳"
     },
      # ... (other languages remain the same) ...
     'hi': {
@@ -59,7 +81,8 @@ MESSAGES = {
         'invalid_gender': "अमान्य चयन। कृपया 1, 2, या 3 के साथ उत्तर दें।",
         'ask_state': "आप किस राज्य में रहते हैं? कृपया अपने राज्य के लिए नंबर के साथ उत्तर दें।",
         'invalid_state': "अमान्य चयन। कृपया सूची से एक संख्या चुनें।",
-        'ask_district': "और कौन सा जिला? कृपया अपने जिले के लिए नंबर के साथ उत्तर दें।",
+        'ask_district': "और कौन सा जिला? कृपया अपने जिले के लिए नंबर के साथ उत्तर दें, या जिले का नाम लिखें।",
+        'district_suggestions': "क्या आपका मतलब इनमें से कोई है? कृपया नंबर के साथ उत्तर दें:",
         'invalid_district': "अमान्य चयन। कृपया अपने राज्य के लिए सूची से एक संख्या चुनें।",
         'registered': "अब आप पंजीकृत हो गए हैं! धन्यवाद।",
         'welcome_back': "आरोग्य सारथी में आपका वापस स्वागत है, {name}! मैं आज आपकी कैसे मदद कर सकता हूँ?",
@@ -72,7 +95,9 @@ MESSAGES = {
         'symptom_checker_start': "आपने लक्षण परीक्षक चुना है। कृपया अपने लक्षणों का वर्णन करें। किसी भी समय बाहर निकलने के लिए, बस 'exit' कहें।",
         'exit_message': "आरोग्य सारथी का उपयोग करने के लिए धन्यवाद। आपका दिन स्वस्थ रहे!",
         'outbreak_alert_intro': "⚠️ आपके क्षेत्र के लिए स्वास्थ्य चेतावनी:",
-        'preventive_tips_intro': "🌿 आपके क्षेत्र के लिए स्वास्थ्य सुझाव:"
+        'preventive_tips_intro': "🌿 आपके क्षेत्र के लिए स्वास्थ्य सुझाव:",
+        'preventive_tips_header': "{district} के लिए {title}",
+        'please_wait': "आप बहुत जल्दी-जल्दी संदेश भेज रहे हैं। कृपया एक मिनट रुककर फिर से प्रयास करें। ⏳"
     },
     'od': {
         'welcome': "ଆରୋଗ୍ୟ ସାରଥିକୁ ସ୍ୱାଗତ! ଆରମ୍ଭ କରିବା ପାଇଁ, ଆପଣଙ୍କର ପୂରା ନାମ କ’ଣ?",
@@ -82,7 +107,8 @@ MESSAGES = {
         'invalid_gender': "ଅବୈଧ ଚୟନ। ଦୟାକରି 1, 2, କିମ୍ବା 3 ସହିତ ଉତ୍ତର ଦିଅନ୍ତୁ।",
         'ask_state': "ଆପଣ କେଉଁ ରାଜ୍ୟରେ ରୁହନ୍ତି? ଦୟାକରି ଆପଣଙ୍କ ରାଜ୍ୟ ପାଇଁ ନମ୍ବର ସହିତ ଉତ୍ତର ଦିଅନ୍ତୁ।",
         'invalid_state': "ଅବୈଧ ଚୟନ। ଦୟାକରି ତାଲିକାରୁ ଏକ ସଂଖ୍ୟା ବାଛନ୍ତୁ।",
-        'ask_district': "ଏବଂ କେଉଁ ଜିଲ୍ଲା? ଦୟାକରି ଆପଣଙ୍କ ଜିଲ୍ଲା ପାଇଁ ନମ୍ବର ସହିତ ଉତ୍ତର ଦିଅନ୍ତୁ।",
+        'ask_district': "ଏବଂ କେଉଁ ଜିଲ୍ଲା? ଦୟାକରି ଆପଣଙ୍କ ଜିଲ୍ଲା ପାଇଁ ନମ୍ବର ସହିତ ଉତ୍ତର ଦିଅନ୍ତୁ, କିମ୍ବା ଜିଲ୍ଲାର ନାମ ଲେଖନ୍ତୁ।",
+        'district_suggestions': "ଆପଣ ଏଥିମଧ୍ୟରୁ କୌଣସି ଗୋଟିଏ କହୁଛନ୍ତି କି? ଦୟାକରି ନମ୍ବର ସହିତ ଉତ୍ତର ଦିଅନ୍ତୁ:",
         'invalid_district': "ଅବୈଧ ଚୟନ। ଦୟାକରି ଆପଣଙ୍କ ରାଜ୍ୟ ପାଇଁ ତାଲିକାରୁ ଏକ ସଂଖ୍ୟା ବାଛନ୍ତୁ।",
         'registered': "ଆପଣ ବର୍ତ୍ତମାନ ପଞ୍ଜିକୃତ ହୋଇଛନ୍ତି! ଧନ୍ୟବାଦ।",
         'welcome_back': "ଆରୋଗ୍ୟ ସାରଥିକୁ ପୁନର୍ବାର ସ୍ୱାଗତ, {name}! ଆଜି ମୁଁ ଆପଣଙ୍କୁ କିପରି ସାହାଯ୍ୟ କରିପାରେ?",
@@ -95,7 +121,9 @@ MESSAGES = {
         'symptom_checker_start': "ଆପଣ ଲକ୍ଷଣ ଯାଞ୍ଚକାରୀ ବାଛିଛନ୍ତି। ଦୟାକରି ଆପଣଙ୍କର ଲକ୍ଷଣ ବର୍ଣ୍ଣନା କରନ୍ତୁ। ଯେକୌଣସି ସମୟରେ ବାହାରିବାକୁ, କେବଳ 'exit' କୁହନ୍ତୁ।",
         'exit_message': "ଆରୋଗ୍ୟ ସାରଥି ବ୍ୟବହାର କରିଥିବାରୁ ଧନ୍ୟବାଦ। ଆପଣଙ୍କ ଦିନ ସୁସ୍ଥ ରହୁ!",
         'outbreak_alert_intro': "⚠️ ଆପଣଙ୍କ ଅଞ୍ଚଳ ପାଇଁ ସ୍ୱାସ୍ଥ୍ୟ ସତର୍କତା:",
-        'preventive_tips_intro': "🌿 ଆପଣଙ୍କ ଅଞ୍ଚଳ ପାଇଁ ସ୍ୱାସ୍ଥ୍ୟ ପରାମର୍ଶ:"
+        'preventive_tips_intro': "🌿 ଆପଣଙ୍କ ଅଞ୍ଚଳ ପାଇଁ ସ୍ୱାସ୍ଥ୍ୟ ପରାମର୍ଶ:",
+        'preventive_tips_header': "{district} ପାଇଁ {title}",
+        'please_wait': "ଆପଣ ବହୁତ ଶୀଘ୍ର ସନ୍ଦେଶ ପଠାଉଛନ୍ତି। ଦୟାକରି ଏକ ମିନିଟ୍ ଅପେକ୍ଷା କରି ପୁଣି ଚେଷ୍ଟା କରନ୍ତୁ। ⏳"
     },
     'kui': {
         'welcome': "ଆରୋଗ୍ୟ ସାରଥିକେ ସ୍ୱାଗତ୍! ଆରମ୍ଭ କରବାକେ, ଆପଣାର୍ ନାମ୍ କାଣା?",
@@ -105,7 +133,8 @@ MESSAGES = {
         'invalid_gender': "ଭୁଲ୍ ଚୟନ୍। ଦୟାକରି 1, 2, କିମ୍ବା 3 ସାଙ୍ଗେ ଉତ୍ତର ଦିଅନ୍ତୁ।",
         'ask_state': "ଆପଣ୍ କେନ୍ ରାଜ୍ୟରେ ରହୁଛନ୍? ଦୟାକରି ଆପଣାର୍ ରାଜ୍ୟର୍ ଲାଗି ନମ୍ବର ସାଙ୍ଗେ ଉତ୍ତର ଦିଅନ୍ତୁ।",
         'invalid_state': "ଭୁଲ୍ ଚୟନ୍। ଦୟାକରି ତାଲିକାରୁ ଗୁଟେ ସଂଖ୍ୟା ବାଛନ୍ତୁ।",
-        'ask_district': "ଆର୍ କେନ୍ ଜିଲ୍ଲା? ଦୟାକରି ଆପଣାର୍ ଜିଲ୍ଲା ଲାଗି ନମ୍ବର ସାଙ୍ଗେ ଉତ୍ତର ଦିଅନ୍ତୁ।",
+        'ask_district': "ଆର୍ କେନ୍ ଜିଲ୍ଲା? ଦୟାକରି ଆପଣାର୍ ଜିଲ୍ଲା ଲାଗି ନମ୍ବର ସାଙ୍ଗେ ଉତ୍ତର ଦିଅନ୍ତୁ, ନାହେଲେ ଜିଲ୍ଲାର୍ ନାଁ ଲେଖନ୍ତୁ।",
+        'district_suggestions': "ଆପଣ୍ ଏଥିରୁ କେନ୍ ଗୁଟେ କହୁଛ? ଦୟାକରି ନମ୍ବର ସାଙ୍ଗେ ଉତ୍ତର ଦିଅନ୍ତୁ:",
         'invalid_district': "ଭୁଲ୍ ଚୟନ୍। ଦୟାକରି ଆପଣାର୍ ରାଜ୍ୟ ଲାଗି ତାଲିକାରୁ ଗୁଟେ ସଂଖ୍ୟା ବାଛନ୍ତୁ।",
         'registered': "ଆପଣ୍ ଏବେ ପଞ୍ଜିକୃତ ହେଇଗଲେ! ଧନ୍ୟବାଦ।",
         'welcome_back': "ଆରୋଗ୍ୟ ସାରଥିକେ ଫେର୍ ସ୍ୱାଗତ୍, {name}! ଆଜି ମୁଇଁ ଆପଣାର୍ କେନ୍ତା ସାହାଯ୍ୟ କର୍ମି?",
@@ -118,7 +147,9 @@ MESSAGES = {
         'symptom_checker_start': "ଆପଣ୍ ଲକ୍ଷଣ ଯାଞ୍ଚ୍ ବାଛିଛନ୍। ଦୟାକରି ଆପଣାର୍ ଲକ୍ଷଣ ବିଷୟରେ କହନ୍ତୁ। ଯେକେନ୍ ସମୟରେ ବାହାର୍ବାକେ, 'exit' କହନ୍ତୁ।",
         'exit_message': "ଆରୋଗ୍ୟ ସାରଥି ବ୍ୟବହାର୍ କର୍ଥିବାରୁ ଧନ୍ୟବାଦ। ଆପଣାର୍ ଦିନ୍ ସୁସ୍ଥ ରହୁ!",
         'outbreak_alert_intro': "⚠️ ଆପଣାର୍ ଅଞ୍ଚଲ୍ ଲାଗି ସ୍ୱାସ୍ଥ୍ୟ ସତର୍କତା:",
-        'preventive_tips_intro': "🌿 ଆପଣାର୍ ଅଞ୍ଚଲ୍ ଲାଗି ସ୍ୱାସ୍ଥ୍ୟ ପରାମର୍ଶ:"
+        'preventive_tips_intro': "🌿 ଆପଣାର୍ ଅଞ୍ଚଲ୍ ଲାଗି ସ୍ୱାସ୍ଥ୍ୟ ପରାମର୍ଶ:",
+        'preventive_tips_header': "{district} ଲାଗି {title}",
+        'please_wait': "ଆପଣ୍ ବେଗି ବେଗି ସନ୍ଦେଶ୍ ପଠାଉଛ। ଦୟାକରି ଗୁଟେ ମିନିଟ୍ ରହି ଫେର୍ ଚେଷ୍ଟା କରନ୍ତୁ। ⏳"
     },
     'sa': {
         'welcome': "ᱟᱨᱚᱜᱭᱚ ᱥᱟᱨᱛᱷᱤ ᱨᱮ ᱥᱟᱹᱜᱩᱱ ᱫᱟᱨᱟᱢ! ᱮᱛᱚᱦᱚᱵᱽ ᱞᱟᱹᱜᱤᱫ, ᱟᱢᱟᱜ ᱯᱩᱨᱟᱹ ᱧᱩᱛᱩᱢ ᱫᱚ ᱪᱮᱫ?",
@@ -128,7 +159,8 @@ MESSAGES = {
         'invalid_gender': "ᱵᱷᱩᱞ ᱵᱟᱪᱷᱱᱟᱣ། ᱫᱟᱭᱟᱠᱟᱛᱮ 1, 2, ᱥᱮ 3 ᱛᱮ ᱛᱮᱞᱟ ᱮᱢᱚᱜ ᱢᱮ᱾",
         'ask_state': "ᱟᱢ ᱚᱠᱟ ରାଜ୍ୟ ᱨᱮᱢ ᱛᱟᱦᱮᱱᱟ? ᱫᱟᱭᱟᱠᱟᱛᱮ ᱟᱢᱟᱜ ରାଜ୍ୟ ᱞᱟᱹᱜᱤᱫ ᱱᱚᱢᱵᱚᱨ ᱛᱮ ᱛᱮᱞᱟ ᱮᱢᱚᱜ ᱢᱮ᱾",
         'invalid_state': "ᱵᱷᱩᱞ ᱵᱟᱪᱷᱱᱟᱣ། ᱫᱟᱭᱟᱠᱟᱛᱮ ᱞᱤᱥᱴ ᱠᱷᱚᱱ ᱢᱤᱫᱴᱟᱹᱝ ᱱᱚᱢᱵᱚᱨ ᱵᱟᱪᱷᱟᱣ ᱢᱮ᱾",
-        'ask_district': "ᱟᱨ ᱚᱠᱟ ᱡᱤᱞᱞᱟ? ᱫᱟᱭᱟᱠᱟᱛᱮ ᱟᱢᱟᱜ ᱡᱤᱞᱞᱟ ᱞᱟᱹଗᱤᱫ ᱱᱚᱢᱵᱚᱨ ᱛᱮ ᱛᱮᱞା ᱮᱢᱚᱜ ᱢᱮ᱾",
+        'ask_district': "ᱟᱨ ᱚᱠᱟ ᱡᱤᱞᱞᱟ? ᱫᱟᱭᱟᱠᱟᱛᱮ ᱟᱢᱟᱜ ᱡᱤᱞᱞᱟ ᱞᱟᱹଗᱤᱫ ᱱᱚᱢᱵᱚᱨ ᱛᱮ ᱛᱮᱞା ᱮᱢᱚᱜ ᱢᱮ, ᱟᱨᱵᱟᱝ ᱡᱤᱞᱞᱟ ᱨᱮᱱᱟᱜ ᱧᱩᱛᱩᱢ ᱚᱞ ᱢᱮ᱾",
+        'district_suggestions': "ᱱᱚᱣᱟ ᱠᱚ ᱛᱟᱞᱟ ᱨᱮᱭᱟᱜ ᱢᱤᱫᱴᱟᱹᱝ ᱥᱮ? ᱫᱟᱭᱟᱠᱟᱛᱮ ᱱᱚᱢᱵᱚᱨ ᱛᱮ ᱛᱮᱞᱟ ᱮᱢᱚᱜ ᱢᱮ:",
         'invalid_district': "ᱵᱷᱩᱞ ᱵᱟᱪᱷᱱᱟᱣ། ᱫᱟᱭାᱠᱟᱛᱮ ᱟᱢᱟᱜ ରାଜ୍ୟ ᱞᱟᱹᱜᱤᱫ ᱞᱤᱥᱴ ᱠᱷᱚᱱ ᱢᱤᱫᱴᱟᱹᱝ ᱱᱚᱢᱵᱚᱨ ᱵᱟᱪᱷᱟᱣ ᱢᱮ᱾",
         'registered': "ᱟᱢ ᱱᱤᱛᱚᱜ ᱯଞ୍ଜᱤᱠୃᱛ ᱮᱱᱟᱢ! ᱥᱟᱨᱦᱟᱣ།",
         'welcome_back': "ᱟᱨᱚᱜᱭᱚ ᱥᱟᱨᱛᱷᱤ ᱨᱮ ᱟᱨᱦᱚᱸ ᱥᱟᱹᱜᱩᱱ ᱫᱟᱨᱟᱢ, {name}! ᱛᱮᱦᱮᱧ ᱤᱧ ᱟᱢᱟᱜ ᱪᱮᱫ ᱜᱚᱲᱚ ᱫᱟᱲᱮᱭᱟᱢᱟ?",
@@ -141,173 +173,450 @@ MESSAGES = {
         'symptom_checker_start': "ᱟᱢ ախտանիշների ստուգում ᱮᱢ ᱵᱟᱪᱷᱟᱣ ᱠᱮᱫᱟ᱾ ᱫᱟᱭᱟᱠᱟᱛᱮ ᱟᱢᱟᱜ ախտանիշները նկարագրիր։ Ցանկացած պահի դուրս գալու համար պարզապես ասա 'exit'։",
         'exit_message': "ᱟᱨᱚਗᱭᱚ ᱥᱟᱨᱛᱷᱤ ᱵ୍ୟବହାର ᱞᱟᱹᱜᱤᱫ ᱥᱟᱨᱦᱟᱣ། ᱟᱢᱟᱜ ᱫᱤᱱ ᱱᱟᱯᱟᱭ ᱛᱟᱦᱮᱱ!",
         'outbreak_alert_intro': "⚠️ ᱟᱢᱟᱜ ᱮᱞᱟᱠᱟ ᱞᱟᱹᱜᱤᱫ ᱥᱣᱟᱥᱛᱷᱚ  cảnh báo:",
-        'preventive_tips_intro': "🌿 ᱟᱢᱟᱜ ᱮᱞᱟକା ᱞᱟᱹᱜᱤᱫ ᱥᱣᱟᱥᱛᱷᱚ পরামর্শ:"
+        'preventive_tips_intro': "🌿 ᱟᱢᱟᱜ ᱮᱞᱟକା ᱞᱟᱹᱜᱤᱫ ᱥᱣᱟᱥᱛᱷᱚ পরামর্শ:",
+        'preventive_tips_header': "{district} ᱞᱟᱹᱜᱤᱫ {title}",
+        'please_wait': "ᱟᱢ ᱟᱹᱰᱤ ᱞᱚᱜᱚᱱ ᱠᱷᱚᱵᱚᱨ ᱠᱩᱞ ᱮᱫᱟᱢ᱾ ᱫᱟᱭᱟᱠᱟᱛᱮ ᱢᱤᱫ ᱢᱤᱱᱤᱴ ᱛᱟᱹᱝᱜᱤ ᱠᱟᱛᱮ ᱟᱨᱦᱚᱸ ᱠᱩᱨᱩᱢᱩᱴᱩᱭ ᱢᱮ᱾ ⏳"
     }
 }
-user_states = {}
+user_states = create_state_store()
+# TwiML already sent for each MessageSid, replayed when Twilio retries a slow webhook.
+webhook_responses = create_idempotency_cache()
+# Per-number rate limits and per-upstream budgets; over-limit numbers are asked to wait.
+admission = create_admission_controller()
+
+# --- Asynchronous Replies ---
+# When enabled, slow work (Gemini turns, alert checks, clinic searches) is acknowledged at
+# once and finished by background workers, which deliver the reply via the Twilio REST API.
+ASYNC_REPLIES = os.environ.get("ASYNC_REPLIES", "").lower() in ('1', 'true', 'yes')
+
+def deliver(to, messages, seen_alert=None):
+    """
+    Queues messages for delivery, in order, through the Twilio REST API.
+    `seen_alert`, a (user id, alert) pair, is marked as seen once all of them have been sent.
+    """
+    messages = [message for message in messages if message]
+    if messages:
+        payload = {'to': to, 'messages': messages}
+        if seen_alert:
+            user_id, alert = seen_alert
+            payload['seen_alert'] = [user_id, {'id': alert['id'], 'published': alert.get('published')}]
+        enqueue('send_messages', payload, key=f"send:{to}")
+
+@job_handler('send_messages')
+def send_messages_job(payload):
+    sender = get_sender()
+    while payload['messages']:
+        sender.send(payload['to'], payload['messages'][0])
+        # Drop each message once sent, so a retry resumes after the last delivered one.
+        payload['messages'].pop(0)
+    if payload.get('seen_alert'):
+        mark_outbreak_alert_seen(*payload['seen_alert'])
+
+@job_handler('symptom_turn')
+def symptom_turn_job(payload):
+    user = get_user(payload['to'])
+    if GEMINI_STREAMING:
+        segments = SegmentSender(payload['to'])
+        handle_symptom_checker(user, {}, payload['msg'], payload['lang'], MESSAGES, send_segment=segments,
+                               turn_id=payload.get('turn_id'))
+        deliver(payload['to'], segments.unsent)
+        return
+    response_text = handle_symptom_checker(user, {}, payload['msg'], payload['lang'], MESSAGES, turn_id=payload.get('turn_id'))
+    deliver(payload['to'], [response_text])
+
+@job_handler('outbreak_check')
+def outbreak_check_job(payload):
+    user = get_user(payload['to'])
+    lang = payload['lang']
+    alert, alert_message = find_outbreak_alert(user, lang) or (None, None)
+    seen_alert = (user.id, alert) if alert else None
+    if payload.get('manual'):
+        deliver(payload['to'], [alert_message or "No active alerts for your country at this time.", MESSAGES[lang]['main_menu']],
+                seen_alert=seen_alert)
+    else:
+        deliver(payload['to'], [alert_message], seen_alert=seen_alert)
+
+@job_handler('clinic_search')
+def clinic_search_job(payload):
+    lang = payload['lang']
+    response_text = find_nearby_centers(payload['vaccine'], payload['district'], lang, MESSAGES)
+    deliver(payload['to'], [response_text, MESSAGES[lang]['main_menu']])
+
+if ASYNC_REPLIES:
+    get_job_queue().start()
 
 @app.route("/")
 def index():
     return "<h1>Aarogya Sarthi Backend is Running!</h1>"
 
-def list_paginated(items, page_num=1, page_size=10):
-    start = (page_num - 1) * page_size
-    end = start + page_size
-    paginated_items = items[start:end]
-    response_text = ""
-    for i, item in enumerate(paginated_items, start + 1):
-        response_text += f"{i}. {item}\n"
-    if end < len(items):
-        response_text += f"\nReply with 'more' to see the next page."
-    return response_text
+@app.route("/db_stats")
+def db_stats():
+    return jsonify(get_pool_stats())
+
+# --- Metrics ---
+# Collectors return {name: (help, value)} for gauges and (help, value, 'counter') for counts since start.
+POOL_COUNTERS = ('wait_count', 'wait_time_total', 'timeouts', 'stale_replaced')
+
+def _pool_metrics():
+    return {f"aarogya_db_pool_{key}": (f"Database pool {key.replace('_', ' ')}.", value, 'counter' if key in POOL_COUNTERS else 'gauge')
+            for key, value in get_pool_stats().items()}
+
+def _gemini_metrics():
+    stats = get_gemini_client().stats()
+    metrics = {f"aarogya_gemini_{key}": (f"Gemini client {key.replace('_', ' ')} since start.", stats[key], 'counter')
+               for key in ('calls', 'attempts', 'retries')}
+    metrics.update({f"aarogya_gemini_outcome_{outcome}": (f"Gemini calls that ended {outcome.replace('_', ' ')}.", count, 'counter')
+                    for outcome, count in stats['outcomes'].items()})
+    metrics['aarogya_gemini_breaker_open'] = ("1 while the Gemini circuit breaker is not closed.", int(stats['breaker'] != 'closed'))
+    return metrics
+
+def _idempotency_metrics():
+    stats = webhook_responses.stats()
+    metrics = {f"aarogya_webhook_{key}": (f"Webhook requests {key.replace('_', ' ')} by MessageSid de-duplication.", value, 'counter')
+               for key, value in stats.items() if key != 'cached'}
+    metrics['aarogya_webhook_cached'] = ("Webhook responses cached for replay.", stats['cached'])
+    return metrics
+
+def _admission_metrics():
+    stats = admission.stats()
+    metrics = {f"aarogya_admission_rejected_{reason}": (f"Messages turned away for {reason.replace('_', ' ')}.", count, 'counter')
+               for reason, count in stats['rejected'].items()}
+    metrics.update({f"aarogya_admission_{upstream}_in_use": (f"{upstream} budget slots in use.", count)
+                    for upstream, count in stats['in_use'].items()})
+    return metrics
+
+def _enrichment_metrics():
+    metrics = {}
+    for name, counts in get_enrichment_stats().items():
+        metrics.update({f"aarogya_enrichment_{name}_{outcome}": (f"Session-start {name} checks that finished {outcome.replace('_', ' ')}.", count, 'counter')
+                        for outcome, count in counts.items()})
+    return metrics
+
+def _context_metrics():
+    stats = get_context_stats()
+    metrics = {f"aarogya_symptom_context_{key}": (f"Symptom-checker Gemini requests' {key.replace('_', ' ')} since start.", stats[key], 'counter')
+               for key in ('requests', 'payload_bytes_total', 'prompt_tokens_total', 'turns_loaded_total')}
+    metrics['aarogya_symptom_context_summaries'] = ("Symptom-checker session summaries updated since start.", stats['summaries'], 'counter')
+    return metrics
+
+register_collector(_pool_metrics)
+register_collector(_gemini_metrics)
+register_collector(_idempotency_metrics)
+register_collector(_admission_metrics)
+register_collector(_enrichment_metrics)
+register_collector(_context_metrics)
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- Conversation Flow ---
+STATIC, DISTRICT_PAGES = prerender_messages(MESSAGES, STATES_AND_DISTRICTS)
+DISTRICT_SEARCH = build_district_search(STATES_AND_DISTRICTS)
+prepare_tips(MESSAGES)
+LANG_MAP = {'1': 'en', '2': 'hi', '3': 'od', '4': 'kui', '5': 'sa'}
+GENDER_MAP = {'1': 'Male', '2': 'Female', '3': 'Other'}
+# Registration currently places every user in Odisha.
+DEFAULT_STATE = "Odisha"
+
+flow = ConversationMachine()
+
+def send_district_page(conv, page):
+    selected_state = conv.state_info.get('selected_state')
+    page_reply = DISTRICT_PAGES.get((conv.lang, selected_state, page))
+    if page_reply is not None:
+        conv.reply.add(page_reply)
+    else:
+        conv.reply.message(list_paginated(STATES_AND_DISTRICTS.get(selected_state, []), page_num=page))
+    conv.state_info['district_page'] = page
+
+def send_main_menu(conv, welcome=True):
+    if welcome:
+        conv.reply.message(MESSAGES[conv.lang]['welcome_back'].format(name=conv.user.name))
+    conv.reply.add(STATIC[conv.lang]['main_menu'])
+
+@flow.on('awaiting_symptoms')
+def symptoms_step(conv):
+    # Only the bare word ends the session (conv.msg is stripped and lower-cased), not a message mentioning it.
+    if conv.msg == 'exit':
+        conv.reply.message(handle_symptom_checker(conv.user, conv.state_info, conv.msg, conv.lang, MESSAGES))
+        conv.reset(state='awaiting_menu_choice', lang=conv.lang)
+        return
+    # Background workers already bound the Gemini calls made for queued turns.
+    with admission.expensive(conv.from_number, *(() if ASYNC_REPLIES else ('gemini',))) as admitted:
+        if not admitted:
+            conv.reply.add(STATIC[conv.lang]['please_wait'])
+        elif ASYNC_REPLIES:
+            # One number's turns run one at a time and in order; turn_id keeps a retry from appending twice.
+            enqueue('symptom_turn', {'to': conv.from_number, 'msg': conv.msg, 'lang': conv.lang, 'turn_id': uuid.uuid4().hex},
+                    key=f"symptoms:{conv.from_number}")
+        elif GEMINI_STREAMING:
+            # Segments go out through the REST API while Gemini is still writing; any that could
+            # not be sent that way go back in this reply.
+            segments = SegmentSender(conv.from_number)
+            handle_symptom_checker(conv.user, conv.state_info, conv.msg, conv.lang, MESSAGES, send_segment=segments)
+            for segment in segments.unsent:
+                conv.reply.message(segment)
+        else:
+            conv.reply.message(handle_symptom_checker(conv.user, conv.state_info, conv.msg, conv.lang, MESSAGES))
+
+@flow.on('awaiting_vaccine_choice')
+def vaccine_choice_step(conv):
+    def find_centers(vaccine, district, lang, MESSAGES):
+        with admission.expensive(conv.from_number, *(() if ASYNC_REPLIES else ('places',))) as admitted:
+            if not admitted:
+                return MESSAGES[lang]['please_wait']
+            if ASYNC_REPLIES:
+                enqueue('clinic_search', {'to': conv.from_number, 'vaccine': vaccine, 'district': district, 'lang': lang})
+                return None
+            return find_nearby_centers(vaccine, district, lang, MESSAGES)
+    response_text = handle_vaccination_reminders(conv.user, conv.state_info, conv.msg, conv.lang, MESSAGES, find_centers=find_centers)
+    if response_text:
+        conv.reply.message(response_text)
+    if conv.state_info.get('state') != 'awaiting_vaccine_choice':
+        # A deferred clinic search sends the menu itself, after the results.
+        if response_text:
+            conv.reply.add(STATIC[conv.lang]['main_menu'])
+        conv.reset(state='awaiting_menu_choice', lang=conv.lang)
+
+# --- Main Menu ---
+def menu_symptom_checker(conv):
+    conv.state_info['state'] = 'awaiting_symptoms'
+    conv.reply.add(STATIC[conv.lang]['symptom_checker_start'])
+
+def menu_vaccination(conv):
+    conv.state_info['state'] = 'awaiting_vaccine_choice'
+    conv.reply.message(handle_vaccination_reminders(conv.user, conv.state_info, "start", conv.lang, MESSAGES))
+
+def menu_tips(conv):
+    tips_message = get_preventive_tips(conv.user, conv.lang, MESSAGES)
+    conv.reply.message(tips_message or "No specific tips available at the moment.")
+    send_main_menu(conv, welcome=False)
+    conv.state_info['state'] = 'awaiting_menu_choice'
+
+def menu_outbreak_alerts(conv):
+    # Alerts come from the cached WHO feed but may need a Gemini translation.
+    with admission.expensive(conv.from_number, *(() if ASYNC_REPLIES else ('who', 'gemini'))) as admitted:
+        if not admitted:
+            conv.reply.add(STATIC[conv.lang]['please_wait'])
+        elif ASYNC_REPLIES:
+            enqueue('outbreak_check', {'to': conv.from_number, 'lang': conv.lang, 'manual': True})
+        else:
+            alert_message = get_outbreak_alert(conv.user, conv.lang)
+            conv.reply.message(alert_message or "No active alerts for your country at this time.")
+            send_main_menu(conv, welcome=False)
+    conv.state_info['state'] = 'awaiting_menu_choice'
+
+def menu_exit(conv):
+    conv.state_info.clear()
+    conv.reply.add(STATIC[conv.lang]['exit_message'])
+
+MENU_OPTIONS = {
+    '1': menu_symptom_checker,
+    '2': menu_vaccination,
+    '3': menu_tips,
+    '4': menu_outbreak_alerts,
+    '5': menu_exit,
+}
+
+def defer_enrichment(from_number, alerts):
+    """
+    Keeps a session-start message that missed its deadline, to be shown with the next reply.
+    An alert found by the check (in `alerts`, by enrichment name) is marked as seen only when shown.
+    """
+    def on_late(name, text):
+        with user_states.session(from_number) as state_info:
+            state_info.setdefault('deferred', []).append(text)
+            if name in alerts:
+                alert, _ = alerts[name]
+                state_info.setdefault('deferred_alerts', []).append({'id': alert['id'], 'published': alert.get('published')})
+    return on_late
+
+def checked_outbreak_alert(user, lang, alerts):
+    """
+    The unprompted alert check. The (alert, message) it finds is kept in `alerts`, not yet marked as
+    seen: that waits until the message is actually sent. Skipped, rather than waited for, when the
+    alert check's budgets are full.
+    """
+    with admission.upstreams('who', 'gemini') as admitted:
+        found = find_outbreak_alert(user, lang) if admitted else None
+    if found is None:
+        return None
+    alerts['outbreak_alert'] = found
+    return found[1]
+
+@flow.on(None, registered=True)
+def session_start_step(conv):
+    enrichments = [('tips', lambda: get_preventive_tips(conv.user, conv.lang, MESSAGES))]
+    alerts = {}
+    if ASYNC_REPLIES:
+        enqueue('outbreak_check', {'to': conv.from_number, 'lang': conv.lang})
+    else:
+        enrichments.insert(0, ('outbreak_alert', lambda: checked_outbreak_alert(conv.user, conv.lang, alerts)))
+    # The menu never waits more than ENRICHMENT_DEADLINE_MS; a late alert is shown on the next turn.
+    results = run_enrichments(enrichments, on_late=defer_enrichment(conv.from_number, alerts))
+    for text in results:
+        conv.reply.message(text)
+    if 'outbreak_alert' in alerts and alerts['outbreak_alert'][1] in results:
+        mark_outbreak_alert_seen(conv.user.id, alerts['outbreak_alert'][0])
+    menu_choice_step(conv)
+
+@flow.on('awaiting_menu_choice', registered=True)
+def menu_choice_step(conv):
+    option = MENU_OPTIONS.get(conv.msg)
+    if option:
+        conv.reset(lang=conv.lang)
+        option(conv)
+    else:
+        send_main_menu(conv)
+        conv.reset(state='awaiting_menu_choice', lang=conv.lang)
+
+@flow.fallback(registered=True)
+def registered_fallback_step(conv):
+    pass
+
+# --- Registration ---
+@flow.on(None, registered=False)
+def greeting_step(conv):
+    if conv.msg == 'hi':
+        conv.reply.add(STATIC[None]['language_select'])
+        conv.reset(state='awaiting_language')
+    else:
+        conv.reply.add(STATIC[None]['say_hi'])
+
+@flow.on('awaiting_language', registered=False)
+def language_step(conv):
+    lang = LANG_MAP.get(conv.msg)
+    if lang:
+        conv.reset(state='awaiting_name', lang=lang)
+        conv.reply.add(STATIC[lang]['welcome'])
+    else:
+        conv.reply.add(STATIC[None]['invalid_language'])
+
+@flow.on('awaiting_name', registered=False)
+def name_step(conv):
+    conv.state_info['name'] = conv.body
+    conv.reply.add(STATIC[conv.lang]['ask_age'])
+    conv.state_info['state'] = 'awaiting_age'
+
+@flow.on('awaiting_age', registered=False)
+def age_step(conv):
+    try:
+        age = int(conv.msg)
+    except ValueError:
+        age = None
+    if age is not None and 1 <= age <= 120:
+        conv.state_info['age'] = age
+        conv.reply.add(STATIC[conv.lang]['ask_gender'])
+        conv.state_info['state'] = 'awaiting_gender'
+    else:
+        conv.reply.add(STATIC[conv.lang]['invalid_age'])
+
+@flow.on('awaiting_gender', registered=False)
+def gender_step(conv):
+    gender = GENDER_MAP.get(conv.msg)
+    if gender is None:
+        conv.reply.add(STATIC[conv.lang]['invalid_gender'])
+        return
+    conv.state_info['gender'] = gender
+    # The state question is skipped: the district list is asked for directly.
+    conv.state_info['selected_state'] = DEFAULT_STATE
+    conv.state_info['state'] = 'awaiting_district'
+    send_district_page(conv, 1)
+
+def find_district(conv, selected_state, districts):
+    """Resolves a typed district name; if unsure, replies with numbered suggestions instead."""
+    index = DISTRICT_SEARCH.get(selected_state)
+    with stage_timer('district_search') as timer:
+        district, suggestions = index.resolve(conv.msg) if index else (None, [])
+        timer.outcome = 'match' if district else 'suggest' if suggestions else 'miss'
+    if district is None:
+        if suggestions:
+            lines = [f"{districts.index(name) + 1}. {name}" for name in suggestions]
+            conv.reply.message("\n".join([MESSAGES[conv.lang]['district_suggestions'], *lines]))
+        else:
+            conv.reply.add(STATIC[conv.lang]['invalid_district'])
+    return district
+
+@flow.on('awaiting_district', registered=False)
+def district_step(conv):
+    if conv.msg == 'more':
+        send_district_page(conv, conv.state_info.get('district_page', 1) + 1)
+        return
+    selected_state = conv.state_info.get('selected_state')
+    districts = STATES_AND_DISTRICTS.get(selected_state, [])
+    try:
+        choice = int(conv.msg)
+    except (ValueError, TypeError):
+        choice = 0
+    if 1 <= choice <= len(districts):
+        district = districts[choice - 1]
+    else:
+        district = find_district(conv, selected_state, districts)
+        if district is None:
+            return
+    state_info = conv.state_info
+    user_id = add_user(mobile=conv.from_number, name=state_info['name'], age=state_info['age'], gender=state_info['gender'],
+                       state=selected_state, district=district, language=conv.lang)
+    # Due dates are stored in the background; registration does not wait on them.
+    enqueue('plan_vaccinations', {'user_id': user_id, 'age': int(state_info['age']), 'recorded_on': date.today().isoformat()})
+    conv.user = get_user(conv.from_number)
+    conv.reply.add(STATIC[conv.lang]['registered'])
+    send_main_menu(conv)
+    conv.reset(state='awaiting_menu_choice', lang=conv.lang)
+
+@flow.fallback(registered=False)
+def unregistered_fallback_step(conv):
+    conv.reply.add(STATIC[None]['say_hi'])
+
+def handle_message(from_number, incoming_msg, state_info, resp, body=None):
+    """Runs one step of the conversation, mutating `state_info` and appending replies to `resp`."""
+    user = get_user(from_number)
+    lang = (user.language or 'en') if user else state_info.get('lang', 'en')
+    set_lang(lang)
+    conv = Conversation(from_number, incoming_msg, body if body is not None else incoming_msg, state_info, resp, user, lang)
+    for text in state_info.pop('deferred', ()):
+        resp.message(text)
+    for alert in state_info.pop('deferred_alerts', ()):
+        if user:
+            mark_outbreak_alert_seen(user.id, alert)
+    if incoming_msg == 'menu':
+        state_info.clear()
+        if user:
+            send_main_menu(conv)
+            conv.reset(state='awaiting_menu_choice', lang=lang)
+        return
+    flow.dispatch(conv)
+
+def rate_limited_reply(from_number):
+    """The please-wait TwiML, in the user's language if this process has them cached (it never queries)."""
+    user = get_cached_user(from_number)
+    resp = TwimlReply()
+    resp.add(STATIC[(user.language if user else None) or 'en']['please_wait'])
+    return resp.to_bytes()
+
+def process_message(from_number, body):
+    """Handles one incoming message and returns the TwiML reply as bytes."""
+    resp = TwimlReply()
+    with user_states.session(from_number) as state_info:
+        handle_message(from_number, body.lower(), state_info, resp, body=body)
+    return resp.to_bytes()
 
 @app.route("/message", methods=['POST'])
 def reply():
     try:
         from_number = request.values.get('From', '')
-        incoming_msg = request.values.get('Body', '').strip().lower()
-        resp = MessagingResponse()
-        
-        user = get_user(from_number)
-        state_info = user_states.get(from_number, {})
-        current_state = state_info.get('state')
-        
-        lang = state_info.get('lang', 'en')
-        if user:
-            lang = user[7] if len(user) > 7 and user[7] else 'en'
-
-        if incoming_msg == 'menu':
-            if from_number in user_states: del user_states[from_number]
-            if user:
-                resp.message(MESSAGES[lang]['welcome_back'].format(name=user[2]))
-                resp.message(MESSAGES[lang]['main_menu'])
-                user_states[from_number] = {'state': 'awaiting_menu_choice', 'lang': lang}
-            return str(resp)
-
-        if current_state == 'awaiting_symptoms':
-            response_text = handle_symptom_checker(user, state_info, incoming_msg, lang, MESSAGES)
-            resp.message(response_text)
-            if "exit" in incoming_msg:
-                 if from_number in user_states: del user_states[from_number]
-                 user_states[from_number] = {'state': 'awaiting_menu_choice', 'lang': lang}
-            return str(resp)
-        
-        elif current_state == 'awaiting_vaccine_choice':
-            response_text = handle_vaccination_reminders(user, state_info, incoming_msg, lang, MESSAGES)
-            resp.message(response_text)
-            if user_states.get(from_number, {}).get('state') != 'awaiting_vaccine_choice':
-                 resp.message(MESSAGES[lang]['main_menu'])
-                 user_states[from_number] = {'state': 'awaiting_menu_choice', 'lang': lang}
-            return str(resp)
-
-        elif user:
-            if not current_state:
-                alert_message = get_outbreak_alert(user, lang)
-                if alert_message:
-                    resp.message(alert_message)
-                tips_message = get_preventive_tips(user, lang, MESSAGES)
-                if tips_message:
-                    resp.message(tips_message)
-            
-            if current_state in [None, 'awaiting_menu_choice']:
-                if incoming_msg in ['1','2','3','4','5']:
-                    user_states[from_number] = {'lang': lang}
-                    if incoming_msg == '1':
-                        user_states[from_number]['state'] = 'awaiting_symptoms'
-                        resp.message(MESSAGES[lang]['symptom_checker_start'])
-                    elif incoming_msg == '2':
-                        user_states[from_number]['state'] = 'awaiting_vaccine_choice'
-                        response_text = handle_vaccination_reminders(user, user_states[from_number], "start", lang, MESSAGES)
-                        resp.message(response_text)
-                    elif incoming_msg == '3':
-                        tips_message = get_preventive_tips(user, lang, MESSAGES)
-                        resp.message(tips_message or "No specific tips available at the moment.")
-                        resp.message(MESSAGES[lang]['main_menu'])
-                        user_states[from_number]['state'] = 'awaiting_menu_choice'
-                    elif incoming_msg == '4':
-                        alert_message = get_outbreak_alert(user, lang)
-                        resp.message(alert_message or "No active alerts for your country at this time.")
-                        resp.message(MESSAGES[lang]['main_menu'])
-                        user_states[from_number]['state'] = 'awaiting_menu_choice'
-                    elif incoming_msg == '5':
-                        if from_number in user_states: del user_states[from_number]
-                        resp.message(MESSAGES[lang]['exit_message'])
-                else:
-                    resp.message(MESSAGES[lang]['welcome_back'].format(name=user[2]))
-                    resp.message(MESSAGES[lang]['main_menu'])
-                    user_states[from_number] = {'state': 'awaiting_menu_choice', 'lang': lang}
-        else:
-            if current_state is None and incoming_msg == 'hi':
-                resp.message(MESSAGES['language_select'])
-                user_states[from_number] = {'state': 'awaiting_language'}
-            elif current_state == 'awaiting_language':
-                if incoming_msg in ['1','2','3','4','5']:
-                    lang_map = {'1':'en', '2':'hi', '3':'od', '4':'kui', '5':'sa'}
-                    lang = lang_map[incoming_msg]
-                    user_states[from_number] = {'state': 'awaiting_name', 'lang': lang}
-                    resp.message(MESSAGES[lang]['welcome'])
-                else: resp.message("Invalid selection. " + MESSAGES['language_select'])
-            elif current_state == 'awaiting_name':
-                state_info['name'] = request.values.get('Body', '').strip()
-                resp.message(MESSAGES[lang]['ask_age'])
-                state_info['state'] = 'awaiting_age'
-            elif current_state == 'awaiting_age':
-                try:
-                    age = int(incoming_msg)
-                    if 1 <= age <= 120:
-                        state_info['age'] = age
-                        resp.message(MESSAGES[lang]['ask_gender'])
-                        state_info['state'] = 'awaiting_gender'
-                    else: resp.message(MESSAGES[lang]['invalid_age'])
-                except ValueError: resp.message(MESSAGES[lang]['invalid_age'])
-            
-            # --- MODIFIED REGISTRATION FLOW ---
-            elif current_state == 'awaiting_gender':
-                gender_map = {'1': 'Male', '2': 'Female', '3': 'Other'}
-                if incoming_msg in gender_map:
-                    state_info['gender'] = gender_map[incoming_msg]
-                    
-                    # Set state to Odisha by default
-                    selected_state = "Odisha"
-                    state_info['selected_state'] = selected_state
-                    
-                    # Ask for district directly
-                    district_list_text = f"{MESSAGES[lang]['ask_district']}\n\n"
-                    districts = STATES_AND_DISTRICTS[selected_state]
-                    district_list = list_paginated(districts)
-                    
-                    resp.message(district_list_text + district_list)
-                    state_info['state'] = 'awaiting_district'
-                    state_info['district_page'] = 1
-                else:
-                    resp.message(MESSAGES[lang]['invalid_gender'])
-            
-            # This block is now skipped
-            # elif current_state == 'awaiting_state': ...
-
-            elif current_state == 'awaiting_district':
-                selected_state = state_info.get('selected_state')
-                districts = STATES_AND_DISTRICTS.get(selected_state, [])
-                page = state_info.get('district_page', 1)
-                if incoming_msg == 'more':
-                    page += 1
-                    district_list = list_paginated(districts, page_num=page)
-                    resp.message(district_list); state_info['district_page'] = page
-                else:
-                    try:
-                        choice = int(incoming_msg)
-                        if 1 <= choice <= len(districts):
-                            selected_district = districts[choice - 1]
-                            add_user(mobile=from_number, name=state_info['name'], age=state_info['age'], gender=state_info['gender'], state=selected_state, district=selected_district, language=lang)
-                            newly_registered_user = get_user(from_number)
-                            resp.message(MESSAGES[lang]['registered'])
-                            resp.message(MESSAGES[lang]['welcome_back'].format(name=newly_registered_user[2]))
-                            resp.message(MESSAGES[lang]['main_menu'])
-                            user_states[from_number] = {'state': 'awaiting_menu_choice', 'lang': lang}
-                        else: resp.message(MESSAGES[lang]['invalid_district'])
-                    except (ValueError, TypeError): resp.message(MESSAGES[lang]['invalid_district'])
-            else: resp.message("Welcome! Please say 'hi' to start.")
-        return str(resp)
+        # The number's message bucket comes first, so a flood costs no user lookup, lock or MessageSid entry.
+        if not admission.allow_message(from_number):
+            return Response(rate_limited_reply(from_number), mimetype='application/xml')
+        body = request.values.get('Body', '').strip()
+
+        # A Twilio retry of a message already handled (or still being handled) gets the same reply.
+        with request_scope():
+            twiml = webhook_responses.run(request.values.get('MessageSid', ''), lambda: process_message(from_number, body))
+        if twiml is STILL_RUNNING:
+            twiml = EMPTY_TWIML
+        return Response(twiml, mimetype='application/xml')
 
     except Exception as e:
         logging.error(f"FATAL ERROR for number {request.values.get('From', '')}: {e}", exc_info=True)
@@ -322,7 +631,7 @@ def delete_my_data():
     if not my_number: return "MY_NUMBER not set in .env"
     try:
         delete_user(my_number)
-        if my_number in user_states: del user_states[my_number]
+        user_states.delete(my_number)
         return f"User data for {my_number} has been deleted."
     except Exception as e: return f"Error deleting user: {e}"
 
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of the static conversation steps: table dispatch with pre-rendered TwiML
+versus formatting the same reply with MessagingResponse on every request, as reply() used to.
+Runs in-process with no database or network (user lookups are answered from memory).
+
+    python bench_conversation.py [--iterations 20000]
+"""
+import argparse
+import logging
+import timeit
+from twilio.twiml.messaging_response import MessagingResponse
+
+import app
+from database import UserRecord
+
+USER = UserRecord(1, 'whatsapp:+910000000001', 'Asha', 30, 'Female', 'Odisha', 'Khordha', 'od')
+
+def legacy_reply(*texts):
+    resp = MessagingResponse()
+    for text in texts:
+        resp.message(text)
+    return str(resp).encode('utf-8')
+
+def step(msg, state_info, user=None):
+    """Runs one message through handle_message against a copy of `state_info`."""
+    def run():
+        app.get_user = lambda number: user
+        resp = app.TwimlReply()
+        app.handle_message(USER.mobile_number, msg, dict(state_info), resp, body=msg)
+        return resp.to_bytes()
+    return run
+
+def main():
+    logging.disable(logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    messages = app.MESSAGES
+    districts = app.STATES_AND_DISTRICTS[app.DEFAULT_STATE]
+    cases = [
+        ("language select", step('hi', {}),
+         lambda: legacy_reply(messages['language_select'])),
+        ("language chosen", step('3', {'state': 'awaiting_language'}),
+         lambda: legacy_reply(messages['od']['welcome'])),
+        ("invalid age", step('abc', {'state': 'awaiting_age', 'lang': 'od'}),
+         lambda: legacy_reply(messages['od']['invalid_age'])),
+        ("district page 2", step('more', {'state': 'awaiting_district', 'lang': 'od', 'selected_state': app.DEFAULT_STATE, 'district_page': 1}),
+         lambda: legacy_reply(app.list_paginated(districts, page_num=2))),
+        ("menu exit", step('5', {'state': 'awaiting_menu_choice', 'lang': 'od'}, user=USER),
+         lambda: legacy_reply(messages['od']['exit_message'])),
+    ]
+    print(f"{'step':<18}{'legacy us':>12}{'table us':>12}{'speed-up':>10}")
+    for name, new, legacy in cases:
+        assert new() == legacy(), f"{name}: replies differ"
+        legacy_us = min(timeit.repeat(legacy, number=args.iterations, repeat=3)) / args.iterations * 1e6
+        new_us = min(timeit.repeat(new, number=args.iterations, repeat=3)) / args.iterations * 1e6
+        print(f"{name:<18}{legacy_us:>12.2f}{new_us:>12.2f}{legacy_us / new_us:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import time
+import threading
+from concurrent.futures import Future, wait
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache:
+    """
+    A thread-safe LRU cache whose entries also expire `ttl` seconds after they were set.
+    Once `maxsize` entries are held, the least recently used one is evicted.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[1] <= now:
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def purge_expired(self):
+        """Drops every expired entry; returns how many were removed."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._data.items() if expires_at <= now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FlightTimeout(Exception):
+    """Raised to a SingleFlight caller that gave up waiting for another caller's call."""
+
+
+class SingleFlight:
+    """
+    De-duplicates concurrent work: while `fn` is running for a key, other callers asking
+    for the same key wait for that call and share its result (or its exception).
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        """
+        Runs fn() for `key`, or joins the call already running for it. A caller that joins
+        waits at most `timeout` seconds (None: no limit), then gets FlightTimeout.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            # Waits apart from result(): fn's own TimeoutError must reach the caller as it is.
+            if not wait([future], timeout).done:
+                raise FlightTimeout(key)
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._inflight
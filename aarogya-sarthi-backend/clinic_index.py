@@ -0,0 +1,139 @@
+"""
+Persistent index of vaccination centres keyed by (vaccine, district).
+
+Lookups are served from a local SQLite file. The live Google Places search only runs on a
+cache miss (concurrent misses for the same key share one call), or in the background when
+an entry is older than CLINIC_INDEX_TTL. The index is normally warmed offline:
+
+    python clinic_index.py warm [--all-states] [--qps 5] [--force]
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from dotenv import load_dotenv
+
+from cache import SingleFlight
+from rate_limit import TokenBucket
+
+load_dotenv()
+
+# --- Clinic Index Configuration ---
+CLINIC_INDEX_PATH = os.environ.get("CLINIC_INDEX_PATH", "clinic_index.db")
+# Entries older than this are still served, but refreshed in the background.
+CLINIC_INDEX_TTL = int(os.environ.get("CLINIC_INDEX_TTL", 7 * 24 * 3600))
+# Only the first few results are ever shown to users.
+CLINIC_RESULTS_KEPT = 3
+
+
+class ClinicIndex:
+    """Read-through (vaccine, district) -> [{'name', 'address'}] index on local disk."""
+
+    def __init__(self, fetch, path=CLINIC_INDEX_PATH, ttl=CLINIC_INDEX_TTL):
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._flights = SingleFlight()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS clinics ("
+            "vaccine TEXT NOT NULL, district TEXT NOT NULL, results TEXT NOT NULL, fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (vaccine, district))"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_cached(self, vaccine, district):
+        """Returns (results, fetched_at) from the index, or None if the key was never fetched."""
+        row = self._conn().execute(
+            "SELECT results, fetched_at FROM clinics WHERE vaccine = ? AND district = ?", (vaccine, district)
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def store(self, vaccine, district, results):
+        self._conn().execute(
+            "INSERT INTO clinics (vaccine, district, results, fetched_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(vaccine, district) DO UPDATE SET results = excluded.results, fetched_at = excluded.fetched_at",
+            (vaccine, district, json.dumps(results[:CLINIC_RESULTS_KEPT]), time.time())
+        )
+
+    def refresh(self, vaccine, district):
+        """Fetches the key live (once, however many callers ask at the same time) and stores it."""
+        def fetch_and_store():
+            results = self.fetch(vaccine, district)[:CLINIC_RESULTS_KEPT]
+            self.store(vaccine, district, results)
+            return results
+        return self._flights.do((vaccine, district), fetch_and_store)
+
+    def _refresh_in_background(self, vaccine, district):
+        if self._flights.in_flight((vaccine, district)):
+            return
+        def run():
+            try:
+                self.refresh(vaccine, district)
+            except Exception as e:
+                logging.error(f"Background refresh of clinics for {vaccine} in {district} failed: {e}")
+        threading.Thread(target=run, daemon=True).start()
+
+    def lookup(self, vaccine, district):
+        """Returns the centres for a key, going to the live API only if it was never indexed."""
+        cached = self.get_cached(vaccine, district)
+        if cached is None:
+            return self.refresh(vaccine, district)
+        results, fetched_at = cached
+        if time.time() - fetched_at > self.ttl:
+            self._refresh_in_background(vaccine, district)
+        return results
+
+
+def warm(index, districts, vaccines, qps, force=False):
+    """Fetches every (vaccine, district) pair that is missing or stale. Returns (fetched, failed)."""
+    bucket = TokenBucket(qps)
+    fetched = failed = 0
+    for district in districts:
+        for vaccine in vaccines:
+            cached = index.get_cached(vaccine, district)
+            if cached and not force and time.time() - cached[1] <= index.ttl:
+                continue
+            bucket.acquire()
+            try:
+                index.refresh(vaccine, district)
+                fetched += 1
+            except Exception as e:
+                failed += 1
+                logging.error(f"Could not index clinics for {vaccine} in {district}: {e}")
+    return fetched, failed
+
+def main():
+    from location_data import STATES_AND_DISTRICTS
+    from vaccination_reminders import VACCINE_SCHEDULE, get_clinic_index
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['warm'])
+    parser.add_argument('--all-states', action='store_true', help="index every state, not only Odisha")
+    parser.add_argument('--qps', type=float, default=5, help="maximum Places API calls per second")
+    parser.add_argument('--force', action='store_true', help="re-fetch entries that are still fresh")
+    args = parser.parse_args()
+
+    # Registration currently places every user in Odisha.
+    states = STATES_AND_DISTRICTS if args.all_states else {'Odisha': STATES_AND_DISTRICTS['Odisha']}
+    districts = [district for state_districts in states.values() for district in state_districts]
+    vaccines = list(dict.fromkeys(v for group in VACCINE_SCHEDULE.values() for v in group['vaccines']))
+    logging.info(f"Warming {len(districts)} districts x {len(vaccines)} vaccines.")
+    fetched, failed = warm(get_clinic_index(), districts, vaccines, args.qps, args.force)
+    logging.info(f"Done: {fetched} fetched, {failed} failed.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Table-driven conversation flow and pre-rendered TwiML replies.
+
+Each (registered?, state) pair maps to one handler in a ConversationMachine, so a message is
+dispatched with a single dict lookup. Replies are built from <Message> fragments; static text
+(menus, prompts, district pages) is rendered to TwiML bytes once at startup, and a reply made of
+one static message is served as a complete pre-rendered response.
+"""
+from collections import namedtuple
+from twilio.twiml.messaging_response import Message
+
+from metrics import stage_timer
+
+TWIML_HEADER = b'<?xml version="1.0" encoding="UTF-8"?><Response>'
+TWIML_FOOTER = b'</Response>'
+EMPTY_TWIML = b'<?xml version="1.0" encoding="UTF-8"?><Response />'
+
+# --- Pre-rendered TwiML ---
+Static = namedtuple('Static', ['fragment', 'response'])
+
+def render_fragment(text):
+    """Renders one <Message> element exactly as twilio's MessagingResponse would."""
+    return Message(text).to_xml(xml_declaration=False).encode('utf-8')
+
+def render_static(text):
+    fragment = render_fragment(text)
+    return Static(fragment, TWIML_HEADER + fragment + TWIML_FOOTER)
+
+
+class TwimlReply:
+    """Drop-in for MessagingResponse that accepts both dynamic text and pre-rendered messages."""
+
+    __slots__ = ('_parts',)
+
+    def __init__(self):
+        self._parts = []
+
+    def message(self, text):
+        self._parts.append(render_fragment(text))
+
+    def add(self, static):
+        self._parts.append(static)
+
+    def to_bytes(self):
+        parts = self._parts
+        if not parts:
+            return EMPTY_TWIML
+        if len(parts) == 1 and isinstance(parts[0], Static):
+            return parts[0].response
+        return b''.join([TWIML_HEADER, *(part.fragment if isinstance(part, Static) else part for part in parts), TWIML_FOOTER])
+
+
+def list_paginated(items, page_num=1, page_size=10):
+    start = (page_num - 1) * page_size
+    end = start + page_size
+    lines = [f"{i}. {item}" for i, item in enumerate(items[start:end], start + 1)]
+    response_text = "\n".join(lines) + "\n" if lines else ""
+    if end < len(items):
+        response_text += "\nReply with 'more' to see the next page."
+    return response_text
+
+def prerender_messages(messages, states_and_districts, page_size=10):
+    """
+    Renders every static reply once. Returns (static, district_pages):
+      static[lang][key] for each string in MESSAGES[lang] (templates such as 'welcome_back' excluded),
+      static[None][key] for language-independent replies, and
+      district_pages[(lang, state, page)] for the district pick list, with the prompt on page 1.
+    """
+    static = {None: {
+        'language_select': render_static(messages['language_select']),
+        'invalid_language': render_static("Invalid selection. " + messages['language_select']),
+        'say_hi': render_static("Welcome! Please say 'hi' to start."),
+    }}
+    district_pages = {}
+    for lang, texts in messages.items():
+        if not isinstance(texts, dict):
+            continue
+        static[lang] = {key: render_static(text) for key, text in texts.items() if '{' not in text}
+        for state, districts in states_and_districts.items():
+            pages = max(1, -(-len(districts) // page_size))
+            for page in range(1, pages + 1):
+                text = list_paginated(districts, page_num=page, page_size=page_size)
+                if page == 1:
+                    text = f"{texts['ask_district']}\n\n{text}"
+                district_pages[(lang, state, page)] = render_static(text)
+    return static, district_pages
+
+
+# --- State Machine ---
+class Conversation:
+    """Everything a handler needs for one incoming message."""
+
+    __slots__ = ('from_number', 'msg', 'body', 'state_info', 'reply', 'user', 'lang')
+
+    def __init__(self, from_number, msg, body, state_info, reply, user, lang):
+        self.from_number = from_number
+        self.msg = msg              # normalised (stripped, lower-case) text
+        self.body = body            # the text as typed, e.g. for names
+        self.state_info = state_info
+        self.reply = reply
+        self.user = user
+        self.lang = lang
+
+    def reset(self, **values):
+        """Replaces the contents of the number's state dict in place."""
+        self.state_info.clear()
+        self.state_info.update(values)
+
+
+class ConversationMachine:
+    """Dispatch table from (registered, state) to the handler for that step."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._fallbacks = {}
+
+    def on(self, *states, registered=(True, False)):
+        """Registers a handler for `states`, for registered users, unregistered ones, or both."""
+        registered = registered if isinstance(registered, tuple) else (registered,)
+        def decorator(handler):
+            for state in states:
+                for is_registered in registered:
+                    self._handlers[(is_registered, state)] = handler
+            return handler
+        return decorator
+
+    def fallback(self, registered):
+        """Registers the handler for states with no entry of their own."""
+        def decorator(handler):
+            self._fallbacks[registered] = handler
+            return handler
+        return decorator
+
+    def dispatch(self, conv):
+        registered = conv.user is not None
+        handler = self._handlers.get((registered, conv.state_info.get('state')))
+        if handler is None:
+            handler = self._fallbacks.get(registered)
+        if handler is not None:
+            with stage_timer(f"handler.{handler.__name__}"):
+                handler(conv)
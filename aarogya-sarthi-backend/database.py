@@ -1,113 +1,666 @@
 import os
+import time
+import select
+import logging
+import threading
+from datetime import date, datetime, timezone
+from collections import namedtuple
+from contextlib import contextmanager
 import psycopg2
-import json # Needed for storing chat history
+from psycopg2 import extensions, extras, pool as pg_pool
 from dotenv import load_dotenv
 
+from cache import TTLCache
+from metrics import stage_timer
+
 load_dotenv()
 
-# Function to get a database connection
+# --- Connection Pool Configuration ---
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+# Seconds a caller may wait for a free connection before giving up.
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Connections idle for longer than this are pinged before being handed out.
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', 30))
+
+# --- User Cache Configuration ---
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 50000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+# Postgres NOTIFY channel other workers use to tell us a profile changed.
+USER_CHANGED_CHANNEL = 'user_changed'
+# Payload announcing a bulk change (e.g. an import); every cached profile is dropped.
+ALL_USERS_CHANGED = '*'
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Raised when no pooled connection became free within DB_POOL_TIMEOUT."""
+
+
+class ConnectionPool:
+    """
+    A thread-safe PostgreSQL connection pool.
+
+    Wraps psycopg2's ThreadedConnectionPool, which raises as soon as it runs dry,
+    with a semaphore so callers queue for a free connection instead. Connections
+    that sat idle are health-checked before reuse and replaced if they went stale.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_after, **connect_kwargs):
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self.checked_out = 0
+        self.waiters = 0
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+        self.stale_replaced = 0
+
+    def getconn(self):
+        with self._lock:
+            self.waiters += 1
+        start = time.monotonic()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.monotonic() - start
+        with self._lock:
+            self.waiters -= 1
+            self.wait_count += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            if not acquired:
+                self.timeouts += 1
+        if not acquired:
+            raise PoolTimeout(f"No database connection became free within {self.timeout}s")
+
+        try:
+            conn = self._get_healthy_conn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checked_out += 1
+        return conn
+
+    def _get_healthy_conn(self):
+        # Every pooled connection could be stale after a proxy restart, so allow one retry per slot.
+        for _ in range(self.maxconn + 1):
+            conn = self._pool.getconn()
+            if not conn.closed and self._is_fresh(conn):
+                return conn
+            with self._lock:
+                self.stale_replaced += 1
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("Could not obtain a healthy database connection")
+
+    def _is_fresh(self, conn):
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.healthcheck_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def putconn(self, conn, broken=False):
+        try:
+            if not broken and not conn.closed:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self._last_used[id(conn)] = time.monotonic()
+            else:
+                self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=broken or bool(conn.closed))
+        finally:
+            with self._lock:
+                self.checked_out -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_size': self.maxconn,
+                'open': len(self._pool._pool) + len(self._pool._used),
+                'checked_out': self.checked_out,
+                'idle': len(self._pool._pool),
+                'waiters': self.waiters,
+                'wait_count': self.wait_count,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+                'timeouts': self.timeouts,
+                'stale_replaced': self.stale_replaced,
+            }
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _connect_kwargs():
+    return {
+        'host': os.environ.get('DB_HOST'),
+        'database': os.environ.get('DB_NAME'),
+        'user': os.environ.get('DB_USER'),
+        'password': os.environ.get('DB_PASSWORD'),
+    }
+
+def _get_pool():
+    """Returns the process-wide pool, creating it lazily (and again after a fork)."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                # A forked worker must not reuse (or close) sockets inherited from its parent,
+                # so the old pool is simply abandoned and a fresh one is opened for this process.
+                _pool = ConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_AFTER, **_connect_kwargs()
+                )
+                _pool_pid = pid
+    return _pool
+
+@contextmanager
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.environ.get('DB_HOST'),
-        database=os.environ.get('DB_NAME'),
-        user=os.environ.get('DB_USER'),
-        password=os.environ.get('DB_PASSWORD')
-    )
-    return conn
+    """
+    Borrows a connection from the pool for the duration of a `with` block.
+    Commits when the block succeeds and rolls back if it raises.
+    """
+    pool = _get_pool()
+    with stage_timer('postgres.pool_wait'):
+        conn = pool.getconn()
+    broken = False
+    try:
+        with stage_timer('postgres'):
+            yield conn
+            conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, broken=broken)
+
+def get_pool_stats():
+    """Returns a snapshot of pool usage (checked-out connections, waiters, wait times)."""
+    if _pool is None or _pool_pid != os.getpid():
+        return {}
+    return _pool.stats()
+
+def close_pool():
+    """Closes every pooled connection, e.g. from a worker's exit hook."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
 
 # --- User Management Functions ---
+# Tables and indexes are created by migrations.py; `python migrations.py check` EXPLAINs the queries below.
+# Table: users (id SERIAL PRIMARY KEY, mobile_number TEXT UNIQUE, name TEXT, age INT, gender TEXT,
+#               state TEXT, district TEXT, language TEXT, date_of_birth DATE, age_recorded_on DATE DEFAULT CURRENT_DATE)
+#        -- import_beneficiaries.py upserts on mobile_number
+
+# Only the columns the bot reads; the positions match the old `SELECT *` tuple.
+USER_COLUMNS = ('id', 'mobile_number', 'name', 'age', 'gender', 'state', 'district', 'language')
+UserRecord = namedtuple('UserRecord', USER_COLUMNS)
+
+# Read-through cache of profiles by mobile number. Unregistered numbers are cached too
+# (as _NO_USER) so people mid-registration do not hit the database on every message.
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_NO_USER = object()
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+def _notify_user_changed(cur, mobile):
+    cur.execute("SELECT pg_notify(%s, %s)", (USER_CHANGED_CHANNEL, mobile))
+
+def _listen_for_user_changes():
+    """Evicts cached profiles that another worker changed, as announced over NOTIFY."""
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**_connect_kwargs())
+            conn.set_session(autocommit=True)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {USER_CHANGED_CHANNEL}")
+            # Notifications may have been missed while we were disconnected.
+            _user_cache.clear()
+            backoff = 1
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    mobile = conn.notifies.pop(0).payload
+                    if mobile == ALL_USERS_CHANGED:
+                        _user_cache.clear()
+                    else:
+                        _user_cache.pop(mobile)
+        except Exception as e:
+            logging.error(f"User cache listener lost its connection, retrying in {backoff}s: {e}")
+            _user_cache.clear()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
+
+def _start_user_cache_listener():
+    global _listener_pid
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    threading.Thread(target=_listen_for_user_changes, name="user-cache-listener", daemon=True).start()
 
 def add_user(mobile, name, age, gender, state, district, language):
     """Adds a new user to the database and returns the new user's ID."""
-    conn = get_db_connection()
-    user_id = None
-    with conn.cursor() as cur:
-        # The SQL command now includes the correct columns
-        cur.execute(
-            """
-            INSERT INTO users (mobile_number, name, age, gender, state, district, language) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
-            """,
-            (mobile, name, age, gender, state, district, language)
-        )
-        user_id = cur.fetchone()[0]
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # The SQL command now includes the correct columns
+            cur.execute(
+                """
+                INSERT INTO users (mobile_number, name, age, gender, state, district, language) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
+                """,
+                (mobile, name, age, gender, state, district, language)
+            )
+            user_id = cur.fetchone()[0]
+            _notify_user_changed(cur, mobile)
+    _user_cache.pop(mobile)
     print(f"User {name} with ID {user_id} added successfully.")
     return user_id
 
+def get_cached_user(mobile):
+    """The user get_user would return if this process has it cached, else None. Never queries."""
+    user = _user_cache.get(mobile)
+    return None if user is _NO_USER else user
+
 def get_user(mobile):
-    """Gets a user by their mobile number."""
-    conn = get_db_connection()
-    user = None
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM users WHERE mobile_number = %s", (mobile,))
-        user = cur.fetchone()
-    conn.close()
+    """Gets a user by their mobile number, as a UserRecord (or None if unregistered)."""
+    _start_user_cache_listener()
+    user = _user_cache.get(mobile)
+    if user is not None:
+        return None if user is _NO_USER else user
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE mobile_number = %s", (mobile,))
+            row = cur.fetchone()
+    user = UserRecord(*row) if row else None
+    _user_cache.set(mobile, _NO_USER if user is None else user)
     return user
 
 def delete_user(mobile):
     """Deletes a user by their mobile number."""
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("DELETE FROM users WHERE mobile_number = %s", (mobile,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM users WHERE mobile_number = %s", (mobile,))
+            _notify_user_changed(cur, mobile)
+    _user_cache.pop(mobile)
     print(f"User with mobile number {mobile} deleted.")
 
 
 # --- Symptom Checker Functions ---
+# Table: symptom_chat_turns (user_id INT, session_id INT, seq INT, role TEXT, text TEXT, turn_id TEXT,
+#                            created_at TIMESTAMPTZ DEFAULT now(), PRIMARY KEY (user_id, session_id, seq, created_at))
+#        partitioned by month of created_at, so the primary key cannot keep seq unique on its own: append_chat_turns
+#        locks the user's symptom_chats row before numbering, which serialises every append for a user (webhook or
+#        job, in any process). A queued turn's turn_id makes a retried append a no-op.
+# Table: symptom_chats (user_id INT PRIMARY KEY, session_id INT DEFAULT 1, summary TEXT,
+#                       summarized_upto INT DEFAULT 0, chat_history JSON -- legacy blob, see migrate_chat_history.py)
+
+def get_chat_session(user_id):
+    """
+    Returns the user's current checker session: its id, the running summary and the seq of the
+    last turn that summary covers. Creates the session row on first use.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT session_id, summary, summarized_upto FROM symptom_chats WHERE user_id = %s",
+                (user_id,)
+            )
+            result = cur.fetchone()
+            if not result:
+                cur.execute(
+                    """
+                    INSERT INTO symptom_chats (user_id) VALUES (%s)
+                    ON CONFLICT (user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+                    RETURNING session_id, summary, summarized_upto
+                    """,
+                    (user_id,)
+                )
+                result = cur.fetchone()
+    session_id, summary, summarized_upto = result
+    return {'session_id': session_id, 'summary': summary, 'summarized_upto': summarized_upto}
+
+def get_recent_turns(user_id, session_id, limit, after_seq=0):
+    """Returns up to `limit` (None for all) of the session's latest turns after `after_seq`, oldest first."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT seq, role, text, turn_id FROM symptom_chat_turns
+                WHERE user_id = %s AND session_id = %s AND seq > %s
+                ORDER BY seq DESC LIMIT %s
+                """,
+                (user_id, session_id, after_seq, limit)
+            )
+            rows = cur.fetchall()
+    return [{'seq': seq, 'role': role, 'text': text, 'turn_id': turn_id} for seq, role, text, turn_id in reversed(rows)]
 
-def get_chat_history(user_id):
-    """Retrieves or creates a chat history for a user."""
-    conn = get_db_connection()
-    history = None
-    with conn.cursor() as cur:
-        cur.execute("SELECT chat_history FROM symptom_chats WHERE user_id = %s", (user_id,))
-        result = cur.fetchone()
-        if result:
-            history = result[0]
-        else:
-            # If no history exists, create a new entry
-            cur.execute("INSERT INTO symptom_chats (user_id, chat_history) VALUES (%s, %s)", (user_id, json.dumps([])))
-            history = []
-    conn.commit()
-    conn.close()
-    return history
-
-def save_chat_history(user_id, chat_history):
-    """Saves the updated chat history to the database."""
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        # Use json.dumps to convert the Python list to a JSON string for the DB
-        cur.execute(
-            "UPDATE symptom_chats SET chat_history = %s WHERE user_id = %s",
-            (json.dumps(chat_history), user_id)
-        )
-    conn.commit()
-    conn.close()
+def append_chat_turns(user_id, session_id, turns, turn_id=None):
+    """
+    Appends (role, text) turns to a session, numbering them after the session's current last
+    seq. Returns the seqs assigned, in order. With `turn_id`, turns already appended under
+    that id are kept instead, and their seqs returned.
+    """
+    values = ', '.join(['(%s, %s, %s)'] * len(turns))
+    params = [user_id, session_id, user_id, session_id, turn_id]
+    for position, (role, text) in enumerate(turns, 1):
+        params.extend([position, role, text])
+    params.extend([turn_id, user_id, session_id, turn_id])
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # Held until commit. The INSERT is a separate statement so that its snapshot, taken after
+            # the lock is granted, sees the turns of an append that was holding it.
+            cur.execute("SELECT 1 FROM symptom_chats WHERE user_id = %s FOR UPDATE", (user_id,))
+            cur.execute(
+                f"""
+                WITH last AS (
+                    SELECT COALESCE(MAX(seq), 0) AS seq FROM symptom_chat_turns
+                    WHERE user_id = %s AND session_id = %s
+                )
+                INSERT INTO symptom_chat_turns (user_id, session_id, seq, role, text, turn_id)
+                SELECT %s, %s, last.seq + v.position, v.role, v.text, %s
+                FROM last, (VALUES {values}) AS v(position, role, text)
+                WHERE %s IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM symptom_chat_turns WHERE user_id = %s AND session_id = %s AND turn_id = %s
+                )
+                RETURNING seq
+                """,
+                params
+            )
+            seqs = sorted(row[0] for row in cur.fetchall())
+            if not seqs and turn_id is not None:
+                cur.execute(
+                    "SELECT seq FROM symptom_chat_turns WHERE user_id = %s AND session_id = %s AND turn_id = %s ORDER BY seq",
+                    (user_id, session_id, turn_id)
+                )
+                seqs = [row[0] for row in cur.fetchall()]
+            return seqs
+
+def save_chat_summary(user_id, session_id, summary, summarized_upto):
+    """
+    Stores the summary of session `session_id`'s turns up to and including seq `summarized_upto`.
+    Does nothing if the user has since started a new session.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE symptom_chats SET summary = %s, summarized_upto = %s WHERE user_id = %s AND session_id = %s",
+                (summary, summarized_upto, user_id, session_id)
+            )
+
+def start_chat_session(user_id):
+    """Closes the current checker session; the next turn starts a fresh one with no summary."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE symptom_chats SET session_id = session_id + 1, summarized_upto = 0, summary = NULL WHERE user_id = %s",
+                (user_id,)
+            )
 
 # --- Outbreak Alert Functions ---
+# Table: user_alerts_seen (id INT, user_id INT, alert_id TEXT, alert_month DATE), partitioned by alert_month: the
+#        first day of the month the alert was published, so every row of an alert lands in the same partition.
+#        The unique index is on (user_id, alert_id, alert_month), which alone would let an alert be recorded
+#        both in the undated month (rows from before partitioning) and in its real one, so the inserts also
+#        skip pairs already recorded in any month. See retention.py.
+
+# alert_month of alerts without a publication date (and of rows from before partitioning).
+UNDATED_ALERT_MONTH = date(1970, 1, 1)
+
+def alert_month(published):
+    """Returns the partition key for an alert published at `published` (a Unix timestamp, or None)."""
+    if published is None:
+        return UNDATED_ALERT_MONTH
+    return datetime.fromtimestamp(published, timezone.utc).date().replace(day=1)
 
 def has_user_seen_alert(user_id, alert_id):
     """Checks if a user has already been shown a specific alert."""
-    conn = get_db_connection()
-    seen = False
-    with conn.cursor() as cur:
-        cur.execute("SELECT id FROM user_alerts_seen WHERE user_id = %s AND alert_id = %s", (user_id, alert_id))
-        if cur.fetchone():
-            seen = True
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM user_alerts_seen WHERE user_id = %s AND alert_id = %s", (user_id, alert_id))
+            return cur.fetchone() is not None
+
+def mark_alert_as_seen(user_id, alert_id, published=None):
+    """Records that a user has been shown a specific alert (published at `published`)."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO user_alerts_seen (user_id, alert_id, alert_month)
+                SELECT %s, %s, %s
+                WHERE NOT EXISTS (SELECT 1 FROM user_alerts_seen WHERE user_id = %s AND alert_id = %s)
+                ON CONFLICT DO NOTHING
+                """,
+                (user_id, alert_id, alert_month(published), user_id, alert_id)
+            )
+
+def get_seen_alert_ids(user_id, alert_ids=None):
+    """Returns the set of alert ids (optionally limited to `alert_ids`) a user has already seen."""
+    return get_seen_alert_ids_for_users([user_id], alert_ids).get(user_id, set())
+
+def get_seen_alert_ids_for_users(user_ids, alert_ids=None):
+    """Returns {user_id: set of seen alert ids} for a batch of users in a single query."""
+    if not user_ids:
+        return {}
+    query = "SELECT user_id, alert_id FROM user_alerts_seen WHERE user_id = ANY(%s)"
+    params = [list(user_ids)]
+    if alert_ids is not None:
+        query += " AND alert_id = ANY(%s)"
+        params.append(list(alert_ids))
+    seen = {}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            for user_id, alert_id in cur.fetchall():
+                seen.setdefault(user_id, set()).add(alert_id)
     return seen
 
-def mark_alert_as_seen(user_id, alert_id):
-    """Records that a user has been shown a specific alert."""
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute(
-            "INSERT INTO user_alerts_seen (user_id, alert_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-            (user_id, alert_id)
-        )
-    conn.commit()
-    conn.close()
+def mark_alerts_as_seen(pairs, published=None, page_size=1000):
+    """
+    Records many (user_id, alert_id) pairs as seen with multi-row INSERTs. The alerts are taken
+    to be published at `published` (callers mark one alert at a time).
+    """
+    if not pairs:
+        return
+    month = alert_month(published)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            extras.execute_values(
+                cur,
+                """
+                INSERT INTO user_alerts_seen (user_id, alert_id, alert_month)
+                SELECT v.user_id, v.alert_id, v.alert_month FROM (VALUES %s) AS v(user_id, alert_id, alert_month)
+                WHERE NOT EXISTS (SELECT 1 FROM user_alerts_seen s WHERE s.user_id = v.user_id AND s.alert_id = v.alert_id)
+                ON CONFLICT DO NOTHING
+                """,
+                [(user_id, alert_id, month) for user_id, alert_id in pairs],
+                page_size=page_size
+            )
+
+# --- Alert Translation Functions ---
+# Table: alert_translations (alert_id TEXT, lang TEXT, title TEXT, summary TEXT, PRIMARY KEY (alert_id, lang))
+
+def get_alert_translations(alert_ids):
+    """Returns {(alert_id, lang): (title, summary)} for every stored translation of the given alerts."""
+    if not alert_ids:
+        return {}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT alert_id, lang, title, summary FROM alert_translations WHERE alert_id = ANY(%s)",
+                (list(alert_ids),)
+            )
+            return {(alert_id, lang): (title, summary) for alert_id, lang, title, summary in cur.fetchall()}
+
+def save_alert_translation(alert_id, lang, title, summary):
+    """Stores (or replaces) the translation of an alert into one language."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO alert_translations (alert_id, lang, title, summary) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (alert_id, lang) DO UPDATE SET title = EXCLUDED.title, summary = EXCLUDED.summary
+                """,
+                (alert_id, lang, title, summary)
+            )
+
+# --- Outbreak Broadcast Functions ---
+# Table: broadcast_checkpoints (alert_id TEXT PRIMARY KEY, status TEXT, owner TEXT, last_user_id INT DEFAULT 0,
+#                               sent INT DEFAULT 0, failed INT DEFAULT 0, updated_at TIMESTAMPTZ DEFAULT now())
+# Indexes: users (state, id) and (district, id), both INCLUDE (mobile_number, language);
+#          user_alerts_seen holds one row per (user_id, alert_id), in whichever month partition it went to.
+
+def get_broadcast_targets(alert_id, after_id, limit, states=None, districts=None):
+    """
+    Returns up to `limit` (id, mobile_number, language) rows of users with id > `after_id` who
+    have not seen the alert, limited to users in any of `states` or `districts` when given.
+    Keyset pagination on users.id keeps every batch an index range scan.
+    """
+    query = """
+        SELECT u.id, u.mobile_number, u.language FROM users u
+        WHERE u.id > %s
+          AND NOT EXISTS (SELECT 1 FROM user_alerts_seen s WHERE s.user_id = u.id AND s.alert_id = %s)
+    """
+    params = [after_id, alert_id]
+    if states or districts:
+        query += " AND (u.state = ANY(%s) OR u.district = ANY(%s))"
+        params += [list(states or []), list(districts or [])]
+    query += " ORDER BY u.id LIMIT %s"
+    params.append(limit)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            return cur.fetchall()
+
+def claim_broadcast(alert_id, owner, lease_seconds):
+    """
+    Claims the broadcast of an alert for `owner`, or takes over one whose owner stopped
+    checkpointing `lease_seconds` ago. Returns the checkpoint dict, or None if someone else
+    holds it or it already finished.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO broadcast_checkpoints (alert_id, status, owner, updated_at) VALUES (%s, 'running', %s, now())
+                ON CONFLICT (alert_id) DO UPDATE SET owner = EXCLUDED.owner, updated_at = now()
+                WHERE broadcast_checkpoints.status = 'running'
+                  AND broadcast_checkpoints.updated_at < now() - make_interval(secs => %s)
+                RETURNING last_user_id, sent, failed
+                """,
+                (alert_id, owner, lease_seconds)
+            )
+            row = cur.fetchone()
+    if row is None:
+        return None
+    return {'last_user_id': row[0], 'sent': row[1], 'failed': row[2]}
+
+def save_broadcast_checkpoint(alert_id, owner, last_user_id, sent, failed, status='running'):
+    """Records broadcast progress; returns False if `owner` has lost the claim."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE broadcast_checkpoints
+                SET last_user_id = %s, sent = %s, failed = %s, status = %s, updated_at = now()
+                WHERE alert_id = %s AND owner = %s
+                """,
+                (last_user_id, sent, failed, status, alert_id, owner)
+            )
+            return cur.rowcount == 1
+
+# --- Vaccination Due-Date Functions ---
+# Table: vaccination_due (user_id INT REFERENCES users ON DELETE CASCADE, dose TEXT, due_on DATE,
+#                         reminded_at TIMESTAMPTZ, PRIMARY KEY (user_id, dose))
+# Index: vaccination_due (due_on, user_id) INCLUDE (dose) WHERE reminded_at IS NULL -- unsent reminders only.
+# Reminder runs take their claims and checkpoints from broadcast_checkpoints, as 'vaccination:<due date>'.
+
+def get_users_to_plan(after_id, limit):
+    """Returns up to `limit` (id, date_of_birth, age, age_recorded_on) rows of users with id > `after_id`."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, date_of_birth, age, age_recorded_on FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                (after_id, limit)
+            )
+            return cur.fetchall()
+
+def save_vaccination_due(rows, page_size=1000):
+    """Upserts (user_id, dose, due_on) rows. A dose that has already been reminded keeps its date."""
+    if not rows:
+        return
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            extras.execute_values(
+                cur,
+                """
+                INSERT INTO vaccination_due (user_id, dose, due_on) VALUES %s
+                ON CONFLICT (user_id, dose) DO UPDATE SET due_on = EXCLUDED.due_on
+                WHERE vaccination_due.reminded_at IS NULL AND vaccination_due.due_on <> EXCLUDED.due_on
+                """,
+                rows,
+                page_size=page_size
+            )
+
+def get_due_vaccinations(due_on, after_user_id, limit):
+    """
+    Returns up to `limit` (user_id, mobile_number, language, [doses]) rows, one per user with
+    user_id > `after_user_id` who has unsent reminders for doses due on `due_on`. Keyset
+    pagination over the partial (due_on, user_id) index keeps every batch an index range scan.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT d.user_id, u.mobile_number, u.language, array_agg(d.dose ORDER BY d.dose)
+                FROM vaccination_due d JOIN users u ON u.id = d.user_id
+                WHERE d.due_on = %s AND d.user_id > %s AND d.reminded_at IS NULL
+                GROUP BY d.user_id, u.mobile_number, u.language
+                ORDER BY d.user_id LIMIT %s
+                """,
+                (due_on, after_user_id, limit)
+            )
+            return cur.fetchall()
 
+def mark_vaccinations_reminded(due_on, user_ids):
+    """Records that the given users have been reminded of their doses due on `due_on`."""
+    if not user_ids:
+        return
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE vaccination_due SET reminded_at = now()
+                WHERE due_on = %s AND user_id = ANY(%s) AND reminded_at IS NULL
+                """,
+                (due_on, list(user_ids))
+            )
@@ -0,0 +1,263 @@
+"""
+Free-text district search for registration.
+
+Users can type a district's name instead of paging through the numbered list: in English, with
+typos ("kandhmal"), in Odia or Devanagari script ("କନ୍ଧମାଳ", "मयूरभंज"), or by an older or local
+name ("Keonjhar", "Baleswar"). Every name and alias is reduced to a romanised key. An exact key is
+found with one dict lookup; anything else is ranked by trigram overlap and edit distance, over an
+index built once per state at startup.
+
+    python district_search.py [--state Odisha] kandhmal କନ୍ଧମାଳ "mayur bhanj"
+"""
+import re
+import time
+import argparse
+import unicodedata
+from collections import Counter
+
+from cache import TTLCache
+from location_data import STATES_AND_DISTRICTS
+
+# Other names for districts: older or local English spellings, then the Odia and Hindi names.
+DISTRICT_ALIASES = {
+    "Angul": ["Anugul", "ଅନୁଗୁଳ", "ଅନୁଗୋଳ", "अंगुल"],
+    "Balangir": ["Bolangir", "ବଲାଙ୍ଗୀର", "बलांगीर"],
+    "Balasore": ["Baleswar", "Baleshwar", "ବାଲେଶ୍ୱର", "बालेश्वर", "बालासोर"],
+    "Bargarh": ["ବରଗଡ଼", "बरगढ़"],
+    "Bhadrak": ["ଭଦ୍ରକ", "भद्रक"],
+    "Boudh": ["Baudh", "Bauda", "ବୌଦ୍ଧ", "बौध"],
+    "Cuttack": ["Katak", "Kataka", "କଟକ", "कटक"],
+    "Deoghar": ["Deogarh", "Debagarh", "ଦେବଗଡ଼", "देवगढ़"],
+    "Dhenkanal": ["ଢେଙ୍କାନାଳ", "ढेंकानाल"],
+    "Gajapati": ["ଗଜପତି", "गजपति"],
+    "Ganjam": ["Berhampur", "ଗଞ୍ଜାମ", "गंजाम"],
+    "Jagatsinghpur": ["Jagatsinghapur", "ଜଗତସିଂହପୁର", "जगतसिंहपुर"],
+    "Jajpur": ["Jajapur", "ଯାଜପୁର", "जाजपुर"],
+    "Jharsuguda": ["ଝାରସୁଗୁଡ଼ା", "झारसुगुड़ा"],
+    "Kalahandi": ["Bhawanipatna", "କଳାହାଣ୍ଡି", "कालाहांडी"],
+    "Kandhamal": ["Phulbani", "କନ୍ଧମାଳ", "कंधमाल"],
+    "Kendrapara": ["Kendrapada", "କେନ୍ଦ୍ରାପଡ଼ା", "केंद्रपाड़ा"],
+    "Kendujhar": ["Keonjhar", "କେନ୍ଦୁଝର", "क्योंझर"],
+    "Khordha": ["Khurda", "Khurdha", "Bhubaneswar", "Bhubaneshwar", "ଖୋର୍ଦ୍ଧା", "ଭୁବନେଶ୍ୱର", "खोरधा", "भुवनेश्वर"],
+    "Koraput": ["କୋରାପୁଟ", "कोरापुट"],
+    "Malkangiri": ["ମାଲକାନଗିରି", "मलकानगिरी"],
+    "Mayurbhanj": ["Baripada", "ମୟୂରଭଞ୍ଜ", "मयूरभंज"],
+    "Nabarangpur": ["Nabarangapur", "Nowrangpur", "Nawarangpur", "ନବରଙ୍ଗପୁର", "नबरंगपुर"],
+    "Nayagarh": ["ନୟାଗଡ଼", "नयागढ़"],
+    "Nuapada": ["ନୂଆପଡ଼ା", "नुआपाड़ा"],
+    "Puri": ["ପୁରୀ", "पुरी"],
+    "Rayagada": ["ରାୟଗଡ଼ା", "रायगड़ा"],
+    "Sambalpur": ["ସମ୍ବଲପୁର", "संबलपुर"],
+    "Sonepur": ["Subarnapur", "Suvarnapur", "ସୁବର୍ଣ୍ଣପୁର", "ସୋନପୁର", "सोनपुर"],
+    "Sundargarh": ["Sundergarh", "Rourkela", "ସୁନ୍ଦରଗଡ଼", "सुंदरगढ़"],
+}
+
+# Words users add around the name ("Puri district", "ଜିଲ୍ଲା ପୁରୀ").
+FILLER_WORDS = {'district', 'dist', 'zilla', 'jilla', 'zila', 'jila', 'in', 'from', 'my', 'is', 'i', 'live', 'am'}
+
+# A match is taken without asking when it scores at least this and leads the next district by MARGIN.
+ACCEPT_SCORE = 0.75
+MARGIN = 0.1
+# Districts scoring at least this are offered as suggestions.
+SUGGEST_SCORE = 0.5
+# Typing at least MIN_PREFIX letters of a name counts as this similar to it.
+MIN_PREFIX = 4
+PREFIX_SIMILARITY = 0.9
+# District lists never change while running; cached answers only need evicting by size.
+RESOLVE_CACHE_TTL = 24 * 3600
+
+# --- Transliteration ---
+# Devanagari consonants and their romanisation; the Odia block mirrors Devanagari at +0x200.
+_CONSONANTS = {
+    'क': 'k', 'ख': 'kh', 'ग': 'g', 'घ': 'gh', 'ङ': 'n', 'च': 'ch', 'छ': 'chh', 'ज': 'j', 'झ': 'jh', 'ञ': 'n',
+    'ट': 't', 'ठ': 'th', 'ड': 'd', 'ढ': 'dh', 'ण': 'n', 'त': 't', 'थ': 'th', 'द': 'd', 'ध': 'dh', 'न': 'n',
+    'प': 'p', 'फ': 'ph', 'ब': 'b', 'भ': 'bh', 'म': 'm', 'य': 'y', 'र': 'r', 'ल': 'l', 'ळ': 'l', 'व': 'v',
+    'श': 'sh', 'ष': 'sh', 'स': 's', 'ह': 'h', 'य़': 'y',
+}
+_NUKTA_CONSONANTS = {'ड': 'r', 'ढ': 'rh', 'ज': 'z', 'फ': 'f', 'क': 'q', 'ग': 'g', 'ख': 'kh'}
+_VOWELS = {
+    'अ': 'a', 'आ': 'a', 'इ': 'i', 'ई': 'i', 'उ': 'u', 'ऊ': 'u', 'ऋ': 'ri', 'ए': 'e', 'ऐ': 'ai', 'ओ': 'o', 'औ': 'au',
+}
+_MATRAS = {
+    'ा': 'a', 'ि': 'i', 'ी': 'i', 'ु': 'u', 'ू': 'u', 'ृ': 'ri', 'े': 'e', 'ै': 'ai', 'ो': 'o', 'ौ': 'au',
+}
+_SIGNS = {'ं': 'n', 'ँ': 'n', 'ः': 'h'}
+_VIRAMA = '्'
+_NUKTA = '़'
+_ODIA_SPECIAL = {'ୟ': 'य़', 'ୱ': 'व', 'ୖ': '', 'ୗ': ''}   # ya, wa and length marks with no Devanagari twin
+
+
+def _to_devanagari(ch):
+    code = ord(ch)
+    if ch in _ODIA_SPECIAL:
+        return _ODIA_SPECIAL[ch]
+    if 0x0B00 <= code <= 0x0B7F:
+        return chr(code - 0x200)
+    return ch
+
+def transliterate(text):
+    """Romanises Odia and Devanagari text roughly as district names are spelt in English."""
+    chars = [_to_devanagari(ch) for ch in unicodedata.normalize('NFC', text)]
+    chars = list(''.join(chars))
+    out = []
+    i, n = 0, len(chars)
+    while i < n:
+        ch = chars[i]
+        if ch in _CONSONANTS:
+            roman = _CONSONANTS[ch]
+            if i + 1 < n and chars[i + 1] == _NUKTA:
+                roman = _NUKTA_CONSONANTS.get(ch, roman)
+                i += 1
+            nxt = chars[i + 1] if i + 1 < n else ''
+            if nxt == _VIRAMA:
+                out.append(roman)
+                i += 2
+                continue
+            if nxt in _MATRAS:
+                out.append(roman + _MATRAS[nxt])
+                i += 2
+                continue
+            # Inherent vowel, dropped at the end of a word as in the English spellings.
+            at_end = not nxt or not ('ऀ' <= nxt <= 'ॿ')
+            out.append(roman if at_end else roman + 'a')
+        elif ch in _VOWELS:
+            out.append(_VOWELS[ch])
+        elif ch in _SIGNS:
+            out.append(_SIGNS[ch])
+        elif ch in (_VIRAMA, _NUKTA):
+            pass
+        else:
+            out.append(ch)
+        i += 1
+    return ''.join(out)
+
+def normalize(text):
+    """The romanised search key: lower-case letters and digits, filler words dropped, runs collapsed."""
+    text = transliterate(text).lower()
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    words = [word for word in re.split(r'[^a-z0-9]+', text) if word and word not in FILLER_WORDS]
+    key = ''.join(words)
+    key = key.replace('ee', 'i').replace('oo', 'u').replace('w', 'v')
+    return re.sub(r'(.)\1+', r'\1', key)
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b):
+    """Levenshtein distance between two short strings."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        left = i
+        for j, cb in enumerate(b):
+            cost = previous[j] if ca == cb else previous[j] + 1
+            if previous[j + 1] + 1 < cost:
+                cost = previous[j + 1] + 1
+            if left + 1 < cost:
+                cost = left + 1
+            current.append(cost)
+            left = cost
+        previous = current
+    return previous[-1]
+
+
+# --- Index ---
+class DistrictIndex:
+    """Search keys for one state's districts: an exact-key dict plus a trigram inverted index."""
+
+    def __init__(self, districts, aliases=DISTRICT_ALIASES, candidates=4, cache_size=4096):
+        self.districts = list(districts)
+        self.candidates = candidates
+        # Typed text -> resolve() result; the same typos come up again and again.
+        self._resolved = TTLCache(maxsize=cache_size, ttl=RESOLVE_CACHE_TTL)
+        self.exact = {}         # key -> district
+        self.keys = []          # (key, district, trigram count)
+        self.postings = {}      # trigram -> [positions in self.keys]
+        for district in self.districts:
+            for name in [district, *aliases.get(district, ())]:
+                key = normalize(name)
+                if not key or key in self.exact:
+                    continue
+                self.exact[key] = district
+                grams = trigrams(key)
+                for gram in grams:
+                    self.postings.setdefault(gram, []).append(len(self.keys))
+                self.keys.append((key, district, len(grams)))
+
+    def search(self, text, limit=3):
+        """Returns up to `limit` (district, score) pairs, best first; a score of 1.0 is an exact match."""
+        key = normalize(text)
+        if not key:
+            return []
+        district = self.exact.get(key)
+        if district is not None:
+            return [(district, 1.0)]
+        grams = trigrams(key)
+        hits = Counter()
+        for gram in grams:
+            for position in self.postings.get(gram, ()):
+                hits[position] += 1
+        # Edit distance is only worth computing for the keys sharing the most trigrams.
+        ranked = sorted(
+            ((2 * shared / (len(grams) + self.keys[position][2]), position) for position, shared in hits.items()),
+            reverse=True,
+        )[:self.candidates]
+        best = {}
+        for dice, position in ranked:
+            candidate, district, _ = self.keys[position]
+            similarity = 1 - edit_distance(key, candidate) / max(len(key), len(candidate))
+            if len(key) >= MIN_PREFIX and candidate.startswith(key):
+                similarity = max(similarity, PREFIX_SIMILARITY)     # the start of a name, e.g. "sambal"
+            score = round((dice + 2 * similarity) / 3, 3)
+            if score > best.get(district, 0):
+                best[district] = score
+        return sorted(best.items(), key=lambda item: -item[1])[:limit]
+
+    def resolve(self, text):
+        """Returns (district, suggestions): a confident match, or else the districts worth offering."""
+        result = self._resolved.get(text)
+        if result is None:
+            result = self._resolve(text)
+            self._resolved.set(text, result)
+        return result
+
+    def _resolve(self, text):
+        matches = self.search(text)
+        if not matches:
+            return None, []
+        district, score = matches[0]
+        runner_up = matches[1][1] if len(matches) > 1 else 0
+        if score >= ACCEPT_SCORE and score - runner_up >= MARGIN:
+            return district, []
+        return None, [name for name, match_score in matches if match_score >= SUGGEST_SCORE]
+
+
+def build_district_search(states_and_districts=STATES_AND_DISTRICTS):
+    """Builds a DistrictIndex per state."""
+    return {state: DistrictIndex(districts) for state, districts in states_and_districts.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries', nargs='+')
+    parser.add_argument('--state', default='Odisha')
+    parser.add_argument('--iterations', type=int, default=10000, help="repeat lookups per query for the timing")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    index = build_district_search()[args.state]
+    print(f"Built indexes in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for query in args.queries:
+        start = time.perf_counter()
+        result = index.resolve(query)
+        first = (time.perf_counter() - start) * 1e6
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            index.resolve(query)
+        repeat = (time.perf_counter() - start) / args.iterations * 1e6
+        print(f"{query!r:>24} -> key {normalize(query)!r}: {result}  (first {first:.1f} µs, cached {repeat:.1f} µs)")
+
+if __name__ == "__main__":
+    main()
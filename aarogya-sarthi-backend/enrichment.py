@@ -0,0 +1,126 @@
+"""
+Concurrent, deadline-bounded enrichments for the start of a session.
+
+When a registered user opens a session, extra messages (a new outbreak alert, a preventive tip)
+are shown before the menu. run_enrichments() runs them at the same time on a small shared thread
+pool and waits at most ENRICHMENT_DEADLINE_MS for them. One that misses the deadline does not hold
+up the menu: it keeps running, and its message is handed to `on_late` so it can be shown on the
+user's next turn instead.
+"""
+import os
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from dotenv import load_dotenv
+
+from metrics import stage_timer
+
+load_dotenv()
+
+# --- Enrichment Configuration ---
+ENRICHMENT_DEADLINE_MS = float(os.environ.get("ENRICHMENT_DEADLINE_MS", 800))
+ENRICHMENT_WORKERS = int(os.environ.get("ENRICHMENT_WORKERS", 8))
+# With this many enrichments per worker already waiting, new ones are shed instead of queued.
+ENRICHMENT_MAX_BACKLOG = int(os.environ.get("ENRICHMENT_MAX_BACKLOG", 4))
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+_pending = 0
+_stats = {}     # name -> {'on_time', 'late', 'shed', 'failed'}
+
+
+def _get_executor():
+    """Returns the process-wide pool, creating it lazily (and again after a fork)."""
+    global _executor, _executor_pid, _pending
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS, thread_name_prefix='enrichment')
+            _executor_pid = os.getpid()
+            _pending = 0
+        return _executor
+
+def _count(name, outcome):
+    with _lock:
+        counts = _stats.setdefault(name, {'on_time': 0, 'late': 0, 'shed': 0, 'failed': 0})
+        counts[outcome] += 1
+
+def get_enrichment_stats():
+    """Returns {enrichment: {'on_time', 'late', 'shed', 'failed'}} counts since start."""
+    with _lock:
+        return {name: dict(counts) for name, counts in _stats.items()}
+
+
+def _run(name, fn):
+    global _pending
+    try:
+        with stage_timer(f"enrichment.{name}"):
+            return fn()
+    finally:
+        with _lock:
+            _pending -= 1
+
+def _submit(name, fn):
+    """Queues fn on the pool, keeping the request's metrics context; None if the pool is backed up."""
+    global _pending
+    executor = _get_executor()
+    with _lock:
+        if _pending >= ENRICHMENT_WORKERS * (1 + ENRICHMENT_MAX_BACKLOG):
+            return None
+        _pending += 1
+    context = contextvars.copy_context()
+    return executor.submit(context.run, _run, name, fn)
+
+def _deliver_late(name, on_late):
+    def deliver(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            _count(name, 'failed')
+            logging.error(f"Enrichment '{name}' failed after its deadline: {e}")
+            return
+        if result and on_late is not None:
+            try:
+                on_late(name, result)
+            except Exception as e:
+                logging.error(f"Could not defer the result of enrichment '{name}': {e}")
+
+    def done(future):
+        # Always on the pool: a future that finished just after the deadline check runs this at once, in
+        # the request thread, which still holds the number's conversation lock that on_late may need.
+        _get_executor().submit(deliver, future)
+    return done
+
+def run_enrichments(tasks, deadline_ms=ENRICHMENT_DEADLINE_MS, on_late=None):
+    """
+    Runs each (name, fn) in `tasks` concurrently and returns the non-empty results that were
+    ready within `deadline_ms`, in task order. Late results are passed to on_late(name, result).
+    """
+    futures = []
+    for name, fn in tasks:
+        future = _submit(name, fn)
+        if future is None:
+            _count(name, 'shed')
+        else:
+            futures.append((name, future))
+    if not futures:
+        return []
+    wait([future for _, future in futures], timeout=deadline_ms / 1000)
+
+    results = []
+    for name, future in futures:
+        if not future.done():
+            _count(name, 'late')
+            future.add_done_callback(_deliver_late(name, on_late))
+            continue
+        try:
+            result = future.result()
+        except Exception as e:
+            _count(name, 'failed')
+            logging.error(f"Enrichment '{name}' failed: {e}")
+            continue
+        _count(name, 'on_time')
+        if result:
+            results.append(result)
+    return results
@@ -1,46 +1,401 @@
 import os
+import json
+import time
+import random
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+from rate_limit import TokenBucket
+from metrics import stage_timer, timed, observe_stage
+
 load_dotenv()
 
 # --- Gemini AI Configuration ---
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     logging.warning("GEMINI_API_KEY not found in .env file. AI features will fail.")
-    
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={GEMINI_API_KEY}"
 
-def get_gemini_response(chat_history, system_prompt):
+# Point GEMINI_API_BASE at a local stub server to test without the real API.
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash-preview-05-20")
+GEMINI_API_URL = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent"
+GEMINI_STREAM_URL = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse"
+# Stream symptom-checker replies and send them in segments as they are generated (see streaming.py).
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "").lower() in ('1', 'true', 'yes')
+
+# Per-attempt timeout, and the overall budget across retries (for a streamed reply, to its last piece).
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", 20))
+GEMINI_DEADLINE = float(os.environ.get("GEMINI_DEADLINE", 30))
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", 2))
+# Backpressure: calls in flight at once, calls started per second, and how long to queue for either.
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 8))
+GEMINI_MAX_QPS = float(os.environ.get("GEMINI_MAX_QPS", 10))
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get("GEMINI_QUEUE_TIMEOUT", 5))
+# The breaker opens after this many consecutive failed calls and stays open for the cooldown.
+GEMINI_BREAKER_THRESHOLD = int(os.environ.get("GEMINI_BREAKER_THRESHOLD", 5))
+GEMINI_BREAKER_COOLDOWN = float(os.environ.get("GEMINI_BREAKER_COOLDOWN", 30))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+FALLBACK_MESSAGES = {
+    'disabled': {
+        'en': "AI functionality is disabled. Missing API Key.",
+    },
+    'unavailable': {
+        'en': "Sorry, I'm having trouble connecting to my AI brain right now. Please try again later.",
+        'hi': "क्षमा करें, मुझे अभी अपनी AI सेवा से जुड़ने में समस्या हो रही है। कृपया बाद में पुनः प्रयास करें।",
+        'od': "କ୍ଷମା କରନ୍ତୁ, ମୁଁ ବର୍ତ୍ତମାନ ମୋର AI ସେବା ସହ ଯୋଗାଯୋଗ କରିପାରୁନାହିଁ। ଦୟାକରି ପରେ ପୁଣି ଚେଷ୍ଟା କରନ୍ତୁ।",
+        'kui': "ମାଫ୍ କରବେ, ଏବେ AI ସେବା ସାଙ୍ଗେ ଯୋଗାଯୋଗ୍ ହେଉନି। ଦୟାକରି ପଛେ ଫେର୍ ଚେଷ୍ଟା କରନ୍ତୁ।",
+        'sa': "ᱤᱠᱟᱹ ᱠᱟᱹᱧ ᱢᱮ, ᱱᱤᱛᱚᱜ AI ᱥᱮᱣᱟ ᱥᱟᱶ ᱡᱚᱲᱟᱣ ᱵᱟᱝ ᱦᱩᱭ ᱫᱟᱲᱮᱭᱟᱜ ᱠᱟᱱᱟ᱾ ᱫᱟᱭᱟᱠᱟᱛᱮ ᱛᱟᱭᱚᱢ ᱛᱮ ᱟᱨᱦᱚᱸ ᱠᱩᱨᱩᱢᱩᱴᱩᱭ ᱢᱮ᱾",
+    },
+    'busy': {
+        'en': "I'm helping a lot of people right now. Please try again in a minute.",
+        'hi': "मैं अभी बहुत से लोगों की मदद कर रहा हूँ। कृपया एक मिनट बाद पुनः प्रयास करें।",
+        'od': "ମୁଁ ବର୍ତ୍ତମାନ ଅନେକ ଲୋକଙ୍କୁ ସାହାଯ୍ୟ କରୁଛି। ଦୟାକରି ଏକ ମିନିଟ୍ ପରେ ପୁଣି ଚେଷ୍ଟା କରନ୍ତୁ।",
+        'kui': "ଏବେ ବହୁତ୍ ଲୋକଙ୍କୁ ସାହାଯ୍ୟ କରୁଛେ। ଦୟାକରି ଗୁଟେ ମିନିଟ୍ ପଛେ ଫେର୍ ଚେଷ୍ଟା କରନ୍ତୁ।",
+        'sa': "ᱱᱤᱛᱚᱜ ᱤᱧ ᱟᱹᱰᱤ ᱦᱚᱲ ᱜᱚᱲᱚ ᱮᱫᱟᱢ᱾ ᱫᱟᱭᱟᱠᱟᱛᱮ ᱢᱤᱫ ᱢᱤᱱᱤᱴ ᱛᱟᱭᱚᱢ ᱛᱮ ᱟᱨᱦᱚᱸ ᱠᱩᱨᱩᱢᱩᱴᱩᱭ ᱢᱮ᱾",
+    },
+    'blocked': {
+        'en': "I'm sorry, I can't respond to that topic. Let's talk about something else.",
+    },
+    'bad_response': {
+        'en': "Sorry, I received an unusual response from the AI. Please try again.",
+    },
+}
+
+
+class GeminiError(Exception):
+    """Base class for Gemini failures; `reason` selects the fallback message."""
+    reason = 'unavailable'
+
+class GeminiUnavailable(GeminiError):
+    reason = 'unavailable'
+
+class GeminiBusy(GeminiError):
+    reason = 'busy'
+
+class GeminiBlocked(GeminiError):
+    reason = 'blocked'
+
+class GeminiBadResponse(GeminiError):
+    reason = 'bad_response'
+
+class GeminiRejected(GeminiBadResponse):
+    """Gemini answered with a non-retryable 4xx: the request is at fault, not Gemini's health."""
+
+
+class CircuitBreaker:
     """
-    Sends a chat history and a specific system prompt to Gemini and gets the response.
+    Opens after `threshold` consecutive failures, fails fast for `cooldown` seconds, then lets
+    a single trial call through (half-open) to decide whether to close again.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self.opened_at < self.cooldown else 'half_open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release_trial(self):
+        """Gives back a half-open trial slot that ended without reaching Gemini."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class GeminiClient:
+    """
+    Gemini generateContent (and streamGenerateContent) client with a pooled keep-alive session,
+    jittered retries on retryable errors, a circuit breaker, and concurrency/QPS limits.
     """
-    if not GEMINI_API_KEY:
-         return "AI functionality is disabled. Missing API Key."
 
-    payload = {
-        "contents": chat_history,
-        "systemInstruction": {
-            "parts": [{"text": system_prompt}]
+    def __init__(self, api_key=GEMINI_API_KEY, url=GEMINI_API_URL, stream_url=GEMINI_STREAM_URL, timeout=GEMINI_TIMEOUT,
+                 deadline=GEMINI_DEADLINE, max_retries=GEMINI_MAX_RETRIES,
+                 max_concurrency=GEMINI_MAX_CONCURRENCY, max_qps=GEMINI_MAX_QPS,
+                 queue_timeout=GEMINI_QUEUE_TIMEOUT, breaker_threshold=GEMINI_BREAKER_THRESHOLD,
+                 breaker_cooldown=GEMINI_BREAKER_COOLDOWN):
+        self.api_key = api_key
+        self.url = url
+        self.stream_url = stream_url
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+        self.session.headers['x-goog-api-key'] = api_key or ''
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._bucket = TokenBucket(max_qps)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'attempts': 0, 'retries': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        self._outcomes = {}
+
+    def _record(self, outcome, latency=None):
+        with self._stats_lock:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+            if latency is not None:
+                self._stats['latency_total'] += latency
+                self._stats['latency_max'] = max(self._stats['latency_max'], latency)
+
+    def stats(self):
+        """Returns call/retry counters, latency totals, outcome counts and the breaker state."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats['outcomes'] = dict(self._outcomes)
+        stats['breaker'] = self.breaker.state
+        return stats
+
+    def _admit(self):
+        """Waits for a concurrency slot and the breaker's go-ahead; returns the start time. Raises GeminiError."""
+        if not self.api_key:
+            raise GeminiUnavailable("Missing API key")
+        with self._stats_lock:
+            self._stats['calls'] += 1
+        if self.breaker.state == 'open':
+            self._record('circuit_open')
+            raise GeminiUnavailable("Circuit breaker is open")
+
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._record('overloaded')
+            raise GeminiBusy("Too many Gemini calls in flight")
+        if not self.breaker.allow():
+            self._slots.release()
+            self._record('circuit_open')
+            raise GeminiUnavailable("Circuit breaker is open")
+        if not self._bucket.acquire(timeout=self.queue_timeout):
+            self._slots.release()
+            self.breaker.release_trial()
+            self._record('rate_limited')
+            raise GeminiBusy("Gemini QPS limit reached")
+        return start
+
+    def _finish(self, start, error=None):
+        """Releases the call's slot and records its outcome with the breaker."""
+        self._slots.release()
+        if error is None:
+            self.breaker.record_success()
+            self._record('ok', time.monotonic() - start)
+        elif isinstance(error, (GeminiBlocked, GeminiRejected)):
+            # Gemini answered; only the request was refused.
+            self.breaker.record_success()
+            self._record('blocked' if isinstance(error, GeminiBlocked) else 'rejected', time.monotonic() - start)
+        else:
+            self.breaker.record_failure()
+            self._record(error.reason, time.monotonic() - start)
+
+    @timed('gemini')
+    def generate(self, contents, system_prompt):
+        """Returns the model's text, or raises a GeminiError subclass."""
+        start = self._admit()
+        try:
+            with self._post_with_retries(self.url, self._payload(contents, system_prompt), start) as response:
+                text = self._parse(response)
+        except GeminiError as e:
+            self._finish(start, e)
+            raise
+        except BaseException:
+            self._slots.release()
+            self.breaker.release_trial()
+            raise
+        self._finish(start)
+        return text
+
+    def generate_stream(self, contents, system_prompt):
+        """
+        Yields the model's text in pieces as streamGenerateContent produces them, or raises a
+        GeminiError subclass. Only getting the stream started is retried: once text has been
+        yielded, a broken stream, or one still going at the deadline, raises GeminiUnavailable.
+        """
+        start = self._admit()
+        first = True
+        try:
+            with stage_timer('gemini.stream'):
+                response = self._post_with_retries(self.stream_url, self._payload(contents, system_prompt), start, stream=True)
+                with response:
+                    for text in self._parse_stream(response):
+                        if time.monotonic() - start > self.deadline:
+                            raise GeminiUnavailable(f"Gemini stream still going after {self.deadline:g}s")
+                        if first:
+                            observe_stage('gemini.first_token', time.monotonic() - start)
+                            first = False
+                        yield text
+        except GeminiError as e:
+            self._finish(start, e)
+            raise
+        except BaseException:
+            # Includes GeneratorExit, when the caller stops reading early.
+            self._slots.release()
+            self.breaker.release_trial()
+            raise
+        self._finish(start)
+
+    def _payload(self, contents, system_prompt):
+        return {
+            "contents": contents,
+            "systemInstruction": {
+                "parts": [{"text": system_prompt}]
+            }
         }
-    }
+
+    def _post_with_retries(self, url, payload, start, stream=False):
+        """
+        POSTs until Gemini answers with a non-retryable status; returns that (successful) response,
+        which the caller closes. A 4xx raises GeminiRejected.
+        """
+        attempt = 0
+        while True:
+            remaining = self.deadline - (time.monotonic() - start)
+            with self._stats_lock:
+                self._stats['attempts'] += 1
+            retry_after = None
+            response = None
+            try:
+                with stage_timer('gemini.http') as timer:
+                    response = self.session.post(url, json=payload, timeout=min(self.timeout, max(remaining, 1)), stream=stream)
+                    timer.outcome = str(response.status_code)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()
+                    result, response = response, None
+                    return result
+                error = GeminiUnavailable(f"Gemini returned HTTP {response.status_code}")
+                retry_after = response.headers.get('Retry-After')
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = GeminiUnavailable(f"Gemini API request failed: {e}")
+            except requests.exceptions.RequestException as e:
+                # Other 4xx errors will not get better by retrying.
+                logging.error(f"Gemini API request failed: {e}")
+                if e.response is not None and 400 <= e.response.status_code < 500:
+                    raise GeminiRejected(str(e))
+                raise GeminiUnavailable(str(e))
+            finally:
+                # Every response but the one returned, including a streamed one that was never read.
+                if response is not None:
+                    response.close()
+
+            backoff = min(0.5 * 2 ** attempt, 8) * random.uniform(0.5, 1.5)
+            if retry_after and retry_after.isdigit():
+                backoff = max(backoff, float(retry_after))
+            elapsed = time.monotonic() - start
+            if attempt >= self.max_retries or elapsed + backoff >= self.deadline:
+                logging.error(f"{error} (giving up after {attempt + 1} attempts)")
+                raise error
+            attempt += 1
+            with self._stats_lock:
+                self._stats['retries'] += 1
+            time.sleep(backoff)
+
+    def _parse_stream(self, response):
+        """Yields the text of each server-sent event of a streamGenerateContent response."""
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                result = json.loads(line[5:])
+                if result.get('promptFeedback', {}).get('blockReason'):
+                    logging.error(f"Gemini prompt blocked. Reason: {result['promptFeedback']['blockReason']}")
+                    raise GeminiBlocked(result['promptFeedback']['blockReason'])
+                candidates = result.get('candidates') or [{}]
+                text = ''.join(part.get('text', '') for part in candidates[0].get('content', {}).get('parts', []))
+                if text:
+                    yield text
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            raise GeminiUnavailable(f"Gemini stream broke off: {e}")
+        except (ValueError, AttributeError, IndexError) as e:
+            logging.error(f"Error parsing Gemini stream: {e}")
+            raise GeminiBadResponse(str(e))
+
+    def _parse(self, response):
+        try:
+            result = response.json()
+            # Check for safety ratings and blocked content
+            if result.get('promptFeedback', {}).get('blockReason'):
+                logging.error(f"Gemini prompt blocked. Reason: {result['promptFeedback']['blockReason']}")
+                raise GeminiBlocked(result['promptFeedback']['blockReason'])
+            return result['candidates'][0]['content']['parts'][0]['text']
+        except (ValueError, KeyError, IndexError) as e:
+            logging.error(f"Error parsing Gemini response: {e} - Response: {response.text}")
+            raise GeminiBadResponse(str(e))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_gemini_client():
+    """Returns the process-wide Gemini client."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GeminiClient()
+        return _client
+
+def fallback_message(reason, lang='en'):
+    messages = FALLBACK_MESSAGES[reason]
+    return messages.get(lang, messages['en'])
+
+def get_gemini_response(chat_history, system_prompt, lang='en'):
+    """
+    Sends a chat history and a specific system prompt to Gemini and gets the response.
+    On failure returns a message for the user in `lang` instead of raising.
+    """
+    if not GEMINI_API_KEY:
+        return fallback_message('disabled', lang)
     try:
-        response = requests.post(GEMINI_API_URL, json=payload, timeout=20)
-        response.raise_for_status()
-        result = response.json()
-        
-        # Check for safety ratings and blocked content
-        if 'promptFeedback' in result and result['promptFeedback']['blockReason']:
-            logging.error(f"Gemini prompt blocked. Reason: {result['promptFeedback']['blockReason']}")
-            return "I'm sorry, I can't respond to that topic. Let's talk about something else."
-
-        return result['candidates'][0]['content']['parts'][0]['text']
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Gemini API request failed: {e}")
-        return "Sorry, I'm having trouble connecting to my AI brain right now. Please try again later."
-    except (KeyError, IndexError) as e:
-        logging.error(f"Error parsing Gemini response: {e} - Response: {response.text}")
-        return "Sorry, I received an unusual response from the AI. Please try again."
+        return get_gemini_client().generate(chat_history, system_prompt)
+    except GeminiError as e:
+        return fallback_message(e.reason, lang)
 
+def stream_gemini_response(chat_history, system_prompt, lang='en'):
+    """
+    Streaming form of get_gemini_response: yields the reply in pieces as it is generated. A
+    failure before any text yields the fallback message; one part-way through ends the reply there.
+    """
+    if not GEMINI_API_KEY:
+        yield fallback_message('disabled', lang)
+        return
+    started = False
+    try:
+        for text in get_gemini_client().generate_stream(chat_history, system_prompt):
+            started = True
+            yield text
+    except GeminiError as e:
+        if not started:
+            yield fallback_message(e.reason, lang)
+        else:
+            logging.error(f"Gemini stream ended early, keeping the partial reply: {e}")
@@ -0,0 +1,222 @@
+"""
+Idempotent webhook processing keyed by Twilio's MessageSid.
+
+Twilio retries a webhook whose response is slow. A retry must not run the handler again (another
+Gemini call, another chat turn, a second reply), so the TwiML produced for a MessageSid is kept
+for IDEMPOTENCY_TTL seconds and served again to any retry. A retry that arrives while the original
+is still running waits for it and shares its response.
+
+Responses are cached in a per-process LRU in front of a shared backend: with the 'sqlite' backend
+a retry landing on another worker process is answered from the same WAL-mode SQLite file, and the
+first request's claim on the MessageSid makes that worker wait for the original instead of
+re-running it.
+"""
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from dotenv import load_dotenv
+
+from cache import TTLCache, SingleFlight, FlightTimeout
+from metrics import stage_timer
+
+load_dotenv()
+
+# --- Idempotency Configuration ---
+# 'memory' covers retries reaching the same worker; 'sqlite' shares responses between all workers on the host.
+IDEMPOTENCY_BACKEND = os.environ.get("IDEMPOTENCY_BACKEND", os.environ.get("STATE_STORE_BACKEND", "memory"))
+IDEMPOTENCY_PATH = os.environ.get("IDEMPOTENCY_PATH", "idempotency.db")
+# How long a response is replayed for; Twilio gives up retrying well within this.
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 15 * 60))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+# Longest a retry waits for the original request to finish before answering with an empty reply.
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", 14))
+# A claim whose worker died is taken over after this many seconds.
+IDEMPOTENCY_LEASE = float(os.environ.get("IDEMPOTENCY_LEASE", 60))
+
+# Returned by run() for a retry whose original is still running when IDEMPOTENCY_WAIT runs out.
+STILL_RUNNING = None
+
+
+class IdempotencyCache:
+    """
+    Runs `fn` at most once per key within the TTL and replays its (bytes) result.
+    This base class only de-duplicates within the process; subclasses add a shared backend.
+    """
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, maxsize=IDEMPOTENCY_CACHE_SIZE, wait=IDEMPOTENCY_WAIT):
+        self.ttl = ttl
+        self.wait = wait
+        self._responses = TTLCache(maxsize, ttl)
+        self._flights = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self._stats = {'executed': 0, 'replayed': 0, 'joined': 0, 'timed_out': 0}
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, cached=len(self._responses))
+
+    def run(self, key, fn):
+        """Returns fn()'s response for `key`, running fn only if no copy is cached or in flight."""
+        if not key:
+            return fn()
+        response = self._responses.get(key)
+        if response is not None:
+            self._count('replayed')
+            return response
+        try:
+            if self._flights.in_flight(key):
+                self._count('joined')
+                with stage_timer('idempotency.wait'):
+                    return self._flights.do(key, lambda: self._run_once(key, fn), timeout=self.wait)
+            return self._flights.do(key, lambda: self._run_once(key, fn), timeout=self.wait)
+        except FlightTimeout:
+            # The original is still running in this process; it stores its response when done.
+            self._count('timed_out')
+            return STILL_RUNNING
+
+    def _run_once(self, key, fn):
+        # The flight for this key may have finished just before ours started.
+        response = self._responses.get(key)
+        if response is None:
+            response = self._load(key)
+        if response is not None:
+            self._count('replayed')
+            self._responses.set(key, response)
+            return response
+        deadline = time.monotonic() + self.wait
+        while not self._claim(key):
+            # Another worker is running the original request.
+            with stage_timer('idempotency.wait'):
+                response = self._await(key, deadline)
+            if response is not None:
+                self._count('joined')
+                self._responses.set(key, response)
+                return response
+            if time.monotonic() >= deadline:
+                self._count('timed_out')
+                return STILL_RUNNING
+        try:
+            response = fn()
+        except BaseException:
+            self._release(key)
+            raise
+        self._count('executed')
+        self._responses.set(key, response)
+        self._store(key, response)
+        return response
+
+    # --- Shared backend (no-ops within a single process) ---
+    def _load(self, key):
+        return None
+
+    def _claim(self, key):
+        return True
+
+    def _await(self, key, deadline):
+        return None
+
+    def _store(self, key, response):
+        pass
+
+    def _release(self, key):
+        pass
+
+
+class SQLiteIdempotencyCache(IdempotencyCache):
+    """Shares claims and responses between worker processes through a WAL-mode SQLite file."""
+
+    def __init__(self, path=IDEMPOTENCY_PATH, lease=IDEMPOTENCY_LEASE, poll_interval=0.05, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._owner = uuid.uuid4().hex
+        self._local = threading.local()
+        self._last_purge = 0.0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        # response is NULL while the request is being handled; expires_at is then the claim's lease.
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_responses ("
+            "message_sid TEXT PRIMARY KEY, owner TEXT NOT NULL, response BLOB, expires_at REAL NOT NULL)"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _load(self, key):
+        row = self._conn().execute(
+            "SELECT response FROM webhook_responses WHERE message_sid = ? AND response IS NOT NULL AND expires_at > ?",
+            (key, time.time())
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def _claim(self, key):
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO webhook_responses (message_sid, owner, response, expires_at) VALUES (?, ?, NULL, ?) "
+            "ON CONFLICT(message_sid) DO UPDATE SET owner = excluded.owner, response = NULL, expires_at = excluded.expires_at "
+            "WHERE webhook_responses.expires_at <= ?",
+            (key, self._owner, now + self.lease, now)
+        )
+        return cur.rowcount == 1
+
+    def _await(self, key, deadline):
+        """Polls until the other worker stores its response, gives up its claim, or the deadline passes."""
+        while time.monotonic() < deadline:
+            row = self._conn().execute(
+                "SELECT response FROM webhook_responses WHERE message_sid = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            if row is None:
+                return None         # released (or its lease ran out): the caller claims it afresh
+            if row[0] is not None:
+                return bytes(row[0])
+            time.sleep(self.poll_interval)
+        return None
+
+    def _store(self, key, response):
+        try:
+            self._conn().execute(
+                "UPDATE webhook_responses SET response = ?, expires_at = ? WHERE message_sid = ? AND owner = ?",
+                (response, time.time() + self.ttl, key, self._owner)
+            )
+            self._purge_expired()
+        except sqlite3.Error as e:
+            logging.error(f"Could not store webhook response for {key}: {e}")
+
+    def _release(self, key):
+        try:
+            self._conn().execute(
+                "DELETE FROM webhook_responses WHERE message_sid = ? AND owner = ? AND response IS NULL", (key, self._owner)
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Could not release webhook claim for {key}: {e}")
+
+    def _purge_expired(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        self._conn().execute("DELETE FROM webhook_responses WHERE expires_at <= ?", (now,))
+
+
+def create_idempotency_cache():
+    """Builds the cache selected by IDEMPOTENCY_BACKEND."""
+    if IDEMPOTENCY_BACKEND == 'sqlite':
+        return SQLiteIdempotencyCache()
+    if IDEMPOTENCY_BACKEND != 'memory':
+        logging.warning(f"Unknown IDEMPOTENCY_BACKEND '{IDEMPOTENCY_BACKEND}', falling back to memory.")
+    return IdempotencyCache()
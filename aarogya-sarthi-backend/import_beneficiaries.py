@@ -0,0 +1,252 @@
+"""
+Bulk pre-registration of beneficiaries from an ASHA worker's CSV roster.
+
+The file needs a header row with the columns mobile, name, age, gender, district and language
+(plus state, if the roster spans several states, and date_of_birth where it is known). It is read as a stream, in chunks: each row is
+validated against STATES_AND_DISTRICTS and the bot's language codes, and valid rows are COPYed
+into a temporary staging table. Once every chunk is loaded, the staging table is merged into
+users, upserting on mobile_number (the last row wins when a number repeats), in the same
+transaction. The import is therefore all-or-nothing, and memory stays flat whatever the file size.
+Rejected rows are written to a CSV with the reason for each. Run `python vaccination_schedule.py plan`
+afterwards to schedule the vaccination reminders of the imported users.
+
+    python import_beneficiaries.py roster.csv [--state Odisha] [--chunk-size 50000]
+                                   [--rejects roster.rejects.csv] [--keep-existing] [--dry-run]
+"""
+import io
+import re
+import csv
+import sys
+import time
+import logging
+import argparse
+from datetime import date, datetime
+from collections import Counter
+
+from database import get_db_connection, USER_CHANGED_CHANNEL, ALL_USERS_CHANGED
+from district_search import DistrictIndex
+from location_data import STATES_AND_DISTRICTS
+
+logging.basicConfig(level=logging.INFO)
+
+REQUIRED_COLUMNS = ('mobile', 'name', 'age', 'gender', 'district', 'language')
+STAGING_COLUMNS = ('line', 'mobile_number', 'name', 'age', 'gender', 'state', 'district', 'language', 'date_of_birth')
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y', '%d.%m.%Y')
+
+LANGUAGES = {
+    'en': 'en', 'english': 'en', 'hi': 'hi', 'hindi': 'hi', 'od': 'od', 'or': 'od', 'odia': 'od', 'oriya': 'od',
+    'kui': 'kui', 'sa': 'sa', 'sat': 'sa', 'santali': 'sa',
+}
+GENDERS = {'m': 'Male', 'male': 'Male', 'f': 'Female', 'female': 'Female', 'o': 'Other', 'other': 'Other'}
+MAX_NAME_LENGTH = 100
+MAX_AGE = 120
+DISTRICT_CACHE_SIZE = 10000
+_MISSING = object()
+
+
+class RowError(ValueError):
+    """A roster row that cannot be imported; the message is the reason reported for it."""
+
+
+# --- Validation ---
+def normalize_mobile(raw):
+    """Returns the number as Twilio sends it ('whatsapp:+91XXXXXXXXXX'), for Indian mobiles."""
+    digits = re.sub(r'\D', '', raw)
+    if len(digits) == 11 and digits.startswith('0'):
+        digits = digits[1:]
+    if len(digits) == 10:
+        digits = '91' + digits
+    if len(digits) != 12 or not digits.startswith('91') or digits[2] not in '6789':
+        raise RowError('invalid mobile')
+    return f"whatsapp:+{digits}"
+
+def parse_date_of_birth(raw):
+    """Returns an optional date of birth as a date, or None if the column is empty."""
+    raw = (raw or '').strip()
+    if not raw:
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            born = datetime.strptime(raw, date_format).date()
+            break
+        except ValueError:
+            continue
+    else:
+        raise RowError('invalid date of birth')
+    today = date.today()
+    if born > today or today.year - born.year > MAX_AGE + 1:
+        raise RowError('invalid date of birth')
+    return born
+
+class RowValidator:
+    """Checks and normalises one roster row at a time."""
+
+    def __init__(self, default_state):
+        self.default_state = default_state
+        self.states = {state.lower(): state for state in STATES_AND_DISTRICTS}
+        self._district_indexes = {}
+        self._districts = {}    # (state, text as written) -> district, or None if unknown
+
+    def _district(self, state, text):
+        # Rosters spell the same few districts over and over.
+        district = self._districts.get((state, text), _MISSING)
+        if district is _MISSING:
+            index = self._district_indexes.get(state)
+            if index is None:
+                index = self._district_indexes[state] = DistrictIndex(STATES_AND_DISTRICTS[state])
+            # Only exact names and known aliases ("Keonjhar"): a guess is no good in a bulk import.
+            matches = index.search(text, limit=1)
+            district = matches[0][0] if matches and matches[0][1] == 1.0 else None
+            if len(self._districts) < DISTRICT_CACHE_SIZE:
+                self._districts[(state, text)] = district
+        if district is None:
+            raise RowError('unknown district')
+        return district
+
+    def validate(self, row):
+        """Returns the row as (mobile_number, name, age, gender, state, district, language, date_of_birth)."""
+        mobile = normalize_mobile(row.get('mobile') or '')
+        name = ' '.join((row.get('name') or '').split())
+        if not name or len(name) > MAX_NAME_LENGTH:
+            raise RowError('invalid name')
+        try:
+            age = int(float((row.get('age') or '').strip()))
+        except (ValueError, OverflowError):
+            raise RowError('invalid age') from None
+        if not 0 <= age <= MAX_AGE:
+            raise RowError('invalid age')
+        gender = GENDERS.get((row.get('gender') or '').strip().lower())
+        if gender is None:
+            raise RowError('invalid gender')
+        state = self.states.get((row.get('state') or self.default_state).strip().lower())
+        if state is None:
+            raise RowError('unknown state')
+        district = self._district(state, row.get('district') or '')
+        language = LANGUAGES.get((row.get('language') or '').strip().lower())
+        if language is None:
+            raise RowError('unsupported language')
+        date_of_birth = parse_date_of_birth(row.get('date_of_birth'))
+        return mobile, name, age, gender, state, district, language, date_of_birth
+
+
+def read_chunks(rows, validator, chunk_size, on_reject):
+    """Yields lists of (line, *validated row), `chunk_size` at a time, passing bad rows to on_reject."""
+    chunk = []
+    for line, row in enumerate(rows, 2):
+        try:
+            chunk.append((line, *validator.validate(row)))
+        except RowError as e:
+            on_reject(line, row, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# --- Loading ---
+def copy_chunk(cur, chunk):
+    """Streams one chunk into the staging table with COPY."""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(chunk)
+    buffer.seek(0)
+    cur.copy_expert(f"COPY beneficiary_import ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def merge_staging(cur, keep_existing):
+    """Upserts the staged rows into users. Returns (inserted, updated, duplicates)."""
+    if keep_existing:
+        conflict = "DO NOTHING"
+    else:
+        conflict = """DO UPDATE SET name = EXCLUDED.name, age = EXCLUDED.age, gender = EXCLUDED.gender,
+                      state = EXCLUDED.state, district = EXCLUDED.district, language = EXCLUDED.language,
+                      date_of_birth = COALESCE(EXCLUDED.date_of_birth, users.date_of_birth),
+                      age_recorded_on = EXCLUDED.age_recorded_on"""
+    cur.execute(
+        f"""
+        WITH merged AS (
+            INSERT INTO users (mobile_number, name, age, gender, state, district, language, date_of_birth, age_recorded_on)
+            SELECT DISTINCT ON (mobile_number) mobile_number, name, age, gender, state, district, language, date_of_birth,
+                   CURRENT_DATE
+            FROM beneficiary_import ORDER BY mobile_number, line DESC
+            ON CONFLICT (mobile_number) {conflict}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted),
+               (SELECT count(*) - count(DISTINCT mobile_number) FROM beneficiary_import)
+        FROM merged
+        """
+    )
+    return cur.fetchone()
+
+def import_roster(rows, validator, chunk_size, on_reject, keep_existing=False, dry_run=False):
+    """Validates and loads every row. Returns a dict of counts."""
+    counts = Counter()
+    if dry_run:
+        for chunk in read_chunks(rows, validator, chunk_size, on_reject):
+            counts['valid'] += len(chunk)
+        return counts
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMP TABLE beneficiary_import (
+                    line INT, mobile_number TEXT, name TEXT, age INT, gender TEXT, state TEXT, district TEXT, language TEXT,
+                    date_of_birth DATE
+                ) ON COMMIT DROP
+                """
+            )
+            for chunk in read_chunks(rows, validator, chunk_size, on_reject):
+                copy_chunk(cur, chunk)
+                counts['valid'] += len(chunk)
+                logging.info(f"Staged {counts['valid']} rows...")
+            cur.execute("ANALYZE beneficiary_import")
+            counts['inserted'], counts['updated'], counts['duplicates'] = merge_staging(cur, keep_existing)
+            # Workers drop their cached profiles (and cached "unregistered" answers) once this commits.
+            cur.execute("SELECT pg_notify(%s, %s)", (USER_CHANGED_CHANNEL, ALL_USERS_CHANGED))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('roster', help="CSV file with a header row")
+    parser.add_argument('--state', default='Odisha', help="state for rows without a state column")
+    parser.add_argument('--chunk-size', type=int, default=50000, help="rows per COPY")
+    parser.add_argument('--rejects', help="where to write rejected rows (default: <roster>.rejects.csv)")
+    parser.add_argument('--keep-existing', action='store_true', help="do not overwrite users who are already registered")
+    parser.add_argument('--dry-run', action='store_true', help="only validate, without touching the database")
+    args = parser.parse_args()
+    rejects_path = args.rejects or re.sub(r'\.csv$', '', args.roster) + '.rejects.csv'
+
+    start = time.monotonic()
+    reasons = Counter()
+    with open(args.roster, newline='', encoding='utf-8-sig') as roster, \
+            open(rejects_path, 'w', newline='', encoding='utf-8') as rejects_file:
+        reader = csv.DictReader(roster)
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+        missing = [column for column in REQUIRED_COLUMNS if column not in reader.fieldnames]
+        if missing:
+            logging.error(f"{args.roster} is missing the column(s): {', '.join(missing)}")
+            sys.exit(1)
+        rejects = csv.writer(rejects_file)
+        rejects.writerow(['line', 'reason', *reader.fieldnames])
+
+        def on_reject(line, row, reason):
+            reasons[reason] += 1
+            rejects.writerow([line, reason, *(row.get(name) for name in reader.fieldnames)])
+
+        counts = import_roster(reader, RowValidator(args.state), args.chunk_size, on_reject,
+                               keep_existing=args.keep_existing, dry_run=args.dry_run)
+
+    elapsed = time.monotonic() - start
+    total = counts['valid'] + sum(reasons.values())
+    logging.info(f"Read {total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s): "
+                 f"{counts['valid']} valid, {sum(reasons.values())} rejected.")
+    if reasons:
+        logging.info(f"Rejected rows ({rejects_path}): " + ', '.join(f"{reason}: {n}" for reason, n in reasons.most_common()))
+    if not args.dry_run:
+        logging.info(f"Users inserted: {counts['inserted']}, updated: {counts['updated']}, "
+                     f"repeated numbers superseded by a later row: {counts['duplicates']}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Job Queue Configuration ---
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "jobs.db")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# A job claimed by a worker that died is handed out again after this many seconds.
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get("JOB_VISIBILITY_TIMEOUT", 120))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 0.5))
+
+_handlers = {}
+
+
+def job_handler(kind):
+    """
+    Registers a function as the handler for jobs of `kind`. The handler receives the job's
+    payload dict; if it raises, any changes it made to the payload are saved with the retry.
+    """
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+class JobQueue:
+    """
+    A small persistent job queue in a WAL-mode SQLite file, drained by a bounded pool of
+    worker threads. Jobs survive restarts, failed jobs are retried with exponential backoff
+    and several worker processes on the host can share one queue file. Jobs enqueued with the
+    same `key` run one at a time, in the order they were enqueued (a retry keeps its place).
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._started_pid = None
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+            "run_at REAL NOT NULL, last_error TEXT, created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_at)")
+        try:
+            conn.execute("ALTER TABLE jobs ADD COLUMN job_key TEXT")
+        except sqlite3.OperationalError:
+            pass    # queue file created with the column, or added by another worker
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (job_key, id)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, kind, payload, delay=0, key=None):
+        """Persists a job and wakes a worker. Returns the job id."""
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO jobs (kind, payload, run_at, created_at, job_key) VALUES (?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload), now + delay, now, key)
+        )
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return cur.lastrowid
+
+    def _claim(self):
+        """Atomically marks the oldest runnable job as running and returns it, or None."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs "
+                "WHERE status IN ('queued', 'running') AND run_at <= ? "
+                "AND (job_key IS NULL OR NOT EXISTS ("
+                "    SELECT 1 FROM jobs earlier WHERE earlier.job_key = jobs.job_key AND earlier.id < jobs.id"
+                "    AND earlier.status IN ('queued', 'running'))) "
+                "ORDER BY run_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row:
+                # While running, run_at doubles as the lease expiry for crash recovery.
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, run_at = ? WHERE id = ?",
+                    (now + JOB_VISIBILITY_TIMEOUT, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def run_pending(self):
+        """Runs one runnable job in the calling thread. Returns False if there was none."""
+        row = self._claim()
+        if row is None:
+            return False
+        job_id, kind, payload, attempts = row
+        payload = json.loads(payload)
+        attempts += 1
+        conn = self._conn()
+        try:
+            handler = _handlers[kind]
+            handler(payload)
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                logging.error(f"Job {job_id} ({kind}) failed permanently after {attempts} attempts: {e}")
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', payload = ?, last_error = ? WHERE id = ?",
+                    (json.dumps(payload), str(e), job_id)
+                )
+            else:
+                backoff = min(2 ** attempts, 300) * random.uniform(0.5, 1.5)
+                logging.warning(f"Job {job_id} ({kind}) failed, retrying in {backoff:.1f}s: {e}")
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', payload = ?, last_error = ?, run_at = ? WHERE id = ?",
+                    (json.dumps(payload), str(e), time.time() + backoff, job_id)
+                )
+        return True
+
+    def _worker_loop(self):
+        while True:
+            try:
+                if self.run_pending():
+                    continue
+            except Exception as e:
+                logging.error(f"Job worker error: {e}")
+            with self._wakeup:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+
+    def start(self):
+        """Starts the worker threads (once per process)."""
+        with self._wakeup:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True).start()
+
+    def stats(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """Returns the process-wide job queue."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
+
+def enqueue(kind, payload, delay=0, key=None):
+    return get_job_queue().enqueue(kind, payload, delay, key)
@@ -0,0 +1 @@
+"""Load-testing and replay benchmark suite for the /message webhook; see __main__.py."""
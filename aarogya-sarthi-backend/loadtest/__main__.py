@@ -0,0 +1,258 @@
+"""
+Load test and replay benchmark for the /message webhook.
+
+N virtual WhatsApp users register (in all five languages) and then run weighted flows (menu,
+symptom checker, vaccine lookup, outbreak check) against the Flask app in this process, with
+Gemini, Google Places, the WHO feed and Twilio replaced by local stub servers and Postgres by
+an in-process stand-in. Results are printed and saved as JSON for comparing runs.
+
+    python -m loadtest run [--users 50] [--duration 30] [--mix symptoms=3,vaccine=2]
+                           [--latency gemini=0.8,places=0.3] [--error-rate gemini=0.05]
+                           [--db-latency 0.002] [--async] [--admission] [--out results.json] [--compare baseline.json]
+    python -m loadtest run --url http://127.0.0.1:5000/message ...   # a separately started server
+    python -m loadtest stubs                                          # stubs only, prints their env
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loadtest.report import Recorder, git_commit, save_results, print_results, compare_results, default_results_path
+from loadtest.scenarios import registration, parse_mix, flow_picker, phone_number
+from loadtest.stubs import start_stubs
+
+DEFAULT_LATENCY = {'gemini': 0.8, 'places': 0.3, 'who': 0.2, 'twilio': 0.1}
+
+
+def parse_rates(text, defaults=None):
+    """Parses "gemini=0.8,places=0.3" over `defaults`."""
+    rates = dict(defaults or {})
+    for item in filter(None, (text or '').split(',')):
+        name, _, value = item.partition('=')
+        rates[name] = float(value)
+    return rates
+
+def instrument_requests(recorder, hosts):
+    """Times every outgoing `requests` call to a known host:port under that dependency's name."""
+    import requests
+    original_send = requests.Session.send
+    def send(session, request, **kwargs):
+        dependency = hosts.get(urlsplit(request.url).netloc)
+        if dependency is None:
+            return original_send(session, request, **kwargs)
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = original_send(session, request, **kwargs)
+            ok = response.status_code < 400
+            return response
+        finally:
+            recorder.record(dependency, time.perf_counter() - start, ok)
+    requests.Session.send = send
+
+
+def webhook_form(number, body):
+    """The fields of a Twilio webhook, with a fresh MessageSid as Twilio sends."""
+    return {'From': number, 'Body': body, 'MessageSid': f"SM{uuid.uuid4().hex}"}
+
+
+class InProcessClient:
+    """Posts to the app through Flask's test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, number, body):
+        response = self.client.post('/message', data=webhook_form(number, body))
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpClient:
+    """Posts to a running server over HTTP, reusing one keep-alive connection."""
+
+    def __init__(self, url):
+        import requests
+        self.url = url
+        self.session = requests.Session()
+
+    def post(self, number, body):
+        response = self.session.post(self.url, data=webhook_form(number, body), timeout=60)
+        return response.status_code, response.text
+
+
+def run_user(user_index, client, args, pick, deadline, messages, flows):
+    def run_flow(name, script):
+        flow_start = time.perf_counter()
+        flow_ok = True
+        for body in script:
+            start = time.perf_counter()
+            try:
+                status, text = client.post(phone_number(user_index), body)
+                ok = status == 200 and '<Response' in text and 'unexpected error' not in text
+            except Exception as e:
+                logging.error(f"User {user_index} got {e!r} for {body!r}")
+                ok = False
+            messages.record(name, time.perf_counter() - start, ok)
+            flow_ok = flow_ok and ok
+            if args.think:
+                time.sleep(args.think)
+        flows.record(name, time.perf_counter() - flow_start, flow_ok)
+
+    run_flow(*registration(user_index))
+    done = 0
+    while time.monotonic() < deadline and (args.flows_per_user is None or done < args.flows_per_user):
+        run_flow(*pick())
+        done += 1
+
+def wait_for_jobs(timeout):
+    """In async mode, waits until background jobs (replies via Twilio) have drained."""
+    from job_queue import get_job_queue
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = get_job_queue().stats()
+        if not stats.get('queued') and not stats.get('running'):
+            return stats
+        time.sleep(0.2)
+    return get_job_queue().stats()
+
+def run(args):
+    mix = parse_mix(args.mix)
+    messages, flows, dependencies = Recorder(), Recorder(), Recorder()
+    extra = {}
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+        stubs = {}
+    else:
+        latency = parse_rates(args.latency, DEFAULT_LATENCY)
+        stubs, env = start_stubs(latency, parse_rates(args.error_rate))
+        workdir = tempfile.mkdtemp(prefix='loadtest-')
+        os.environ.update(env)
+        os.environ.update({
+            'CLINIC_INDEX_PATH': os.path.join(workdir, 'clinic_index.db'),
+            'JOB_QUEUE_PATH': os.path.join(workdir, 'jobs.db'),
+            'STATE_STORE_BACKEND': 'memory',
+            'IDEMPOTENCY_BACKEND': 'memory',
+            'ADMISSION_BACKEND': 'memory',
+            'ASYNC_REPLIES': '1' if args.async_replies else '',
+            'OUTBREAK_BROADCAST': '',
+        })
+        if not args.admission:
+            # Virtual users send far faster than people; only the upstream budgets stay on.
+            os.environ.update({'NUMBER_MESSAGE_RATE': '0', 'NUMBER_AI_RATE': '0'})
+        instrument_requests(dependencies, {urlsplit(stub.base_url).netloc: name for name, stub in stubs.items()})
+
+        from loadtest.memory_db import MemoryDatabase
+        MemoryDatabase(dependencies, args.db_latency).install()
+        import app as app_module
+        from outbreak_alerts import refresh_feed
+        refresh_feed()
+        make_client = lambda: InProcessClient(app_module.app)
+
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=run_user, args=(i, make_client(), args, flow_picker(mix, args.seed + i), deadline, messages, flows))
+        for i in range(args.users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    if not args.url:
+        # Symptom-checker summaries run on the job queue in either mode.
+        extra['jobs'] = wait_for_jobs(args.drain_timeout)
+        import gemini_services
+        import symptom_checker
+        extra['gemini_client'] = gemini_services.get_gemini_client().stats()
+        extra['symptom_context'] = symptom_checker.get_context_stats()
+        extra['stubs'] = {name: stub.stats() for name, stub in stubs.items()}
+        for stub in stubs.values():
+            stub.stop()
+
+    flow_summary = flows.summary()
+    message_summary = messages.summary()
+    total_messages = sum(s['count'] for s in message_summary.values())
+    total_flows = sum(s['count'] for s in flow_summary.values())
+    return {
+        'meta': {
+            'started_at': started_at, 'git_commit': git_commit(), 'python': platform.python_version(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('func', 'compare', 'out')},
+        },
+        'totals': {
+            'messages': total_messages, 'flows': total_flows,
+            'errors': sum(s['errors'] for s in message_summary.values()),
+            'elapsed_s': round(elapsed, 3),
+            'messages_per_s': round(total_messages / elapsed, 2),
+            'flows_per_s': round(total_flows / elapsed, 2),
+        },
+        'messages': message_summary,
+        'flows': flow_summary,
+        'dependencies': dependencies.summary(),
+        'extra': extra,
+    }
+
+def run_command(args):
+    results = run(args)
+    print_results(results)
+    out = args.out or default_results_path()
+    save_results(results, out)
+    print(f"\nSaved results to {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+def stubs_command(args):
+    stubs, env = start_stubs(parse_rates(args.latency, DEFAULT_LATENCY), parse_rates(args.error_rate))
+    print("Stub servers running. Start the app with:\n")
+    for key, value in env.items():
+        print(f"export {key}='{value}'")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for stub in stubs.values():
+            stub.stop()
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(prog='python -m loadtest', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    run_parser = subcommands.add_parser('run', help="run the load test")
+    run_parser.add_argument('--users', type=int, default=50, help="concurrent virtual users")
+    run_parser.add_argument('--duration', type=float, default=30, help="seconds to keep starting new flows")
+    run_parser.add_argument('--flows-per-user', type=int, default=None, help="stop each user after this many flows")
+    run_parser.add_argument('--think', type=float, default=0.0, help="seconds between a user's messages")
+    run_parser.add_argument('--mix', help="flow weights, e.g. symptoms=3,vaccine=2,menu=1,outbreak=1")
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--url', help="target a running server instead of the in-process app")
+    run_parser.add_argument('--db-latency', type=float, default=0.002, help="simulated Postgres round-trip (s)")
+    run_parser.add_argument('--admission', action='store_true', help="keep the per-number rate limits on")
+    run_parser.add_argument('--async', dest='async_replies', action='store_true', help="run with ASYNC_REPLIES")
+    run_parser.add_argument('--drain-timeout', type=float, default=60, help="seconds to wait for background jobs")
+    run_parser.add_argument('--out', help="results file (default: loadtest-results/<timestamp>.json)")
+    run_parser.add_argument('--compare', help="earlier results file to compare against")
+    run_parser.set_defaults(func=run_command)
+    stubs_parser = subcommands.add_parser('stubs', help="only run the stub servers")
+    stubs_parser.set_defaults(func=stubs_command)
+    for sub in (run_parser, stubs_parser):
+        sub.add_argument('--latency', help="mean stub latency in seconds, e.g. gemini=0.8,places=0.3")
+        sub.add_argument('--error-rate', help="stub error rates, e.g. gemini=0.05")
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+In-process stand-in for the Postgres-backed functions in database.py, for load tests on
+machines without a database. Every call sleeps `latency` seconds to model the round-trip,
+and is recorded under the 'postgres' dependency.
+"""
+import sys
+import time
+import threading
+from datetime import date
+from contextlib import contextmanager
+
+import database
+
+
+class MemoryDatabase:
+    """The subset of database.py the webhook uses, backed by dicts behind one lock."""
+
+    FUNCTIONS = (
+        'get_user', 'add_user', 'delete_user',
+        'get_chat_session', 'get_recent_turns', 'append_chat_turns', 'save_chat_summary', 'start_chat_session',
+        'has_user_seen_alert', 'mark_alert_as_seen', 'get_seen_alert_ids', 'get_seen_alert_ids_for_users',
+        'mark_alerts_as_seen', 'get_alert_translations', 'save_alert_translation',
+        'get_users_to_plan', 'save_vaccination_due', 'get_due_vaccinations', 'mark_vaccinations_reminded',
+    )
+
+    def __init__(self, recorder=None, latency=0.0):
+        self.recorder = recorder
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.users = {}             # mobile -> UserRecord
+        self.chats = {}             # user_id -> {'session_id', 'summary', 'summarized_upto'}
+        self.turns = {}             # (user_id, session_id) -> [{'seq', 'role', 'text', 'turn_id'}]
+        self.alerts_seen = {}       # user_id -> set of alert ids
+        self.translations = {}      # (alert_id, lang) -> (title, summary)
+        self.registered_on = {}     # user_id -> the day the user's age was given
+        self.vaccinations = {}      # (user_id, dose) -> {'due_on', 'reminded'}
+
+    @contextmanager
+    def _query(self):
+        """One simulated round-trip: the latency is paid outside the lock, like concurrent connections."""
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with self._lock:
+                yield
+        finally:
+            if self.recorder:
+                self.recorder.record('postgres', time.perf_counter() - start)
+
+    def install(self):
+        """Replaces the database functions everywhere they have been imported."""
+        for name in self.FUNCTIONS:
+            original = getattr(database, name)
+            replacement = getattr(self, name)
+            for module in list(sys.modules.values()):
+                if getattr(module, name, None) is original:
+                    setattr(module, name, replacement)
+
+    # --- Users ---
+    def get_user(self, mobile):
+        # Keeps database.py's user cache in front, as in production.
+        user = database._user_cache.get(mobile)
+        if user is not None:
+            return None if user is database._NO_USER else user
+        with self._query():
+            user = self.users.get(mobile)
+        database._user_cache.set(mobile, database._NO_USER if user is None else user)
+        return user
+
+    def add_user(self, mobile, name, age, gender, state, district, language):
+        with self._query():
+            user_id = len(self.users) + 1
+            self.users[mobile] = database.UserRecord(user_id, mobile, name, age, gender, state, district, language)
+            self.registered_on[user_id] = date.today()
+        database._user_cache.pop(mobile)
+        return user_id
+
+    def delete_user(self, mobile):
+        with self._query():
+            user = self.users.pop(mobile, None)
+            if user is not None:
+                # ON DELETE CASCADE
+                self.vaccinations = {key: row for key, row in self.vaccinations.items() if key[0] != user.id}
+        database._user_cache.pop(mobile)
+
+    # --- Symptom Checker ---
+    def get_chat_session(self, user_id):
+        with self._query():
+            return dict(self.chats.setdefault(user_id, {'session_id': 1, 'summary': None, 'summarized_upto': 0}))
+
+    def get_recent_turns(self, user_id, session_id, limit, after_seq=0):
+        with self._query():
+            turns = [dict(turn) for turn in self.turns.get((user_id, session_id), []) if turn['seq'] > after_seq]
+        return turns if limit is None else turns[-limit:]
+
+    def append_chat_turns(self, user_id, session_id, turns, turn_id=None):
+        with self._query():
+            rows = self.turns.setdefault((user_id, session_id), [])
+            stored = [row['seq'] for row in rows if turn_id is not None and row['turn_id'] == turn_id]
+            if stored:
+                return stored
+            seqs = []
+            for role, text in turns:
+                seqs.append(len(rows) + 1)
+                rows.append({'seq': seqs[-1], 'role': role, 'text': text, 'turn_id': turn_id})
+        return seqs
+
+    def save_chat_summary(self, user_id, session_id, summary, summarized_upto):
+        with self._query():
+            if user_id in self.chats and self.chats[user_id]['session_id'] == session_id:
+                self.chats[user_id].update(summary=summary, summarized_upto=summarized_upto)
+
+    def start_chat_session(self, user_id):
+        with self._query():
+            if user_id in self.chats:
+                chat = self.chats[user_id]
+                chat.update(session_id=chat['session_id'] + 1, summary=None, summarized_upto=0)
+
+    # --- Outbreak Alerts ---
+    def has_user_seen_alert(self, user_id, alert_id):
+        with self._query():
+            return alert_id in self.alerts_seen.get(user_id, ())
+
+    def mark_alert_as_seen(self, user_id, alert_id, published=None):
+        with self._query():
+            self.alerts_seen.setdefault(user_id, set()).add(alert_id)
+
+    def get_seen_alert_ids(self, user_id, alert_ids=None):
+        return self.get_seen_alert_ids_for_users([user_id], alert_ids).get(user_id, set())
+
+    def get_seen_alert_ids_for_users(self, user_ids, alert_ids=None):
+        seen = {}
+        with self._query():
+            for user_id in user_ids:
+                alerts = self.alerts_seen.get(user_id, set())
+                alerts = alerts if alert_ids is None else alerts & set(alert_ids)
+                if alerts:
+                    seen[user_id] = set(alerts)
+        return seen
+
+    def mark_alerts_as_seen(self, pairs, published=None, page_size=1000):
+        with self._query():
+            for user_id, alert_id in pairs:
+                self.alerts_seen.setdefault(user_id, set()).add(alert_id)
+
+    def get_alert_translations(self, alert_ids):
+        with self._query():
+            return {key: value for key, value in self.translations.items() if key[0] in alert_ids}
+
+    def save_alert_translation(self, alert_id, lang, title, summary):
+        with self._query():
+            self.translations[(alert_id, lang)] = (title, summary)
+
+    # --- Vaccination Schedule ---
+    def get_users_to_plan(self, after_id, limit):
+        with self._query():
+            rows = sorted((user.id, None, int(user.age), self.registered_on[user.id])
+                          for user in self.users.values() if user.id > after_id)
+        return rows[:limit]
+
+    def save_vaccination_due(self, rows, page_size=1000):
+        if not rows:
+            return
+        with self._query():
+            for user_id, dose, due_on in rows:
+                row = self.vaccinations.setdefault((user_id, dose), {'due_on': due_on, 'reminded': False})
+                if not row['reminded']:
+                    row['due_on'] = due_on
+
+    def get_due_vaccinations(self, due_on, after_user_id, limit):
+        with self._query():
+            doses = {}
+            for (user_id, dose), row in self.vaccinations.items():
+                if row['due_on'] == due_on and user_id > after_user_id and not row['reminded']:
+                    doses.setdefault(user_id, []).append(dose)
+            users = {user.id: user for user in self.users.values()}
+        return [(user_id, users[user_id].mobile_number, users[user_id].language, sorted(doses[user_id]))
+                for user_id in sorted(doses)[:limit] if user_id in users]
+
+    def mark_vaccinations_reminded(self, due_on, user_ids):
+        if not user_ids:
+            return
+        user_ids = set(user_ids)
+        with self._query():
+            for (user_id, dose), row in self.vaccinations.items():
+                if user_id in user_ids and row['due_on'] == due_on:
+                    row['reminded'] = True
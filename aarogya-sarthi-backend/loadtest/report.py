@@ -0,0 +1,92 @@
+"""
+Latency recording, percentile summaries and machine-readable results for load-test runs.
+"""
+import os
+import json
+import math
+import time
+import threading
+import subprocess
+from collections import defaultdict
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list, or None if it is empty."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(samples):
+    """Count, errors and latency percentiles (ms) of a list of (seconds, ok) samples."""
+    latencies = sorted(seconds * 1000 for seconds, _ in samples)
+    return {
+        'count': len(samples),
+        'errors': sum(1 for _, ok in samples if not ok),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else None,
+        **{f'p{p}_ms': round(percentile(latencies, p), 3) if latencies else None for p in (50, 95, 99)},
+        'max_ms': round(latencies[-1], 3) if latencies else None,
+    }
+
+
+class Recorder:
+    """Thread-safe collector of (seconds, ok) samples under named series."""
+
+    def __init__(self):
+        self._samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, series, seconds, ok=True):
+        with self._lock:
+            self._samples[series].append((seconds, ok))
+
+    def summary(self):
+        with self._lock:
+            return {series: summarize(samples) for series, samples in sorted(self._samples.items())}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def save_results(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def print_results(results):
+    totals = results['totals']
+    print(f"\n{totals['messages']} messages, {totals['flows']} flows, {totals['errors']} errors in {totals['elapsed_s']}s "
+          f"-> {totals['messages_per_s']} msg/s, {totals['flows_per_s']} flows/s")
+    for title, section in (("Per message, by flow", results['messages']), ("Whole flow", results['flows']),
+                           ("External dependencies", results['dependencies'])):
+        print(f"\n{title}:")
+        print(f"  {'name':<22}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for name, s in section.items():
+            cells = ''.join(f"{s[key]:>10.1f}" if s[key] is not None else f"{'-':>10}" for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+            print(f"  {name:<22}{s['count']:>8}{s['errors']:>8}{cells}")
+    context = results.get('extra', {}).get('symptom_context')
+    if context and context.get('requests'):
+        print(f"\nSymptom-checker context: {context['prompt_tokens_avg']:.0f} prompt tokens and "
+              f"{context['payload_bytes_avg']:.0f} bytes per request, {context['summaries']} summaries")
+
+def compare_results(baseline, current):
+    """Prints throughput and p95 changes of `current` against a saved `baseline` run."""
+    def change(old, new):
+        if not old or new is None:
+            return '-'
+        return f"{(new - old) / old * 100:+.1f}%"
+    print(f"\nAgainst {baseline['meta'].get('git_commit')} ({baseline['meta'].get('started_at')}):")
+    for key in ('messages_per_s', 'flows_per_s'):
+        print(f"  {key:<30}{baseline['totals'][key]:>10} -> {current['totals'][key]:<10} {change(baseline['totals'][key], current['totals'][key])}")
+    for section in ('messages', 'flows', 'dependencies'):
+        for name, s in current[section].items():
+            old = baseline.get(section, {}).get(name)
+            if old:
+                print(f"  {section + '/' + name + ' p95':<30}{old['p95_ms']!s:>10} -> {s['p95_ms']!s:<10} {change(old['p95_ms'], s['p95_ms'])}")
+
+def default_results_path():
+    return os.path.join('loadtest-results', time.strftime('%Y%m%d-%H%M%S') + '.json')
@@ -0,0 +1,48 @@
+"""
+Scripted WhatsApp conversations. Every virtual user registers first (cycling through the five
+languages), then runs flows picked at random by weight.
+"""
+import random
+
+# (menu digit, language code), in the order of the language-select menu.
+LANGUAGES = [('1', 'en'), ('2', 'hi'), ('3', 'od'), ('4', 'kui'), ('5', 'sa')]
+# An infant, a child and an adult, so every vaccine schedule is exercised.
+AGES = ['1', '8', '34']
+
+FLOWS = {
+    'menu': ['menu', '3', '5'],
+    'symptoms': ['menu', '1', "I have had a fever since yesterday", "I also have a headache", "and some body ache", 'exit'],
+    'vaccine': ['menu', '2', '2'],
+    'outbreak': ['menu', '4'],
+}
+DEFAULT_MIX = {'menu': 3, 'symptoms': 3, 'vaccine': 2, 'outbreak': 2}
+
+
+def phone_number(user_index):
+    return f"whatsapp:+9199{user_index:08d}"
+
+def registration(user_index):
+    """Returns (flow name, messages) registering virtual user `user_index`."""
+    digit, lang = LANGUAGES[user_index % len(LANGUAGES)]
+    gender = str(user_index % 3 + 1)
+    district = str(user_index % 30 + 1)
+    return f"registration/{lang}", ['hi', digit, f"Load Tester {user_index}", AGES[user_index % len(AGES)], gender, district]
+
+def parse_mix(text):
+    """Parses "symptoms=3,vaccine=1" into flow weights."""
+    mix = {}
+    for item in filter(None, (text or '').split(',')):
+        name, _, weight = item.partition('=')
+        if name not in FLOWS:
+            raise ValueError(f"unknown flow '{name}' (choose from {', '.join(FLOWS)})")
+        mix[name] = float(weight or 1)
+    return mix or dict(DEFAULT_MIX)
+
+def flow_picker(mix, seed):
+    """Returns a function yielding (flow name, messages) at random according to `mix`."""
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    def pick():
+        name = rng.choices(names, weights)[0]
+        return name, FLOWS[name]
+    return pick
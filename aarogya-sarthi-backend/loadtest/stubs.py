@@ -0,0 +1,207 @@
+"""
+Local stand-ins for the bot's external HTTP APIs, each with configurable latency and error rate.
+"""
+import json
+import time
+import random
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    """A threaded HTTP server on 127.0.0.1 that answers with `respond(handler)` after `latency` seconds."""
+
+    name = 'stub'
+
+    def __init__(self, latency=0.0, error_rate=0.0, port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub._handle(self)
+
+            def do_POST(self):
+                stub._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, handler):
+        length = int(handler.headers.get('Content-Length') or 0)
+        handler.body = handler.rfile.read(length) if length else b''
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            # Exponential around the mean, like a real upstream's long tail.
+            time.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            self.send(handler, 503, b'{"error": "stub failure"}')
+            return
+        self.respond(handler)
+
+    def send(self, handler, status, body, content_type='application/json', headers=None):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def respond(self, handler):
+        raise NotImplementedError
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'errors': self.errors}
+
+
+class GeminiStub(StubServer):
+    """
+    generateContent: translations in the "Title:/Summary:" format, canned advice otherwise.
+    streamGenerateContent: longer canned advice as server-sent events, a few words every `stream_interval` seconds.
+    """
+
+    name = 'gemini'
+    stream_interval = 0.05
+    streamed_advice = (
+        "A fever for two days is usually caused by a viral infection and often settles on its own. "
+        "Please rest, drink plenty of fluids such as water, ORS or coconut water, and eat light meals. "
+        "You can take paracetamol for the fever as directed on the pack, but avoid taking other medicines without advice. "
+        "Check your temperature twice a day and note any new symptoms. "
+        "See a doctor or visit your nearest health centre if the fever lasts more than three days, goes above 103°F, "
+        "or comes with a rash, bleeding, severe headache, vomiting or difficulty breathing. "
+        "If you live in an area with dengue or malaria cases, get a blood test done early. "
+        "This advice does not replace a consultation with a doctor."
+    )
+
+    def respond(self, handler):
+        payload = json.loads(handler.body or b'{}')
+        system_prompt = payload.get('systemInstruction', {}).get('parts', [{}])[0].get('text', '')
+        if ':streamGenerateContent' in handler.path:
+            self.stream(handler, self.streamed_advice)
+            return
+        if 'translator' in system_prompt:
+            text = "Title: Stub alert title\nSummary: Stub alert summary."
+        else:
+            text = "Please rest, drink plenty of fluids and see a doctor if the fever lasts more than two days."
+        body = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}}]}
+        self.send(handler, 200, json.dumps(body).encode())
+
+    def stream(self, handler, text):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.close_connection = True
+        words = text.split(' ')
+        for i in range(0, len(words), 4):
+            piece = ' '.join(words[i:i + 4]) + (' ' if i + 4 < len(words) else '')
+            body = {'candidates': [{'content': {'parts': [{'text': piece}], 'role': 'model'}}]}
+            handler.wfile.write(f"data: {json.dumps(body)}\r\n\r\n".encode())
+            handler.wfile.flush()
+            time.sleep(self.stream_interval)
+
+
+class PlacesStub(StubServer):
+    """Google Places text search with three fixed centres."""
+
+    name = 'places'
+    path = '/maps/api/place/textsearch/json'
+
+    def respond(self, handler):
+        results = [
+            {'name': f"Stub Health Centre {i}", 'formatted_address': f"{i} Hospital Road, Bhubaneswar, Odisha"}
+            for i in range(1, 4)
+        ]
+        self.send(handler, 200, json.dumps({'status': 'OK', 'results': results}).encode())
+
+
+class WhoFeedStub(StubServer):
+    """The WHO outbreak RSS feed with one India alert, honouring If-None-Match."""
+
+    name = 'who'
+    path = '/rss-feeds/emergencies-disease-outbreak-news-english.xml'
+    etag = '"stub-feed-1"'
+
+    def respond(self, handler):
+        if handler.headers.get('If-None-Match') == self.etag:
+            self.send(handler, 304, b'')
+            return
+        published = formatdate(time.time() - 3600, usegmt=True)
+        feed = (
+            '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            '<title>Disease Outbreak News</title>'
+            f'<item><guid>stub-india-1</guid><title>Dengue - India</title><pubDate>{published}</pubDate>'
+            '<description>Cases of dengue reported in several states of India.</description></item>'
+            f'<item><guid>stub-other-1</guid><title>Cholera - Elsewhere</title><pubDate>{published}</pubDate>'
+            '<description>Cholera outbreak elsewhere.</description></item>'
+            '</channel></rss>'
+        )
+        self.send(handler, 200, feed.encode(), content_type='application/rss+xml', headers={'ETag': self.etag})
+
+
+class TwilioStub(StubServer):
+    """Twilio's create-message endpoint."""
+
+    name = 'twilio'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sid = 0
+
+    def respond(self, handler):
+        with self._lock:
+            self._sid += 1
+            sid = f"SM{self._sid:032d}"
+        self.send(handler, 201, json.dumps({'sid': sid, 'status': 'queued'}).encode())
+
+
+def start_stubs(latency=None, error_rate=None):
+    """
+    Starts one stub per upstream. `latency` and `error_rate` map stub names to values.
+    Returns ({name: stub}, env) where env points the bot at the stubs.
+    """
+    latency, error_rate = latency or {}, error_rate or {}
+    stubs = {
+        cls.name: cls(latency.get(cls.name, 0.0), error_rate.get(cls.name, 0.0)).start()
+        for cls in (GeminiStub, PlacesStub, WhoFeedStub, TwilioStub)
+    }
+    env = {
+        'GEMINI_API_BASE': stubs['gemini'].base_url,
+        'GEMINI_API_KEY': 'stub-key',
+        'GOOGLE_PLACES_API_URL': stubs['places'].base_url + PlacesStub.path,
+        'GOOGLE_MAPS_API_KEY': 'stub-key',
+        'WHO_RSS_URL': stubs['who'].base_url + WhoFeedStub.path,
+        'TWILIO_API_BASE': stubs['twilio'].base_url,
+        'TWILIO_ACCOUNT_SID': 'ACstub',
+        'TWILIO_AUTH_TOKEN': 'stub-token',
+        'TWILIO_WHATSAPP_FROM': 'whatsapp:+10000000000',
+    }
+    return stubs, env
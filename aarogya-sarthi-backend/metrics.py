@@ -0,0 +1,224 @@
+"""
+Low-overhead latency histograms per stage, exported in the Prometheus text format, plus an
+optional trace log of slow requests.
+
+Wrap a unit of work in `stage_timer('gemini')` (or decorate it with `@timed('gemini')`): its
+duration is counted in aarogya_stage_seconds{stage, lang, outcome}, where `lang` is the language
+of the message being handled and `outcome` is 'ok', the exception's `reason` (GeminiError), or
+'error'. When TRACE_SAMPLE_RATE > 0, that fraction of requests also records every stage, and a
+request slower than TRACE_SLOW_MS is logged with its breakdown.
+
+Histograms live in process memory, so with several workers each one serves its own /metrics.
+"""
+import os
+import json
+import time
+import random
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Metrics Configuration ---
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() not in ('0', 'false', 'no')
+# Fraction of requests traced stage by stage; 0 turns tracing off entirely.
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+# A traced request slower than this is written to the 'aarogya.trace' log.
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 1000))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+trace_log = logging.getLogger('aarogya.trace')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """A thread-safe histogram with fixed buckets, one series per label-value tuple."""
+
+    def __init__(self, name, help, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}   # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """Returns {labels: (cumulative bucket counts, sum, count)}."""
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        snapshot = {}
+        for labels, (counts, total, count) in series.items():
+            running, cumulative = 0, []
+            for bucket_count in counts:
+                running += bucket_count
+                cumulative.append(running)
+            snapshot[labels] = (cumulative, total, count)
+        return snapshot
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for labels, (cumulative, total, count) in sorted(self.snapshot().items()):
+            for bound, bucket_count in zip(bounds, cumulative):
+                le = 'le="' + bound + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    'aarogya_stage_seconds', "Time spent in each stage of handling messages.", ('stage', 'lang', 'outcome')
+)
+
+_lang = ContextVar('metrics_lang', default='none')
+_trace = ContextVar('metrics_trace', default=None)
+
+
+class _Trace:
+    __slots__ = ('start', 'spans')
+
+    def __init__(self, start):
+        self.start = start
+        self.spans = []
+
+
+class StageTimer:
+    """Times a `with` block into stage_seconds (and the current trace, if any)."""
+
+    __slots__ = ('stage', 'outcome', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.outcome = 'ok'
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        outcome = self.outcome
+        if exc is not None and outcome == 'ok':
+            reason = getattr(exc, 'reason', None)
+            outcome = reason if isinstance(reason, str) else 'error'
+        stage_seconds.observe(elapsed, (self.stage, _lang.get(), outcome))
+        trace = _trace.get()
+        if trace is not None:
+            trace.spans.append((self.stage, self.start - trace.start, elapsed, outcome))
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ('outcome',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_TIMER = _NoopTimer()
+
+def stage_timer(stage):
+    """Returns a context manager timing one stage; set `.outcome` on it to label the result."""
+    return StageTimer(stage) if METRICS_ENABLED else _NOOP_TIMER
+
+def observe_stage(stage, seconds, outcome='ok'):
+    """Records a duration measured by hand, e.g. from the start of a stage to a point inside it."""
+    if METRICS_ENABLED:
+        stage_seconds.observe(seconds, (stage, _lang.get(), outcome))
+
+def timed(stage):
+    """Decorator form of stage_timer."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def set_lang(lang):
+    """Labels the rest of the current request's stages with the user's language."""
+    _lang.set(lang or 'none')
+
+@contextmanager
+def request_scope(stage='request'):
+    """Times a whole request; samples it for tracing and logs the trace if it was slow."""
+    lang_token = _lang.set('none')
+    trace = None
+    if TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE:
+        trace = _Trace(time.perf_counter())
+    trace_token = _trace.set(trace)
+    try:
+        with stage_timer(stage):
+            yield
+    finally:
+        if trace is not None and trace.spans:
+            _log_if_slow(trace)
+        _trace.reset(trace_token)
+        _lang.reset(lang_token)
+
+def _log_if_slow(trace):
+    stage, _, total, outcome = trace.spans[-1]
+    if total * 1000 < TRACE_SLOW_MS:
+        return
+    spans = [
+        {'stage': name, 'start_ms': round(offset * 1000, 1), 'ms': round(elapsed * 1000, 1), 'outcome': span_outcome}
+        for name, offset, elapsed, span_outcome in sorted(trace.spans[:-1], key=lambda span: span[1])
+    ]
+    trace_log.warning(f"Slow {stage} ({total * 1000:.0f} ms, lang={_lang.get()}, outcome={outcome}): {json.dumps(spans)}")
+
+
+# --- Exposition ---
+_collectors = []
+
+def register_collector(collect):
+    """
+    Adds `collect()` to /metrics. It returns {metric name: (help, value)} for gauges, or
+    (help, value, 'counter') for values that only go up since start; a counter's name is
+    given the `_total` suffix if it does not end in it already.
+    """
+    _collectors.append(collect)
+
+def render_metrics():
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = stage_seconds.render()
+    for collect in _collectors:
+        try:
+            metrics = collect()
+        except Exception as e:
+            logging.error(f"Metrics collector {getattr(collect, '__name__', collect)} failed: {e}")
+            continue
+        for name, (help, value, *kind) in metrics.items():
+            kind = kind[0] if kind else 'gauge'
+            if kind == 'counter' and not name.endswith('_total'):
+                name += '_total'
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return '\n'.join(lines) + '\n'
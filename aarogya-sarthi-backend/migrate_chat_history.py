@@ -0,0 +1,78 @@
+"""
+One-off migration of the legacy symptom_chats.chat_history JSON blobs into symptom_chat_turns.
+
+Each blob is exploded into one row per message under session 1 and then emptied, in the same
+transaction, so the script can be stopped and re-run safely. Run it before the bot starts
+writing turns with the new code, so the legacy turns keep their place at the start of session 1.
+
+    python migrate_chat_history.py [--batch-size 500]
+"""
+import argparse
+import json
+import logging
+from psycopg2 import extras
+from database import get_db_connection
+
+logging.basicConfig(level=logging.INFO)
+
+LEGACY_SESSION_ID = 1
+
+def _blob_turns(chat_history):
+    if isinstance(chat_history, str):
+        chat_history = json.loads(chat_history)
+    turns = []
+    for message in chat_history or []:
+        text = ''.join(part.get('text', '') for part in message.get('parts', []))
+        turns.append((message.get('role', 'user'), text))
+    return turns
+
+def migrate_batch(batch_size):
+    """Explodes up to `batch_size` non-empty blobs. Returns (chats, turns) migrated."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT user_id, chat_history FROM symptom_chats
+                WHERE chat_history IS NOT NULL AND chat_history::text NOT IN ('[]', 'null')
+                LIMIT %s FOR UPDATE SKIP LOCKED
+                """,
+                (batch_size,)
+            )
+            rows = cur.fetchall()
+            turn_rows = []
+            for user_id, chat_history in rows:
+                for seq, (role, text) in enumerate(_blob_turns(chat_history), 1):
+                    turn_rows.append((user_id, LEGACY_SESSION_ID, seq, role, text))
+            extras.execute_values(
+                cur,
+                "INSERT INTO symptom_chat_turns (user_id, session_id, seq, role, text) VALUES %s ON CONFLICT DO NOTHING",
+                turn_rows,
+                page_size=1000
+            )
+            # The migrated session keeps going; its old summary bookkeeping no longer applies.
+            cur.execute(
+                """
+                UPDATE symptom_chats SET chat_history = '[]', session_id = %s, summary = NULL, summarized_upto = 0
+                WHERE user_id = ANY(%s)
+                """,
+                (LEGACY_SESSION_ID, [row[0] for row in rows])
+            )
+    return len(rows), len(turn_rows)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    total_chats = total_turns = 0
+    while True:
+        chats, turns = migrate_batch(args.batch_size)
+        if not chats:
+            break
+        total_chats += chats
+        total_turns += turns
+        logging.info(f"Migrated {total_chats} chats ({total_turns} turns) so far.")
+    logging.info(f"Done: {total_chats} chats, {total_turns} turns.")
+
+if __name__ == "__main__":
+    main()
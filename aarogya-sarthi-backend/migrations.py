@@ -0,0 +1,360 @@
+"""
+Versioned schema migrations for the bot's PostgreSQL tables, and a check that its queries use indexes.
+
+Each migration runs in its own transaction, under an advisory lock so two deploys cannot apply
+the same one twice, and is recorded in schema_migrations. The first ones use IF NOT EXISTS, so a
+database whose tables were created by hand is adopted as it is and only the missing pieces are added.
+
+    python migrations.py migrate [--to VERSION]     apply pending migrations (all by default)
+    python migrations.py status                     list migrations and whether they are applied
+    python migrations.py check [--rows 100000]      EXPLAIN every query in database.py
+
+`check` is meant for a local, migrated database: it seeds every table with --rows rows inside a
+transaction, runs each database.py function there with EXPLAIN in front of every statement, and
+rolls everything back. It exits with 1 if any plan contains a sequential scan, or if a function
+in database.py that talks to the database has no entry in QUERY_CHECKS.
+"""
+import sys
+import inspect
+import logging
+import argparse
+from datetime import date
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import extensions
+
+import database
+from location_data import STATES_AND_DISTRICTS
+
+logging.basicConfig(level=logging.INFO)
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every process that migrates this database.
+MIGRATION_LOCK_ID = 7262011
+
+# (version, name, SQL). Append new migrations; never edit one that has been applied somewhere.
+MIGRATIONS = [
+    (1, 'core tables', """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY, mobile_number TEXT NOT NULL, name TEXT, age INT, gender TEXT,
+            state TEXT, district TEXT, language TEXT
+        );
+        CREATE TABLE IF NOT EXISTS symptom_chats (user_id INT PRIMARY KEY, chat_history JSON);
+        CREATE TABLE IF NOT EXISTS user_alerts_seen (id SERIAL PRIMARY KEY, user_id INT NOT NULL, alert_id TEXT NOT NULL);
+    """),
+    (2, 'symptom chat sessions and turns', """
+        ALTER TABLE symptom_chats
+            ADD COLUMN IF NOT EXISTS session_id INT NOT NULL DEFAULT 1,
+            ADD COLUMN IF NOT EXISTS summary TEXT,
+            ADD COLUMN IF NOT EXISTS summarized_upto INT NOT NULL DEFAULT 0;
+        -- The primary key serves "latest turns of a session" as a backward index scan. Turn text is
+        -- not INCLUDEd: a long Gemini reply would exceed the btree tuple size limit.
+        CREATE TABLE IF NOT EXISTS symptom_chat_turns (
+            user_id INT NOT NULL, session_id INT NOT NULL, seq INT NOT NULL, role TEXT NOT NULL, text TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, session_id, seq)
+        );
+    """),
+    (3, 'alert translations and broadcast checkpoints', """
+        CREATE TABLE IF NOT EXISTS alert_translations (
+            alert_id TEXT NOT NULL, lang TEXT NOT NULL, title TEXT, summary TEXT, PRIMARY KEY (alert_id, lang)
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_checkpoints (
+            alert_id TEXT PRIMARY KEY, status TEXT NOT NULL, owner TEXT, last_user_id INT NOT NULL DEFAULT 0,
+            sent INT NOT NULL DEFAULT 0, failed INT NOT NULL DEFAULT 0, updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    (4, 'hot-path indexes', """
+        -- A number registered twice (add_user had no unique index to stop it) is merged into its newest
+        -- row, the profile the user entered last: older rows' seen alerts move to it, and their chats go.
+        CREATE TEMP TABLE duplicate_users ON COMMIT DROP AS
+        SELECT id AS old_id, keep_id, mobile_number FROM (
+            SELECT id, mobile_number, max(id) OVER (PARTITION BY mobile_number) AS keep_id FROM users
+        ) numbered WHERE id <> keep_id;
+        DO $$ BEGIN
+            IF EXISTS (SELECT 1 FROM duplicate_users) THEN
+                RAISE NOTICE 'Merging % duplicate user row(s) for % mobile number(s) into the newest row of each',
+                    (SELECT count(*) FROM duplicate_users), (SELECT count(DISTINCT mobile_number) FROM duplicate_users);
+            END IF;
+        END $$;
+        UPDATE user_alerts_seen s SET user_id = d.keep_id FROM duplicate_users d WHERE s.user_id = d.old_id;
+        DELETE FROM symptom_chat_turns t USING duplicate_users d WHERE t.user_id = d.old_id;
+        DELETE FROM symptom_chats c USING duplicate_users d WHERE c.user_id = d.old_id;
+        DELETE FROM users u USING duplicate_users d WHERE u.id = d.old_id;
+
+        -- get_user runs on every message, and the imports upsert ON CONFLICT (mobile_number). The
+        -- name is the one a UNIQUE column constraint gets, so an existing constraint is kept.
+        CREATE UNIQUE INDEX IF NOT EXISTS users_mobile_number_key ON users (mobile_number);
+        CREATE UNIQUE INDEX IF NOT EXISTS symptom_chats_pkey ON symptom_chats (user_id);
+
+        -- mark_alert_as_seen's ON CONFLICT DO NOTHING only de-duplicates against a unique index.
+        DELETE FROM user_alerts_seen a USING user_alerts_seen b
+        WHERE a.user_id = b.user_id AND a.alert_id = b.alert_id AND a.id > b.id;
+        CREATE UNIQUE INDEX IF NOT EXISTS user_alerts_seen_user_alert_key ON user_alerts_seen (user_id, alert_id);
+
+        -- Broadcast batches: keyset pages of the users in a state or district, answered from the index.
+        CREATE INDEX IF NOT EXISTS users_state_id ON users (state, id) INCLUDE (mobile_number, language);
+        CREATE INDEX IF NOT EXISTS users_district_id ON users (district, id) INCLUDE (mobile_number, language);
+    """),
+    (5, 'monthly partitions for alert-seen rows and chat turns', """
+        -- The existing tables are attached as partitions as they are, so no rows are copied, but attaching
+        -- scans each of them once under an exclusive lock: apply this off-peak. retention.py then creates
+        -- the monthly partitions ahead of time and archives old ones.
+
+        -- user_alerts_seen is partitioned by the alert's publication month (see database.alert_month); the
+        -- rows from before carry the "undated" month and stay in user_alerts_seen_undated.
+        ALTER TABLE user_alerts_seen ADD COLUMN IF NOT EXISTS alert_month DATE NOT NULL DEFAULT '1970-01-01';
+        ALTER TABLE user_alerts_seen RENAME TO user_alerts_seen_undated;
+        ALTER INDEX user_alerts_seen_user_alert_key RENAME TO user_alerts_seen_undated_user_alert_key;
+        CREATE TABLE user_alerts_seen (
+            id INT NOT NULL DEFAULT nextval('user_alerts_seen_id_seq'), user_id INT NOT NULL, alert_id TEXT NOT NULL,
+            alert_month DATE NOT NULL DEFAULT '1970-01-01'
+        ) PARTITION BY RANGE (alert_month);
+        ALTER SEQUENCE user_alerts_seen_id_seq OWNED BY user_alerts_seen.id;
+        -- A unique index on a partitioned table must include the partition key, so this one alone lets a
+        -- pair be recorded in two months: the inserts in database.py skip pairs already present in any.
+        CREATE UNIQUE INDEX user_alerts_seen_user_alert_key ON user_alerts_seen (user_id, alert_id, alert_month);
+        ALTER TABLE user_alerts_seen ATTACH PARTITION user_alerts_seen_undated FOR VALUES FROM (MINVALUE) TO ('1970-02-01');
+        CREATE TABLE user_alerts_seen_default PARTITION OF user_alerts_seen DEFAULT;
+
+        -- symptom_chat_turns is partitioned by created_at; the old table covers everything up to next month.
+        ALTER TABLE symptom_chat_turns RENAME TO symptom_chat_turns_legacy;
+        ALTER TABLE symptom_chat_turns_legacy RENAME CONSTRAINT symptom_chat_turns_pkey TO symptom_chat_turns_legacy_pkey;
+        CREATE TABLE symptom_chat_turns (
+            user_id INT NOT NULL, session_id INT NOT NULL, seq INT NOT NULL, role TEXT NOT NULL, text TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            -- Includes the partition key, so seq is kept unique by append_chat_turns' lock on symptom_chats.
+            PRIMARY KEY (user_id, session_id, seq, created_at)
+        ) PARTITION BY RANGE (created_at);
+        DO $$ BEGIN
+            EXECUTE format(
+                'ALTER TABLE symptom_chat_turns ATTACH PARTITION symptom_chat_turns_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+                (date_trunc('month', now() AT TIME ZONE 'UTC') + interval '1 month') AT TIME ZONE 'UTC'
+            );
+        END $$;
+        CREATE TABLE symptom_chat_turns_default PARTITION OF symptom_chat_turns DEFAULT;
+    """),
+    (6, 'vaccination due dates', """
+        -- Without a date of birth, users.age is read as the age on age_recorded_on (existing rows get
+        -- today's date, as the day their age was last known).
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS date_of_birth DATE,
+            ADD COLUMN IF NOT EXISTS age_recorded_on DATE NOT NULL DEFAULT CURRENT_DATE;
+        CREATE TABLE IF NOT EXISTS vaccination_due (
+            user_id INT NOT NULL REFERENCES users (id) ON DELETE CASCADE, dose TEXT NOT NULL, due_on DATE NOT NULL,
+            reminded_at TIMESTAMPTZ,
+            PRIMARY KEY (user_id, dose)
+        );
+        -- The daily run reads one day's unsent reminders in user order; a sent reminder leaves the index.
+        CREATE INDEX IF NOT EXISTS vaccination_due_pending ON vaccination_due (due_on, user_id) INCLUDE (dose)
+            WHERE reminded_at IS NULL;
+    """),
+    (7, 'idempotent chat-turn appends', """
+        -- Turns appended by a queued symptom turn carry its turn_id, so a retried job does not store them twice.
+        ALTER TABLE symptom_chat_turns ADD COLUMN IF NOT EXISTS turn_id TEXT;
+    """),
+]
+
+
+# --- Migrating ---
+def connect():
+    return psycopg2.connect(**database._connect_kwargs())
+
+def applied_versions(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """
+    )
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+def pending_migrations(conn, target=None):
+    with conn, conn.cursor() as cur:
+        applied = applied_versions(cur)
+    return [m for m in MIGRATIONS if m[0] not in applied and (target is None or m[0] <= target)]
+
+def migrate(conn, target=None):
+    """Applies every pending migration up to `target`, one transaction each. Returns the versions applied."""
+    done = []
+    for version, name, sql in pending_migrations(conn, target):
+        with conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            # Another process may have applied it while we waited for the lock.
+            if version in applied_versions(cur):
+                continue
+            logging.info(f"Applying migration {version}: {name}")
+            cur.execute(sql)
+            # e.g. migration 4 reporting the duplicate users it merged.
+            for notice in conn.notices:
+                logging.warning(f"Migration {version}: {notice.strip()}")
+            del conn.notices[:]
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        done.append(version)
+    return done
+
+
+# --- Query Plan Check ---
+SEED_PREFIX = 'seed:'
+
+def seed(cur, rows):
+    """Fills every table with `rows` synthetic rows (inside the caller's transaction) and ANALYZEs them."""
+    states = list(STATES_AND_DISTRICTS)
+    districts = [district for state in states for district in STATES_AND_DISTRICTS[state]]
+    cur.execute(
+        """
+        INSERT INTO users (mobile_number, name, age, gender, state, district, language)
+        SELECT %s || g, 'Seed', 30, 'Female', (%s::text[])[1 + g %% %s], (%s::text[])[1 + g %% %s], 'en'
+        FROM generate_series(1, %s) g
+        """,
+        (SEED_PREFIX, states, len(states), districts, len(districts), rows)
+    )
+    cur.execute(
+        """
+        CREATE TEMP TABLE seed_users ON COMMIT DROP AS
+        SELECT id FROM users WHERE mobile_number LIKE %s
+        """,
+        (SEED_PREFIX + '%',)
+    )
+    cur.execute("INSERT INTO user_alerts_seen (user_id, alert_id) SELECT id, 'seed-alert-' || id % 50 FROM seed_users "
+                "ON CONFLICT DO NOTHING")
+    cur.execute("INSERT INTO symptom_chats (user_id) SELECT id FROM seed_users ON CONFLICT DO NOTHING")
+    cur.execute("INSERT INTO symptom_chat_turns (user_id, session_id, seq, role, text) "
+                "SELECT id, 1, 1, 'user', 'seed' FROM seed_users ON CONFLICT DO NOTHING")
+    cur.execute("INSERT INTO alert_translations (alert_id, lang, title, summary) "
+                "SELECT 'seed-alert-' || g, 'en', 'Seed', 'Seed' FROM generate_series(1, %s) g ON CONFLICT DO NOTHING", (rows,))
+    cur.execute("INSERT INTO broadcast_checkpoints (alert_id, status, owner) "
+                "SELECT 'seed-broadcast-' || g, 'done', 'seed' FROM generate_series(1, %s) g ON CONFLICT DO NOTHING", (rows,))
+    cur.execute("INSERT INTO vaccination_due (user_id, dose, due_on) "
+                "SELECT id, 'Seed dose', CURRENT_DATE + (id % 365)::int FROM seed_users ON CONFLICT DO NOTHING")
+    for table in ('users', 'user_alerts_seen', 'symptom_chats', 'symptom_chat_turns', 'alert_translations',
+                  'broadcast_checkpoints', 'vaccination_due'):
+        cur.execute(f"ANALYZE {table}")
+    cur.execute("SELECT id, mobile_number FROM users WHERE mobile_number = %s", (SEED_PREFIX + '1',))
+    return cur.fetchone()
+
+# One call per database.py function that runs queries, given the seeded user's (id, mobile).
+QUERY_CHECKS = {
+    'add_user': lambda uid, mobile: database.add_user(SEED_PREFIX + 'new', 'Seed', 30, 'Female', 'Odisha', 'Khordha', 'en'),
+    'get_user': lambda uid, mobile: database.get_user(mobile),
+    'delete_user': lambda uid, mobile: database.delete_user(SEED_PREFIX + 'new'),
+    'get_chat_session': lambda uid, mobile: database.get_chat_session(uid),
+    'get_recent_turns': lambda uid, mobile: database.get_recent_turns(uid, 1, 10),
+    'append_chat_turns': lambda uid, mobile: (
+        database.append_chat_turns(uid, 1, [('user', 'hi'), ('model', 'hello')]),
+        database.append_chat_turns(uid, 1, [('user', 'hi'), ('model', 'hello')], turn_id='seed-turn'),
+    ),
+    'save_chat_summary': lambda uid, mobile: database.save_chat_summary(uid, 1, 'summary', 1),
+    'start_chat_session': lambda uid, mobile: database.start_chat_session(uid),
+    'has_user_seen_alert': lambda uid, mobile: database.has_user_seen_alert(uid, 'seed-alert-1'),
+    'mark_alert_as_seen': lambda uid, mobile: database.mark_alert_as_seen(uid, 'seed-alert-new'),
+    'get_seen_alert_ids_for_users': lambda uid, mobile: database.get_seen_alert_ids_for_users([uid, uid + 1], ['seed-alert-1']),
+    'mark_alerts_as_seen': lambda uid, mobile: database.mark_alerts_as_seen([(uid, 'seed-alert-new'), (uid + 1, 'seed-alert-new')]),
+    'get_alert_translations': lambda uid, mobile: database.get_alert_translations(['seed-alert-1', 'seed-alert-2']),
+    'save_alert_translation': lambda uid, mobile: database.save_alert_translation('seed-alert-1', 'hi', 'Seed', 'Seed'),
+    'get_broadcast_targets': lambda uid, mobile: (
+        database.get_broadcast_targets('seed-alert-1', 0, 500),
+        database.get_broadcast_targets('seed-alert-1', 0, 500, districts=['Khordha']),
+    ),
+    'claim_broadcast': lambda uid, mobile: database.claim_broadcast('seed-broadcast-1', 'check', 60),
+    'save_broadcast_checkpoint': lambda uid, mobile: database.save_broadcast_checkpoint('seed-broadcast-1', 'check', 0, 0, 0),
+    'get_users_to_plan': lambda uid, mobile: database.get_users_to_plan(uid, 500),
+    'save_vaccination_due': lambda uid, mobile: database.save_vaccination_due([(uid, 'Seed dose', date.today()), (uid, 'MR-2', date.today())]),
+    'get_due_vaccinations': lambda uid, mobile: database.get_due_vaccinations(date.today(), 0, 500),
+    'mark_vaccinations_reminded': lambda uid, mobile: database.mark_vaccinations_reminded(date.today(), [uid, uid + 1]),
+}
+
+def query_functions():
+    """Names of the database.py functions that borrow a connection to run queries."""
+    return sorted(
+        name for name, fn in inspect.getmembers(database, inspect.isfunction)
+        if fn.__module__ == database.__name__ and name != 'get_db_connection'
+        and 'get_db_connection()' in inspect.getsource(fn)
+    )
+
+def seq_scans(plan):
+    """Yields the relation of every Seq Scan node in an EXPLAIN (FORMAT JSON) plan tree."""
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan.get('Relation Name')
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+class ExplainingCursor(extensions.cursor):
+    """Runs EXPLAIN before each statement (then the statement itself, so callers still get rows)."""
+    plans = None
+
+    def execute(self, query, vars=None):
+        text = query.decode() if isinstance(query, bytes) else query
+        if 'pg_notify' not in text:
+            super().execute('EXPLAIN (FORMAT JSON) ' + text, vars)
+            self.plans.append((' '.join(text.split()), self.fetchone()[0][0]['Plan']))
+        return super().execute(query, vars)
+
+@contextmanager
+def _borrowed(conn):
+    # Stands in for database.get_db_connection: same connection, no commit, so the seed survives.
+    yield conn
+
+def check(conn, rows):
+    """EXPLAINs every query in database.py against seeded tables. Returns a list of problems."""
+    problems = [f"{name}: no entry in QUERY_CHECKS" for name in query_functions() if name not in QUERY_CHECKS]
+    original = database.get_db_connection
+    try:
+        with conn.cursor() as cur:
+            uid, mobile = seed(cur, rows)
+        database.get_db_connection = lambda: _borrowed(conn)
+        # The user cache (and its NOTIFY listener) would answer get_user without a query.
+        database._user_cache.clear()
+        database._listener_pid = None
+        database._start_user_cache_listener = lambda: None
+        conn.cursor_factory = ExplainingCursor
+        for name, call in QUERY_CHECKS.items():
+            ExplainingCursor.plans = []
+            call(uid, mobile)
+            database._user_cache.clear()
+            for query, plan in ExplainingCursor.plans:
+                for relation in seq_scans(plan):
+                    problems.append(f"{name}: sequential scan on {relation} in: {query[:160]}")
+            logging.info(f"{name}: {len(ExplainingCursor.plans)} statement(s) checked")
+    finally:
+        database.get_db_connection = original
+        conn.cursor_factory = extensions.cursor
+        conn.rollback()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help="apply pending migrations")
+    migrate_parser.add_argument('--to', type=int, help="stop after this version")
+    commands.add_parser('status', help="list migrations")
+    check_parser = commands.add_parser('check', help="fail if a database.py query does a sequential scan")
+    check_parser.add_argument('--rows', type=int, default=100000, help="rows to seed into each table")
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        if args.command == 'migrate':
+            done = migrate(conn, args.to)
+            logging.info(f"Applied {len(done)} migration(s)." if done else "Nothing to apply.")
+        elif args.command == 'status':
+            pending = {m[0] for m in pending_migrations(conn)}
+            for version, name, _ in MIGRATIONS:
+                print(f"{version:4d}  {'pending' if version in pending else 'applied':8s} {name}")
+        else:
+            if pending_migrations(conn):
+                logging.error("The database has pending migrations; run `python migrations.py migrate` first.")
+                sys.exit(1)
+            problems = check(conn, args.rows)
+            for problem in problems:
+                logging.error(problem)
+            if problems:
+                sys.exit(1)
+            logging.info(f"Every query uses an index at {args.rows} rows per table.")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
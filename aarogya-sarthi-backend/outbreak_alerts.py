@@ -1,84 +1,379 @@
+import os
+import json
+import time
+import random
 import logging
+import tempfile
+import threading
 import requests
 import xml.etree.ElementTree as ET
-from gemini_services import get_gemini_response
-from database import has_user_seen_alert, mark_alert_as_seen
+from email.utils import parsedate_to_datetime
+from gemini_services import get_gemini_client, GeminiError
+from cache import SingleFlight, TTLCache
+from metrics import stage_timer
+from database import get_seen_alert_ids, mark_alert_as_seen, get_alert_translations, save_alert_translation
 
 # --- BUG FIX: Use the new, correct URL for the WHO RSS feed ---
-WHO_RSS_URL = "https://www.who.int/rss-feeds/emergencies-disease-outbreak-news-english.xml"
+WHO_RSS_URL = os.environ.get("WHO_RSS_URL", "https://www.who.int/rss-feeds/emergencies-disease-outbreak-news-english.xml")
+
+# --- Feed Cache Configuration ---
+# How long a fetched feed is considered fresh before the refresher polls WHO again.
+WHO_FEED_TTL = int(os.environ.get("WHO_FEED_TTL", 900))
+# Optional file shared by all workers on a host, so only one of them hits WHO per TTL.
+WHO_FEED_CACHE_FILE = os.environ.get("WHO_FEED_CACHE_FILE")
+
+_feed_lock = threading.Lock()
+_feed = {'alerts': [], 'etag': None, 'last_modified': None, 'fetched_at': 0.0}
+_refresher_pid = None
+
+def _parse_feed(content):
+    """Parses the WHO RSS XML and keeps only the alerts relevant to India."""
+    root = ET.fromstring(content)
+    alerts = []
+    for item in root.findall('.//channel/item'):
+        title = item.find('title').text
+        description = item.find('description').text
+        alert_id = item.find('guid').text 
+        published = None
+        if item.find('pubDate') is not None:
+            try:
+                published = parsedate_to_datetime(item.find('pubDate').text).timestamp()
+            except (TypeError, ValueError):
+                pass
+        
+        if 'india' in title.lower() or 'india' in description.lower():
+            alerts.append({'id': alert_id, 'title': title, 'summary': description, 'published': published})
+    return alerts
+
+def _load_shared_feed():
+    """Adopts the shared cache file if another worker refreshed it more recently than we did."""
+    if not WHO_FEED_CACHE_FILE:
+        return
+    try:
+        with open(WHO_FEED_CACHE_FILE, encoding='utf-8') as f:
+            shared = json.load(f)
+    except (OSError, ValueError):
+        return
+    with _feed_lock:
+        if shared.get('fetched_at', 0) > _feed['fetched_at']:
+            _feed.update(shared)
+
+def _save_shared_feed(snapshot):
+    if not WHO_FEED_CACHE_FILE:
+        return
+    try:
+        directory = os.path.dirname(os.path.abspath(WHO_FEED_CACHE_FILE))
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, delete=False) as f:
+            json.dump(snapshot, f)
+        os.replace(f.name, WHO_FEED_CACHE_FILE)
+    except OSError as e:
+        logging.error(f"Could not write WHO feed cache file: {e}")
+
+def refresh_feed():
+    """
+    Re-fetches the WHO feed if the cached copy is older than WHO_FEED_TTL.
+    Uses a conditional GET so an unchanged feed costs a 304 and no parsing.
+    On failure the previous alerts are kept and served stale.
+    """
+    _load_shared_feed()
+    with _feed_lock:
+        if time.time() - _feed['fetched_at'] < WHO_FEED_TTL:
+            return
+        headers = {}
+        if _feed['etag']:
+            headers['If-None-Match'] = _feed['etag']
+        if _feed['last_modified']:
+            headers['If-Modified-Since'] = _feed['last_modified']
+
+    try:
+        with stage_timer('who_feed') as timer:
+            response = requests.get(WHO_RSS_URL, headers=headers, timeout=10)
+            timer.outcome = str(response.status_code)
+        if response.status_code == 304:
+            update = {}
+        else:
+            response.raise_for_status()
+            update = {
+                'alerts': _parse_feed(response.content),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+    except Exception as e:
+        logging.error(f"Failed to fetch or parse WHO RSS feed, serving cached alerts: {e}")
+        return
+
+    with _feed_lock:
+        _feed.update(update)
+        _feed['fetched_at'] = time.time()
+        snapshot = dict(_feed)
+    _save_shared_feed(snapshot)
+
+_new_alert_callbacks = []
+_known_alert_ids = set()
+
+def on_new_alert(callback):
+    """
+    Registers `callback(alert)` to run in the refresher whenever an alert first enters the feed.
+    Alerts already in the feed when the process starts do not count as new, so a restart does not
+    re-announce them; users still get those on their next message.
+    """
+    _new_alert_callbacks.append(callback)
+    return callback
+
+def _refresh_loop():
+    first = True
+    while True:
+        refresh_feed()
+        live_alerts = fetch_live_alerts()
+        live_ids = {alert['id'] for alert in live_alerts}
+        # Per-alert state lives only as long as the alert is in the feed.
+        seen_alerts.retain(live_ids)
+        retain_translations(live_ids)
+        _known_alert_ids.intersection_update(live_ids)
+        warm_translations(live_alerts)
+        for alert in live_alerts:
+            if alert['id'] in _known_alert_ids:
+                continue
+            _known_alert_ids.add(alert['id'])
+            if first:
+                continue
+            for callback in _new_alert_callbacks:
+                try:
+                    callback(alert)
+                except Exception as e:
+                    logging.error(f"New-alert callback failed for alert {alert['id']}: {e}")
+        # Only a feed that was actually fetched seeds the known alerts; an empty cold cache does not.
+        first = first and not get_feed_snapshot()[1]
+        # Jitter keeps workers that started together from polling WHO in lockstep.
+        time.sleep(WHO_FEED_TTL * random.uniform(0.9, 1.1))
+
+def start_feed_refresher():
+    """Starts the background thread that keeps the feed cache warm (once per process)."""
+    global _refresher_pid
+    with _feed_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+    threading.Thread(target=_refresh_loop, name="who-feed-refresher", daemon=True).start()
 
 def fetch_live_alerts():
-    """Fetches and parses the WHO RSS feed to find alerts relevant to India."""
+    """
+    Returns the India-relevant alerts from the cached WHO feed.
+    Never touches the network: the background refresher keeps the cache up to date.
+    """
+    start_feed_refresher()
+    with _feed_lock:
+        if _feed['fetched_at']:
+            return _feed['alerts']
+    # Cold start: another worker may already have filled the shared cache file.
+    _load_shared_feed()
+    with _feed_lock:
+        return _feed['alerts']
+
+def get_feed_snapshot():
+    """Returns (alerts, fetched_at) from the cache; fetched_at is 0 if the feed has never been fetched."""
+    _load_shared_feed()
+    with _feed_lock:
+        return _feed['alerts'], _feed['fetched_at']
+
+# --- Seen-Alert Index ---
+class SeenAlertIndex:
+    """
+    Remembers which users are known to have seen each alert, as one bitmap per alert
+    indexed by user id (about 125 KB per alert for a million users).
+    A set bit is authoritative; a clear bit only means "not known yet" and is confirmed
+    against the database, so the common "already seen everything" case needs no query.
+    """
+
+    def __init__(self):
+        self._bitmaps = {}
+        self._lock = threading.Lock()
+
+    def _is_marked(self, alert_id, user_id):
+        bitmap = self._bitmaps.get(alert_id)
+        byte = user_id >> 3
+        return bitmap is not None and byte < len(bitmap) and bool(bitmap[byte] & (1 << (user_id & 7)))
+
+    def mark(self, user_id, alert_ids):
+        byte, bit = user_id >> 3, 1 << (user_id & 7)
+        with self._lock:
+            for alert_id in alert_ids:
+                bitmap = self._bitmaps.setdefault(alert_id, bytearray())
+                if byte >= len(bitmap):
+                    bitmap.extend(bytes(byte + 1 - len(bitmap)))
+                bitmap[byte] |= bit
+
+    def unseen(self, user_id, alerts):
+        """Returns the alerts the user has not seen yet, in feed order."""
+        with self._lock:
+            candidates = [alert for alert in alerts if not self._is_marked(alert['id'], user_id)]
+        if not candidates:
+            return []
+        seen = get_seen_alert_ids(user_id, [alert['id'] for alert in candidates])
+        if seen:
+            self.mark(user_id, seen)
+        return [alert for alert in candidates if alert['id'] not in seen]
+
+    def retain(self, alert_ids):
+        """Drops the bitmaps of alerts that have left the feed."""
+        with self._lock:
+            for alert_id in list(self._bitmaps):
+                if alert_id not in alert_ids:
+                    del self._bitmaps[alert_id]
+
+seen_alerts = SeenAlertIndex()
+
+# --- Alert Translation Cache ---
+SUPPORTED_LANGS = ('en', 'hi', 'od', 'kui', 'sa')
+# After a failed translation, the English text is served for this long before Gemini is asked again.
+ALERT_TRANSLATION_RETRY_TTL = float(os.environ.get("ALERT_TRANSLATION_RETRY_TTL", 60))
+
+_translations = {}      # (alert_id, lang) -> (title, summary)
+_translations_lock = threading.Lock()
+_translation_flights = SingleFlight()
+_warmed_alert_ids = set()
+_untranslated = TTLCache(1000, ALERT_TRANSLATION_RETRY_TTL)     # (alert_id, lang) -> English (title, summary)
+
+def _translate_alert(alert, lang):
+    """Asks Gemini for the translation. Returns None if the reply could not be parsed."""
+    alert_title_en = alert['title']
+    alert_summary_en = alert['summary']
+    translation_prompt = (
+        f"Translate the following health alert title and summary into the language with code '{lang}'. "
+        f"Respond ONLY with the translation, formatted exactly like this:\n"
+        f"Title: [translated title]\n"
+        f"Summary: [translated summary]\n\n"
+        f"---START---\n"
+        f"Title: {alert_title_en}\n"
+        f"Summary: {alert_summary_en}\n"
+        f"---END---"
+    )
+    translation_system_prompt = "You are an expert translator specializing in public health announcements."
+    chat_history = [{"role": "user", "parts": [{"text": translation_prompt}]}]
+    try:
+        translated_text = get_gemini_client().generate(chat_history, translation_system_prompt)
+    except GeminiError as e:
+        logging.error(f"Could not translate alert {alert['id']} into '{lang}': {e}")
+        return None
     try:
-        response = requests.get(WHO_RSS_URL, timeout=10)
-        response.raise_for_status()
-        root = ET.fromstring(response.content)
-        alerts = []
-        for item in root.findall('.//channel/item'):
-            title = item.find('title').text
-            description = item.find('description').text
-            alert_id = item.find('guid').text 
-            
-            if 'india' in title.lower() or 'india' in description.lower():
-                alerts.append({'id': alert_id, 'title': title, 'summary': description})
-        return alerts
+        lines = translated_text.strip().split('\n')
+        translated_title = lines[0].replace('Title: ', '').strip()
+        translated_summary = lines[1].replace('Summary: ', '').strip()
+        return translated_title, translated_summary
+    except IndexError:
+        logging.error(f"Could not parse Gemini translation: {translated_text}")
+        return None
+
+def get_alert_translation(alert, lang):
+    """
+    Returns (title, summary) of an alert in the given language.
+    Translations are looked up in memory, then in the alert_translations table, and only
+    translated by Gemini when neither has them. Concurrent callers asking for the same
+    (alert, lang) share a single in-flight translation.
+    """
+    if lang == 'en':
+        return alert['title'], alert['summary']
+    key = (alert['id'], lang)
+
+    with _translations_lock:
+        if key in _translations:
+            return _translations[key]
+    fallback = _untranslated.get(key)
+    if fallback is not None:
+        return fallback
+    return _translation_flights.do(key, lambda: _load_or_translate(alert, lang))
+
+def _load_or_translate(alert, lang):
+    key = (alert['id'], lang)
+    translation = get_alert_translations([alert['id']]).get(key)
+    if translation is None:
+        translation = _translate_alert(alert, lang)
+        if translation is not None:
+            save_alert_translation(alert['id'], lang, *translation)
+    if translation is None:
+        # Untranslatable this time: show English, without asking Gemini again on every request for a while.
+        fallback = (alert['title'], alert['summary'])
+        _untranslated.set(key, fallback)
+        return fallback
+    with _translations_lock:
+        _translations[key] = translation
+    return translation
+
+def warm_translations(alerts):
+    """Translates newly seen alerts into every supported language ahead of any user request."""
+    new_alerts = [alert for alert in alerts if alert['id'] not in _warmed_alert_ids]
+    if not new_alerts:
+        return
+    try:
+        stored = get_alert_translations([alert['id'] for alert in new_alerts])
     except Exception as e:
-        logging.error(f"Failed to fetch or parse WHO RSS feed: {e}")
-        return []
+        logging.error(f"Could not load stored alert translations: {e}")
+        return
+    with _translations_lock:
+        _translations.update(stored)
 
-def get_outbreak_alert(user, lang):
-    """Checks for new alerts the user hasn't seen and returns a translated message."""
+    for alert in new_alerts:
+        complete = True
+        for lang in SUPPORTED_LANGS:
+            if lang == 'en' or (alert['id'], lang) in stored:
+                continue
+            try:
+                get_alert_translation(alert, lang)
+            except Exception as e:
+                logging.error(f"Could not pre-translate alert {alert['id']} into '{lang}': {e}")
+            with _translations_lock:
+                complete = complete and (alert['id'], lang) in _translations
+        if complete:
+            _warmed_alert_ids.add(alert['id'])
+
+def retain_translations(alert_ids):
+    """Drops the in-memory translations of alerts that have left the feed; the table keeps them."""
+    with _translations_lock:
+        for key in [key for key in _translations if key[0] not in alert_ids]:
+            del _translations[key]
+        _warmed_alert_ids.intersection_update(alert_ids)
+
+def format_alert_message(alert, lang):
+    """Renders the user-facing message for an alert in one language."""
+    translated_title, translated_summary = get_alert_translation(alert, lang)
+
+    intro = "⚠️ Health Alert:"
+    if lang == 'hi': intro = "⚠️ स्वास्थ्य चेतावनी:"
+    elif lang == 'od': intro = "⚠️ ସ୍ୱାସ୍ଥ୍ୟ ସତର୍କତା:"
+    # Add intros for kui and sa
+
+    return f"*{intro}*\n\n*{translated_title}*\n{translated_summary}"
+
+def find_outbreak_alert(user, lang):
+    """
+    Returns (alert, message) for the first live alert the user has not seen, or None.
+    The alert is not marked as seen: call mark_outbreak_alert_seen once the message has been sent.
+    """
     try:
-        user_id = user[0]
         live_alerts = fetch_live_alerts()
         if not live_alerts:
             return None
-
-        new_alert = None
-        for alert in live_alerts:
-            if not has_user_seen_alert(user_id, alert['id']):
-                new_alert = alert
-                break 
-        if not new_alert:
+        unseen = seen_alerts.unseen(user.id, live_alerts)
+        if not unseen:
             return None
-
-        alert_title_en = new_alert['title']
-        alert_summary_en = new_alert['summary']
-        
-        translated_title = alert_title_en
-        translated_summary = alert_summary_en
-
-        if lang != 'en':
-            translation_prompt = (
-                f"Translate the following health alert title and summary into the language with code '{lang}'. "
-                f"Respond ONLY with the translation, formatted exactly like this:\n"
-                f"Title: [translated title]\n"
-                f"Summary: [translated summary]\n\n"
-                f"---START---\n"
-                f"Title: {alert_title_en}\n"
-                f"Summary: {alert_summary_en}\n"
-                f"---END---"
-            )
-            translation_system_prompt = "You are an expert translator specializing in public health announcements."
-            chat_history = [{"role": "user", "parts": [{"text": translation_prompt}]}]
-            translated_text = get_gemini_response(chat_history, translation_system_prompt)
-            try:
-                lines = translated_text.strip().split('\n')
-                translated_title = lines[0].replace('Title: ', '').strip()
-                translated_summary = lines[1].replace('Summary: ', '').strip()
-            except IndexError:
-                logging.error(f"Could not parse Gemini translation: {translated_text}")
-        
-        mark_alert_as_seen(user_id, new_alert['id'])
-        
-        intro = "⚠️ Health Alert:"
-        if lang == 'hi': intro = "⚠️ स्वास्थ्य चेतावनी:"
-        elif lang == 'od': intro = "⚠️ ସ୍ୱାସ୍ଥ୍ୟ ସତର୍କତା:"
-        # Add intros for kui and sa
-        
-        return f"*{intro}*\n\n*{translated_title}*\n{translated_summary}"
-
+        return unseen[0], format_alert_message(unseen[0], lang)
     except Exception as e:
-        logging.error(f"Could not check for outbreak alerts for user {user[0]}: {e}")
+        logging.error(f"Could not check for outbreak alerts for user {user.id}: {e}")
         return None
 
+def mark_outbreak_alert_seen(user_id, alert):
+    """Records that the user has been sent `alert` ({'id', 'published'} is enough)."""
+    try:
+        mark_alert_as_seen(user_id, alert['id'], alert.get('published'))
+        seen_alerts.mark(user_id, [alert['id']])
+    except Exception as e:
+        logging.error(f"Could not mark alert {alert['id']} as seen for user {user_id}: {e}")
+
+def get_outbreak_alert(user, lang):
+    """Checks for new alerts the user hasn't seen and returns a translated message, marking it as seen."""
+    found = find_outbreak_alert(user, lang)
+    if found is None:
+        return None
+    alert, message = found
+    mark_outbreak_alert_seen(user.id, alert)
+    return message
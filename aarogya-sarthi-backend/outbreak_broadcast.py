@@ -0,0 +1,225 @@
+"""
+Proactive outbreak broadcasts: pushes a newly published alert to every affected user through
+the Twilio REST API instead of waiting for them to message the bot.
+
+Targets are read in keyset-paginated batches, each language variant is rendered once, sends are
+rate limited to BROADCAST_RATE per second, and every batch is recorded in user_alerts_seen in one
+bulk insert followed by a checkpoint, so a restarted (or taken-over) broadcast resumes after the
+last completed batch. Users whose send failed are not marked as seen and get the alert the next
+time they message the bot.
+
+    python outbreak_broadcast.py send <alert_id> [--state Odisha] [--district Khordha]
+    python outbreak_broadcast.py bench [--users 1000000] [--rate 0] [--latency 0]
+"""
+import os
+import re
+import time
+import socket
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from database import get_broadcast_targets, claim_broadcast, save_broadcast_checkpoint, mark_alerts_as_seen
+from location_data import STATES_AND_DISTRICTS
+from outbreak_alerts import fetch_live_alerts, format_alert_message, seen_alerts, SUPPORTED_LANGS
+from rate_limit import TokenBucket
+from twilio_sender import get_sender, FakeTwilioSender
+
+load_dotenv()
+
+# --- Broadcast Configuration ---
+OUTBREAK_BROADCAST = os.environ.get("OUTBREAK_BROADCAST", "").lower() in ('1', 'true', 'yes')
+# Messages per second across all send workers; 0 means unlimited.
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 50))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 1000))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", 8))
+# A claimed broadcast whose owner has not checkpointed for this long is taken over.
+BROADCAST_LEASE = int(os.environ.get("BROADCAST_LEASE", 300))
+# Alerts published longer ago than this (or without a date) are left to the pull path.
+BROADCAST_MAX_AGE_DAYS = float(os.environ.get("BROADCAST_MAX_AGE_DAYS", 3))
+
+
+# --- Broadcast Stores ---
+class PostgresBroadcastStore:
+    """Targets, seen-marks and checkpoints in the bot's database."""
+
+    def claim(self, alert_id, owner):
+        return claim_broadcast(alert_id, owner, BROADCAST_LEASE)
+
+    def targets(self, alert_id, after_id, limit, states=None, districts=None):
+        return get_broadcast_targets(alert_id, after_id, limit, states, districts)
+
+    def mark_seen(self, pairs, published=None):
+        mark_alerts_as_seen(pairs, published)
+
+    def checkpoint(self, alert_id, owner, last_user_id, sent, failed, status='running'):
+        return save_broadcast_checkpoint(alert_id, owner, last_user_id, sent, failed, status)
+
+
+class DryRunBroadcastStore:
+    """Synthetic users 1..`users` (languages cycled) with in-memory bookkeeping, for benchmarks."""
+
+    def __init__(self, users):
+        self.users = users
+        self.marked = 0
+        self.checkpoints = 0
+
+    def claim(self, alert_id, owner):
+        return {'last_user_id': 0, 'sent': 0, 'failed': 0}
+
+    def targets(self, alert_id, after_id, limit, states=None, districts=None):
+        last = min(after_id + limit, self.users)
+        return [
+            (user_id, f"whatsapp:+91{7000000000 + user_id}", SUPPORTED_LANGS[user_id % len(SUPPORTED_LANGS)])
+            for user_id in range(after_id + 1, last + 1)
+        ]
+
+    def mark_seen(self, pairs, published=None):
+        self.marked += len(pairs)
+
+    def checkpoint(self, alert_id, owner, last_user_id, sent, failed, status='running'):
+        self.checkpoints += 1
+        return True
+
+
+# --- Broadcast Engine ---
+def affected_areas(alert):
+    """Returns (states, districts) named in the alert text; both empty means the whole country."""
+    text = f"{alert['title']} {alert['summary']}"
+    def named(place):
+        return re.search(rf"\b{re.escape(place)}\b", text, re.IGNORECASE) is not None
+    states = [state for state in STATES_AND_DISTRICTS if named(state)]
+    districts = [
+        district for state_districts in STATES_AND_DISTRICTS.values()
+        for district in state_districts if named(district)
+    ]
+    return states, districts
+
+def broadcast_alert(alert, store=None, sender=None, rate=BROADCAST_RATE, batch_size=BROADCAST_BATCH_SIZE,
+                    workers=BROADCAST_WORKERS, states=None, districts=None, render=format_alert_message):
+    """
+    Sends `alert` to every target user who has not seen it. Returns a stats dict, or None if
+    another process owns this broadcast or it has already finished.
+    """
+    store = store or PostgresBroadcastStore()
+    sender = sender or get_sender()
+    alert_id = alert['id']
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    checkpoint = store.claim(alert_id, owner)
+    if checkpoint is None:
+        logging.info(f"Broadcast of alert {alert_id} is finished or owned elsewhere; skipping.")
+        return None
+
+    last_user_id, sent, failed = checkpoint['last_user_id'], checkpoint['sent'], checkpoint['failed']
+    bucket = TokenBucket(rate)
+    rendered = {}
+    batches = 0
+    finished = False
+    started = time.monotonic()
+
+    def send(row):
+        user_id, mobile_number, lang = row
+        bucket.acquire()
+        try:
+            sender.send(mobile_number, rendered[lang])
+            return user_id
+        except Exception as e:
+            logging.error(f"Broadcast of alert {alert_id} to user {user_id} failed: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = store.targets(alert_id, last_user_id, batch_size, states, districts)
+            if not rows:
+                finished = True
+                break
+            rows = [(user_id, mobile, lang if lang in SUPPORTED_LANGS else 'en') for user_id, mobile, lang in rows]
+            for lang in {row[2] for row in rows} - rendered.keys():
+                rendered[lang] = render(alert, lang)
+
+            delivered = [user_id for user_id in executor.map(send, rows) if user_id is not None]
+            store.mark_seen([(user_id, alert_id) for user_id in delivered], alert.get('published'))
+            for user_id in delivered:
+                seen_alerts.mark(user_id, [alert_id])
+
+            last_user_id = rows[-1][0]
+            sent += len(delivered)
+            failed += len(rows) - len(delivered)
+            batches += 1
+            if not store.checkpoint(alert_id, owner, last_user_id, sent, failed):
+                logging.warning(f"Lost the claim on broadcast of alert {alert_id} after user {last_user_id}; stopping.")
+                break
+    if finished:
+        store.checkpoint(alert_id, owner, last_user_id, sent, failed, status='done')
+
+    elapsed = time.monotonic() - started
+    stats = {
+        'alert_id': alert_id, 'sent': sent, 'failed': failed, 'batches': batches,
+        'elapsed': round(elapsed, 3), 'messages_per_second': round(sent / elapsed, 1) if elapsed else None,
+    }
+    logging.info(f"Broadcast of alert {alert_id}: {stats}")
+    return stats
+
+def is_recent(alert, max_age_days=BROADCAST_MAX_AGE_DAYS):
+    published = alert.get('published')
+    return published is not None and time.time() - published <= max_age_days * 86400
+
+def broadcast_in_background(alert):
+    """New-alert hook: broadcasts a recent alert to its affected areas on a daemon thread."""
+    if not is_recent(alert):
+        return
+    states, districts = affected_areas(alert)
+    def run():
+        try:
+            broadcast_alert(alert, states=states, districts=districts)
+        except Exception as e:
+            logging.error(f"Broadcast of alert {alert['id']} failed: {e}")
+    threading.Thread(target=run, daemon=True).start()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    send_parser = subcommands.add_parser('send', help="broadcast one alert from the live feed")
+    send_parser.add_argument('alert_id')
+    send_parser.add_argument('--state', action='append', help="limit to users in this state (repeatable)")
+    send_parser.add_argument('--district', action='append', help="limit to users in this district (repeatable)")
+    bench_parser = subcommands.add_parser('bench', help="dry-run fan-out to synthetic users with a fake sender")
+    bench_parser.add_argument('--users', type=int, default=1000000)
+    bench_parser.add_argument('--latency', type=float, default=0.0, help="simulated seconds per Twilio call")
+    for sub in (send_parser, bench_parser):
+        sub.add_argument('--rate', type=float, default=None, help="messages per second, 0 for unlimited")
+        sub.add_argument('--batch-size', type=int, default=BROADCAST_BATCH_SIZE)
+        sub.add_argument('--workers', type=int, default=BROADCAST_WORKERS)
+    args = parser.parse_args()
+
+    if args.command == 'send':
+        alert = next((alert for alert in fetch_live_alerts() if alert['id'] == args.alert_id), None)
+        if alert is None:
+            from outbreak_alerts import refresh_feed
+            refresh_feed()
+            alert = next((alert for alert in fetch_live_alerts() if alert['id'] == args.alert_id), None)
+        if alert is None:
+            parser.error(f"alert {args.alert_id} is not in the live feed")
+        if args.state or args.district:
+            states, districts = args.state, args.district
+        else:
+            states, districts = affected_areas(alert)
+        broadcast_alert(alert, rate=BROADCAST_RATE if args.rate is None else args.rate,
+                        batch_size=args.batch_size, workers=args.workers, states=states, districts=districts)
+    else:
+        alert = {'id': 'bench', 'title': "Benchmark alert", 'summary': "Dry-run broadcast."}
+        store = DryRunBroadcastStore(args.users)
+        sender = FakeTwilioSender(latency=args.latency, record=False)
+        stats = broadcast_alert(alert, store=store, sender=sender, rate=0 if args.rate is None else args.rate,
+                                batch_size=args.batch_size, workers=args.workers,
+                                # Untranslated text, so the benchmark measures fan-out rather than Gemini.
+                                render=lambda alert, lang: f"*{alert['title']}*\n{alert['summary']}")
+        print(f"{stats['sent']} sent, {stats['failed']} failed, {store.marked} marked seen, "
+              f"{stats['batches']} batches in {stats['elapsed']}s ({stats['messages_per_second']} msg/s)")
+
+if __name__ == "__main__":
+    main()
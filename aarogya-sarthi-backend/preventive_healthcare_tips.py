@@ -1,32 +1,34 @@
+"""
+Seasonal, district-aware preventive healthcare tips.
+
+Tips live in tips_data.json, keyed by season and optionally by state and district (monsoon
+malaria advice for Koraput, heat-stroke advice for Khordha, ...). The file is loaded once into an
+index and the final message for every (season, state, district, language) is rendered at startup,
+so serving a tip is a single dict lookup. A background thread reloads the file when it changes.
+"""
+import os
+import json
+import time
 import datetime
 import logging
+import threading
+from dotenv import load_dotenv
+
+from location_data import STATES_AND_DISTRICTS
+
+load_dotenv()
+
+# --- Tips Configuration ---
+TIPS_DATA_PATH = os.environ.get(
+    "TIPS_DATA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tips_data.json")
+)
+# Seconds between checks of the data file's modification time; 0 disables hot reload.
+TIPS_RELOAD_INTERVAL = float(os.environ.get("TIPS_RELOAD_INTERVAL", 30))
+
+DEFAULT_INTRO = "Here's a health tip for your area:"
+DEFAULT_HEADER = "{title} for {district}"
+ANY = None      # an entry without a state or district applies to all of them
 
-TIPS_BY_SEASON = {
-    'summer': {
-        'title_en': "Summer Health Tips", 'title_hi': "गर्मी के स्वास्थ्य सुझाव", 'title_od': "ଗ୍ରୀଷ୍ମ ସ୍ୱାସ୍ଥ୍ୟ ପରାମର୍ଶ", 'title_kui': "ଗ୍ରୀଷ୍ମ ଦିନର ସ୍ୱାସ୍ଥ୍ୟ କଥା", 'title_sa': "ᱥᱤᱛᱩᱝ ᱫᱤᱱ ᱨᱮᱭᱟᱜ ᱦᱚᱲᱢᱚ ᱥᱟᱵᱽଧାନ",
-        'tip_en': "Stay hydrated by drinking plenty of water. Avoid direct sun between 12 PM and 4 PM. Eat light, seasonal fruits.",
-        'tip_hi': "खूब पानी पीकर हाइड्रेटेड रहें। दोपहर 12 बजे से 4 बजे के बीच सीधी धूप से बचें। हल्के, मौसमी फल खाएं।",
-        'tip_od': "ପର୍ଯ୍ୟାପ୍ତ ପାଣି ପିଇ ହାଇଡ୍ରେଟେଡ୍ ରୁହନ୍ତୁ। ଦିନ 12ଟାରୁ 4ଟା ମଧ୍ୟରେ ସିଧାସଳଖ ସୂର୍ଯ୍ୟ କିରଣରୁ ଦୂରେଇ ରୁହନ୍ତୁ। ହାଲୁକା, ଋତୁକାଳୀନ ଫଳ ଖାଆନ୍ତୁ।",
-        'tip_kui': "ବେଶୀ ପାଣି ପିଅନ୍ତୁ। ଦିନ 12ଟାରୁ 4ଟା ଭିତରେ ଖରାକୁ ଯାଆନ୍ତୁ ନାହିଁ। ହାଲୁକା ଫଳ ଖାଆନ୍ତୁ।",
-        'tip_sa': "ᱟᱹᱰᱤ ᱜᱟᱱ ᱫᱟᱜ ᱧᱩᱭ ᱯᱮ᱾ ᱑᱒ ᱵᱟᱡᱟ ᱠᱷᱚᱱ ᱔ ᱵᱟᱡᱟ ᱫᱷᱟᱹବᱤᱡ ᱥᱤଧା ᱥᱤᱛᱩᱝ ᱨᱮ ᱟᱞᱚᱯᱮ ᱚḍੋᱠ-ᱟ᱾ ᱦᱟᱞᱠᱟ,  मौसम ᱨᱮᱭᱟᱜ ᱯᱷᱚળ ᱡᱚᱢ ᱯᱮ।"
-    },
-    'monsoon': {
-        'title_en': "Monsoon Health Tips", 'title_hi': "मानसून के स्वास्थ्य सुझाव", 'title_od': "ମୌସୁମୀ ସ୍ୱାସ୍ଥ୍ୟ ପରାମର୍ଶ", 'title_kui': "ବର୍ଷା ଦିନର ସ୍ୱାସ୍ଥ୍ୟ କଥା", 'title_sa': "ᱡᱟᱹᱯᱩᱫ ᱫᱤᱱ ᱨᱮᱭᱟᱜ ᱦᱚᱲᱢᱚ ᱥᱟᱵᱽଧାନ",
-        'tip_en': "Protect yourself from mosquitoes to prevent Dengue and Malaria. Drink boiled water and avoid street food to prevent water-borne diseases.",
-        'tip_hi': "डेंगू और मलेरिया से बचने के लिए खुद को मच्छरों से बचाएं। पानी से होने वाली बीमारियों से बचने के लिए उबला हुआ पानी पिएं और स्ट्रीट फूड से बचें।",
-        'tip_od': "ଡେଙ୍ଗୁ ଓ ମ୍ୟାଲେରିଆରୁ ରକ୍ଷା ପାଇବା ପାଇଁ ନିଜକୁ ମଶାଙ୍କଠାରୁ ଦୂରେଇ ରଖନ୍ତୁ। ପାଣିଜନିତ ରୋଗରୁ ବଞ୍ଚିବା ପାଇଁ ଫୁଟା ପାଣି ପିଅନ୍ତୁ ଏବଂ ରାସ୍ତା କଡ଼ ଖାଦ୍ୟରୁ ଦୂରେଇ ରୁହନ୍ତୁ।",
-        'tip_kui': "ମଶାଙ୍କଠାରୁ ନିଜକୁ ବଞ୍ଚାନ୍ତୁ। ଫୁଟା ପାଣି ପିଅନ୍ତୁ ଏବଂ ବାହାର ଖାଦ୍ୟ ଖାଆନ୍ତୁ ନାହିଁ।",
-        'tip_sa': "ᱥᱤᱠᱤᱲᱤ ᱠᱷᱚᱱ ᱵᱟᱧ୍ଚᱟᱣ ᱞᱟᱹᱜᱤᱫ নিজেকে বাঁচান। 끓ানো পানি পান করুন এবং রাস্তার খাবার এড়িয়ে চলুন।"
-    },
-    'winter': {
-        'title_en': "Winter Health Tips", 'title_hi': "सर्दियों के स्वास्थ्य सुझाव", 'title_od': "ଶୀତଦିନର ସ୍ୱାସ୍ଥ୍ୟ ପରାମର୍ଶ", 'title_kui': "ଶୀତ ଦିନର ସ୍ୱାସ୍ଥ୍ୟ କଥା", 'title_sa': "ᱨᱟᱵᱟᱝ ᱫᱤᱱ ᱨᱮᱭᱟᱜ ᱦᱚᱲᱢᱚ ᱥᱟᱵᱽଧାନ",
-        'tip_en': "Keep warm to avoid colds and flu. Eat foods rich in Vitamin C like oranges to boost your immunity. Keep your skin moisturized.",
-        'tip_hi': "सर्दी और फ्लू से बचने के लिए गर्म रहें। अपनी रोग प्रतिरोधक क्षमता को बढ़ाने के लिए संतरे जैसे विटामिन सी से भरपूर खाद्य पदार्थ खाएं। अपनी त्वचा को नमीयुक्त रखें।",
-        'tip_od': "ଥଣ୍ଡା ଏବଂ ଫ୍ଲୁରୁ ରକ୍ଷା ପାଇବା ପାଇଁ ନିଜକୁ ଉଷୁମ ରଖନ୍ତୁ। ଆପଣଙ୍କ ରୋଗ ପ୍ରତିରୋଧକ ଶକ୍ତି ବଢ଼ାଇବା ପାଇଁ କମଳା ପରି ଭିଟାମିନ୍ ସିରେ ଭରପୂର ଖାଦ୍ୟ ଖାଆନ୍ତୁ। ଆପଣଙ୍କ ତ୍ୱଚାକୁ ଆର୍ଦ୍ର ରଖନ୍ତୁ।",
-        'tip_kui': "ଥଣ୍ଡାରୁ ବଞ୍ଚିବା ପାଇଁ ଗରମରେ ରୁହନ୍ତୁ। କମଳା ପରି ଭିଟାମିନ୍ ସି ଥିବା ଖାଦ୍ୟ ଖାଆନ୍ତୁ। ଚମକୁ ଶୁଖିଲା ରଖନ୍ତୁ ନାହିଁ।",
-        'tip_sa': "춥 ও ফ্লু থেকে বাঁচতে গরম থাকুন। কমলালেবুর মতো ভিটামিন সি সমৃদ্ধ খাবার খেয়ে আপনার রোগ প্রতিরোধ ক্ষমতা বাড়ান। আপনার ত্বককে ময়েশ্চারাইজড রাখুন।"
-    }
-}
 
 def get_current_season():
     """Determines the current season in India based on the month."""
@@ -35,26 +37,146 @@ def get_current_season():
     elif month in [6, 7, 8, 9]: return 'monsoon'
     else: return 'winter'
 
+_season = (None, 0.0)   # (season, epoch time at which it must be recomputed)
+
+def _cached_season():
+    """get_current_season(), recomputed only when a new month starts."""
+    global _season
+    season, valid_until = _season
+    now = time.time()
+    if now < valid_until:
+        return season
+    today = datetime.date.today()
+    next_month = datetime.datetime(today.year + today.month // 12, today.month % 12 + 1, 1)
+    season = get_current_season()
+    _season = (season, next_month.timestamp())
+    return season
+
+
+# --- Tips Index ---
+def load_tips(path):
+    """Reads the data file into {(season, state, district): {'title': {...}, 'tip': {...}}}."""
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)['tips']
+    index = {}
+    for entry in entries:
+        state = entry.get('state', ANY)
+        for district in entry.get('districts') or [ANY]:
+            index[(entry['season'], state, district)] = {'title': entry['title'], 'tip': entry['tip']}
+    return index
+
+def render_tip(index, templates, season, state, district, lang):
+    """
+    Builds the tip message from the most specific entry in `lang` (else in English) for the district.
+    `templates` maps each language to its (intro line, "{title} for {district}" header) pair.
+    """
+    entries = [index[key] for key in ((season, state, district), (season, state, ANY), (season, ANY, ANY)) if key in index]
+    entry = next((e for e in entries if lang in e['tip']), None) or next((e for e in entries if 'en' in e['tip']), None)
+    if entry is None:
+        return None
+    title = entry['title'].get(lang, entry['title']['en'])
+    tip = entry['tip'].get(lang, entry['tip']['en'])
+    intro, header = templates.get(lang, (DEFAULT_INTRO, DEFAULT_HEADER))
+    return f"*{intro}*\n\n*{header.format(title=title, district=district)}*\n- {tip}"
+
+def _templates(texts):
+    return texts.get('preventive_tips_intro', DEFAULT_INTRO), texts.get('preventive_tips_header', DEFAULT_HEADER)
+
+
+class TipsEngine:
+    """The loaded index plus every pre-rendered message, swapped as a whole on reload."""
+
+    def __init__(self, path=TIPS_DATA_PATH, states_and_districts=STATES_AND_DISTRICTS):
+        self.path = path
+        self.states_and_districts = states_and_districts
+        self.templates = {}
+        self._index = {}
+        self._rendered = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._reloader_pid = None
+
+    def load(self):
+        """(Re)reads the data file and re-renders; on a bad file the previous tips stay in place."""
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+                index = load_tips(self.path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.error(f"Could not load preventive tips from {self.path}: {e}")
+                return False
+            rendered = self._render_all(index, self.templates) if self.templates else {}
+            self._index, self._rendered, self._mtime = index, rendered, mtime
+        logging.info(f"Loaded {len(index)} preventive tip entries ({len(rendered)} messages pre-rendered)")
+        return True
+
+    def prerender(self, messages):
+        """Renders every tip in every language of MESSAGES, with that language's intro and header."""
+        templates = {lang: _templates(texts) for lang, texts in messages.items() if isinstance(texts, dict)}
+        with self._lock:
+            self.templates = templates
+        return self.load()
+
+    def _render_all(self, index, templates):
+        seasons = {season for season, _, _ in index}
+        return {
+            (season, state, district, lang): render_tip(index, templates, season, state, district, lang)
+            for season in seasons
+            for state, districts in self.states_and_districts.items()
+            for district in districts
+            for lang in templates
+        }
+
+    def get(self, season, state, district, lang, messages):
+        if self._mtime is None:
+            self.load()
+        key = (season, state, district, lang)
+        message = self._rendered.get(key)
+        if message is None and key not in self._rendered:
+            # A district or language outside the pre-rendered set: render once and keep it. Under the
+            # lock, so a reload cannot swap in new tips between the render and the insert.
+            with self._lock:
+                if key in self._rendered:
+                    return self._rendered[key]
+                templates = self.templates or {lang: _templates(messages[lang])}
+                message = self._rendered[key] = render_tip(self._index, templates, season, state, district, lang)
+        return message
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logging.error(f"Could not check preventive tips file {self.path}: {e}")
+            return False
+        return mtime != self._mtime and self.load()
+
+    def _reload_loop(self):
+        while True:
+            time.sleep(TIPS_RELOAD_INTERVAL)
+            self.reload_if_changed()
+
+    def start_reloader(self):
+        """Starts the thread that watches the data file (once per process)."""
+        if not TIPS_RELOAD_INTERVAL:
+            return
+        with self._lock:
+            if self._reloader_pid == os.getpid():
+                return
+            self._reloader_pid = os.getpid()
+        threading.Thread(target=self._reload_loop, name="tips-reloader", daemon=True).start()
+
+
+tips_engine = TipsEngine()
+
+def prepare_tips(MESSAGES):
+    """Loads and pre-renders all tips, and starts watching the data file for changes."""
+    tips_engine.prerender(MESSAGES)
+    tips_engine.start_reloader()
+
 def get_preventive_tips(user, lang, MESSAGES):
     """Generates a personalized preventive healthcare tip message."""
     try:
-        season = get_current_season()
-        # --- BUG FIX: Use correct index for district ---
-        user_district = user[6]  # id=0, mobile=1, name=2, age=3, gender=4, state=5, district=6
-        
-        seasonal_tips = TIPS_BY_SEASON.get(season)
-        if not seasonal_tips:
-            return None
-
-        title = seasonal_tips.get(f'title_{lang}', seasonal_tips['title_en'])
-        tip = seasonal_tips.get(f'tip_{lang}', seasonal_tips['tip_en'])
-        
-        intro = MESSAGES[lang].get('preventive_tips_intro', "Here's a health tip for your area:")
-        
-        message = f"*{intro}*\n\n*{title} for {user_district}*\n- {tip}"
-        return message
-
+        return tips_engine.get(_cached_season(), user.state, user.district, lang, MESSAGES)
     except (IndexError, KeyError) as e:
         logging.error(f"Could not generate preventive tips for user: {e}")
         return None
-
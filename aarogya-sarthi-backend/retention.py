@@ -0,0 +1,246 @@
+"""
+Monthly partition upkeep, retention and archival for user_alerts_seen and symptom_chat_turns.
+
+Both tables are range-partitioned by month (migration 5 in migrations.py). A run:
+
+  1. creates the partitions for the coming months (and for the months of alerts in the WHO feed),
+  2. detaches every partition that ended before the retention cutoff, writes it to a gzipped CSV
+     in ARCHIVE_DIR and drops it (alert partitions are kept while one of their alerts is still live),
+  3. deletes, in small keyset batches, the seen-rows of alerts that are no longer in the WHO feed.
+
+Every statement runs in its own short transaction with a lock_timeout, so a run that meets a busy
+table skips the step (and tries again next time) instead of queueing traffic behind its lock, and
+the batched deletes stop when --max-seconds is used up. Partitions are detached before they are
+archived, and a detached partition left behind by an interrupted run is archived by the next one.
+
+    python retention.py [--dry-run] [--max-seconds 600]
+"""
+import os
+import re
+import gzip
+import time
+import logging
+import argparse
+from datetime import date, datetime, timezone
+from collections import Counter
+import psycopg2
+from psycopg2 import errors
+from dotenv import load_dotenv
+
+import database
+from outbreak_alerts import refresh_feed, get_feed_snapshot
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+# --- Retention Configuration ---
+CHAT_RETENTION_MONTHS = int(os.environ.get("CHAT_RETENTION_MONTHS", 6))
+ALERT_SEEN_RETENTION_MONTHS = int(os.environ.get("ALERT_SEEN_RETENTION_MONTHS", 3))
+PARTITION_PREMAKE_MONTHS = int(os.environ.get("PARTITION_PREMAKE_MONTHS", 3))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 5000))
+# Pause between delete batches, so autovacuum and replication keep up.
+RETENTION_PAUSE = float(os.environ.get("RETENTION_PAUSE", 0.2))
+RETENTION_LOCK_TIMEOUT = os.environ.get("RETENTION_LOCK_TIMEOUT", "2s")
+# Seen-rows are only deleted against a feed fetched at most this many seconds ago.
+RETENTION_FEED_MAX_AGE = float(os.environ.get("RETENTION_FEED_MAX_AGE", 3600))
+
+# Partitioned table -> partition key column.
+PARTITIONED_TABLES = {'user_alerts_seen': 'alert_month', 'symptom_chat_turns': 'created_at'}
+
+
+def month_start(day, offset=0):
+    """The first day of the month `offset` months after the month of `day`."""
+    months = day.year * 12 + day.month - 1 + offset
+    return date(months // 12, months % 12 + 1, 1)
+
+def partition_bounds(cur, table):
+    """Returns [(partition, lower, upper)] with date bounds; None for MINVALUE/MAXVALUE, and DEFAULT omitted."""
+    cur.execute(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass ORDER BY c.relname
+        """,
+        (table,)
+    )
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+        if match:
+            lower, upper = (date.fromisoformat(value.strip("'")[:10]) if value.startswith("'") else None
+                            for value in match.groups())
+            partitions.append((name, lower, upper))
+    return partitions
+
+
+class RetentionJob:
+    """One run over both tables; `report` counts partitions, rows and bytes reclaimed per table."""
+
+    def __init__(self, conn, dry_run=False, max_seconds=600, batch_size=RETENTION_BATCH_SIZE, archive_dir=ARCHIVE_DIR):
+        self.conn = conn
+        self.dry_run = dry_run
+        self.deadline = time.monotonic() + max_seconds
+        self.batch_size = batch_size
+        self.archive_dir = archive_dir
+        self.report = {table: Counter() for table in PARTITIONED_TABLES}
+        self.today = datetime.now(timezone.utc).date()
+        with conn, conn.cursor() as cur:
+            cur.execute("SELECT set_config('lock_timeout', %s, false)", (RETENTION_LOCK_TIMEOUT,))
+            # Month bounds are UTC midnights, whatever the server's default time zone.
+            cur.execute("SELECT set_config('TimeZone', 'UTC', false)")
+
+    def _execute(self, sql, params=None):
+        """Runs one statement in its own transaction; returns False if a lock could not be had in time."""
+        try:
+            with self.conn, self.conn.cursor() as cur:
+                cur.execute(sql, params)
+            return True
+        except errors.LockNotAvailable:
+            logging.warning(f"Lock timeout, skipped for this run: {sql.split(chr(10))[0][:120]}")
+            return False
+
+    # --- Partition upkeep ---
+    def create_partitions(self, table, months):
+        for month in sorted(set(months)):
+            name = f"{table}_{month:%Y_%m}"
+            with self.conn, self.conn.cursor() as cur:
+                cur.execute("SELECT to_regclass(%s)", (name,))
+                exists = cur.fetchone()[0] is not None
+            if exists or self.dry_run:
+                continue
+            try:
+                if self._execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                                 (month, month_start(month, 1))):
+                    logging.info(f"Created partition {name}")
+            except errors.InvalidObjectDefinition:
+                pass    # the month is still covered by the legacy partition
+            except errors.CheckViolation:
+                # Rows for this month already went to the default partition; they stay there.
+                logging.warning(f"Not creating {name}: the default partition already holds rows for that month.")
+
+    # --- Archival ---
+    def archive_partition(self, partition, table):
+        """Copies a detached partition into a gzipped CSV, then drops it."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{partition}.csv.gz")
+        with self.conn, self.conn.cursor() as cur:
+            cur.execute("SELECT pg_total_relation_size(%s::regclass), count(*) FROM " + partition, (partition,))
+            size, rows = cur.fetchone()
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8', newline='') as f:
+                cur.copy_expert(f"COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+        os.replace(path + '.tmp', path)
+        if self._execute(f"DROP TABLE {partition}"):
+            self.report[table].update(partitions=1, partition_rows=rows, partition_bytes=size,
+                                      archive_bytes=os.path.getsize(path))
+            logging.info(f"Archived {partition} ({rows} rows, {size} bytes) to {path}")
+
+    def detached_leftovers(self, table):
+        """Partitions an interrupted run detached but did not archive yet."""
+        with self.conn, self.conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = current_schema() AND c.relkind = 'r' AND NOT c.relispartition
+                  AND c.relname ~ %s
+                """,
+                (rf"^{table}_(\d{{4}}_\d{{2}}|legacy|undated)$",)
+            )
+            return [row[0] for row in cur.fetchall()]
+
+    def expire_partitions(self, table, cutoff, live_alert_ids=None):
+        """Detaches and archives the partitions of `table` that ended on or before `cutoff`."""
+        for partition in self.detached_leftovers(table):
+            if not self.dry_run:
+                self.archive_partition(partition, table)
+        with self.conn, self.conn.cursor() as cur:
+            partitions = partition_bounds(cur, table)
+        for partition, _, upper in partitions:
+            if upper is None or upper > cutoff:
+                continue
+            if live_alert_ids is not None:
+                with self.conn, self.conn.cursor() as cur:
+                    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {partition} WHERE alert_id = ANY(%s))", (live_alert_ids,))
+                    if cur.fetchone()[0]:
+                        continue
+            if self.dry_run:
+                logging.info(f"Would archive {partition}")
+                self.report[table].update(partitions=1)
+                continue
+            if self._execute(f"ALTER TABLE {table} DETACH PARTITION {partition}"):
+                self.archive_partition(partition, table)
+
+    # --- Seen-rows of retired alerts ---
+    def drop_retired_seen_rows(self, live_alert_ids):
+        """Deletes the seen-rows of alerts not in `live_alert_ids`, in keyset batches by user_id."""
+        if self.dry_run:
+            with self.conn, self.conn.cursor() as cur:
+                cur.execute("SELECT count(*), COALESCE(sum(pg_column_size(s.*)), 0) FROM user_alerts_seen s "
+                            "WHERE alert_id <> ALL(%s)", (live_alert_ids,))
+                rows, size = cur.fetchone()
+            self.report['user_alerts_seen'].update(retired_rows=rows, retired_bytes=size)
+            return
+        after_user = 0
+        while time.monotonic() < self.deadline:
+            with self.conn, self.conn.cursor() as cur:
+                cur.execute(
+                    """
+                    WITH retired AS (
+                        SELECT user_id, alert_id, alert_month FROM user_alerts_seen
+                        WHERE user_id >= %s AND alert_id <> ALL(%s) ORDER BY user_id LIMIT %s
+                    ), gone AS (
+                        DELETE FROM user_alerts_seen s USING retired r
+                        WHERE s.user_id = r.user_id AND s.alert_id = r.alert_id AND s.alert_month = r.alert_month
+                        RETURNING s.user_id, pg_column_size(s.*) AS size
+                    )
+                    SELECT count(*), COALESCE(sum(size), 0), max(user_id) FROM gone
+                    """,
+                    (after_user, live_alert_ids, self.batch_size)
+                )
+                rows, size, last_user = cur.fetchone()
+            if not rows:
+                return
+            self.report['user_alerts_seen'].update(retired_rows=rows, retired_bytes=size)
+            after_user = last_user
+            time.sleep(RETENTION_PAUSE)
+        logging.warning("Out of time; the remaining retired seen-rows are left for the next run.")
+
+    def run(self):
+        refresh_feed()
+        alerts, fetched_at = get_feed_snapshot()
+        feed_is_fresh = fetched_at and time.time() - fetched_at <= RETENTION_FEED_MAX_AGE
+        live_alert_ids = [alert['id'] for alert in alerts] if feed_is_fresh else None
+
+        upcoming = [month_start(self.today, offset) for offset in range(PARTITION_PREMAKE_MONTHS + 1)]
+        alert_months = [database.alert_month(alert.get('published')) for alert in alerts]
+        self.create_partitions('user_alerts_seen', upcoming + [m for m in alert_months if m != database.UNDATED_ALERT_MONTH])
+        self.create_partitions('symptom_chat_turns', upcoming)
+
+        self.expire_partitions('symptom_chat_turns', month_start(self.today, -CHAT_RETENTION_MONTHS))
+        if live_alert_ids is None:
+            logging.warning("No fresh copy of the WHO feed; alert-seen rows are left alone this run.")
+            return self.report
+        self.expire_partitions('user_alerts_seen', month_start(self.today, -ALERT_SEEN_RETENTION_MONTHS), live_alert_ids)
+        self.drop_retired_seen_rows(live_alert_ids)
+        return self.report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help="report what would be reclaimed without changing anything")
+    parser.add_argument('--max-seconds', type=float, default=600, help="time budget for the batched deletes")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**database._connect_kwargs())
+    try:
+        report = RetentionJob(conn, dry_run=args.dry_run, max_seconds=args.max_seconds).run()
+    finally:
+        conn.close()
+    for table, counts in report.items():
+        logging.info(
+            f"{table}: {counts['partitions']} partition(s) archived ({counts['partition_rows']} rows, "
+            f"{counts['partition_bytes']} bytes on disk, {counts['archive_bytes']} bytes archived); "
+            f"{counts['retired_rows']} seen-rows of retired alerts dropped ({counts['retired_bytes']} bytes)"
+        )
+
+if __name__ == "__main__":
+    main()
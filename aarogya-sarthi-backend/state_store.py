@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from cache import TTLCache
+
+load_dotenv()
+
+# --- State Store Configuration ---
+# 'memory' keeps state inside this process; 'sqlite' shares it between all workers on the host.
+STATE_STORE_BACKEND = os.environ.get("STATE_STORE_BACKEND", "memory")
+STATE_STORE_PATH = os.environ.get("STATE_STORE_PATH", "conversation_state.db")
+# Abandoned conversations are forgotten after this many seconds of inactivity.
+STATE_TTL = int(os.environ.get("STATE_TTL", 24 * 3600))
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES", 100000))
+# A number's lock lapses this many seconds after its holder stops renewing it (every third of the
+# lease, for as long as the turn runs): how long a crashed worker can hold up that number.
+STATE_LOCK_LEASE = float(os.environ.get("STATE_LOCK_LEASE", 30))
+
+_LOCK_STRIPES = 64
+
+
+class StateStore:
+    """
+    Keeps each WhatsApp number's conversation state (a small JSON-able dict).
+
+    Use `session(number)` for read-modify-write: it holds the number's lock while the
+    webhook runs, so two concurrent messages from one number cannot clobber each other.
+    """
+
+    def __init__(self):
+        self._stripes = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+    def get(self, number):
+        raise NotImplementedError
+
+    def set(self, number, state):
+        raise NotImplementedError
+
+    def delete(self, number):
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, number):
+        with self._stripes[hash(number) % _LOCK_STRIPES]:
+            yield
+
+    @contextmanager
+    def session(self, number):
+        """Yields the number's state dict and saves it (or deletes it, if emptied) afterwards."""
+        with self.lock(number):
+            state = self.get(number)
+            yield state
+            if state:
+                self.set(number, state)
+            else:
+                self.delete(number)
+
+
+class MemoryStateStore(StateStore):
+    """Process-local store with TTL expiry and LRU eviction. Only valid for a single worker."""
+
+    def __init__(self, ttl=STATE_TTL, maxsize=STATE_MAX_ENTRIES):
+        super().__init__()
+        self._cache = TTLCache(maxsize, ttl)
+
+    def get(self, number):
+        state = self._cache.get(number)
+        return dict(state) if state else {}
+
+    def set(self, number, state):
+        self._cache.set(number, dict(state))
+
+    def delete(self, number):
+        self._cache.pop(number)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Store shared by every worker process on the host through a WAL-mode SQLite file.
+    Per-number locks are leases in the same file, so they also hold across processes. A
+    heartbeat thread renews the leases this process holds, so a slow turn keeps its lock.
+    """
+
+    def __init__(self, path=STATE_STORE_PATH, ttl=STATE_TTL, lease=STATE_LOCK_LEASE):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self._local = threading.local()
+        self._last_purge = 0.0
+        self._held = {}         # owner -> number, for every lease this process holds
+        self._held_lock = threading.Lock()
+        self._heartbeat_pid = None
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_state ("
+            "number TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_locks ("
+            "number TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, number):
+        row = self._conn().execute(
+            "SELECT state FROM conversation_state WHERE number = ? AND expires_at > ?", (number, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def set(self, number, state):
+        self._conn().execute(
+            "INSERT INTO conversation_state (number, state, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(number) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at",
+            (number, json.dumps(state), time.time() + self.ttl)
+        )
+        self._purge_expired()
+
+    def delete(self, number):
+        self._conn().execute("DELETE FROM conversation_state WHERE number = ?", (number,))
+
+    def _purge_expired(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        conn = self._conn()
+        conn.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,))
+        conn.execute("DELETE FROM conversation_locks WHERE expires_at <= ?", (now,))
+
+    @contextmanager
+    def lock(self, number):
+        owner = uuid.uuid4().hex
+        conn = self._conn()
+        # The in-process stripe avoids busy-waiting on SQLite for threads of the same worker.
+        with super().lock(number):
+            while True:
+                now = time.time()
+                cur = conn.execute(
+                    "INSERT INTO conversation_locks (number, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(number) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE conversation_locks.expires_at <= ?",
+                    (number, owner, now + self.lease, now)
+                )
+                if cur.rowcount == 1:
+                    break
+                time.sleep(0.01)
+            with self._held_lock:
+                self._held[owner] = number
+            self._start_heartbeat()
+            try:
+                yield
+            finally:
+                with self._held_lock:
+                    del self._held[owner]
+                conn.execute("DELETE FROM conversation_locks WHERE number = ? AND owner = ?", (number, owner))
+
+    def _start_heartbeat(self):
+        with self._held_lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat_pid = os.getpid()
+        threading.Thread(target=self._heartbeat_loop, name="state-lock-heartbeat", daemon=True).start()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.lease / 3)
+            with self._held_lock:
+                held = [(number, owner) for owner, number in self._held.items()]
+            if not held:
+                continue
+            expires_at = time.time() + self.lease
+            try:
+                self._conn().executemany(
+                    "UPDATE conversation_locks SET expires_at = ? WHERE number = ? AND owner = ?",
+                    [(expires_at, number, owner) for number, owner in held]
+                )
+            except sqlite3.Error as e:
+                logging.error(f"Could not renew {len(held)} conversation lock(s): {e}")
+
+
+def create_state_store():
+    """Builds the store selected by STATE_STORE_BACKEND."""
+    if STATE_STORE_BACKEND == 'sqlite':
+        return SQLiteStateStore()
+    if STATE_STORE_BACKEND != 'memory':
+        logging.warning(f"Unknown STATE_STORE_BACKEND '{STATE_STORE_BACKEND}', falling back to memory.")
+    return MemoryStateStore()
@@ -0,0 +1,163 @@
+"""
+Early delivery of streamed Gemini replies as WhatsApp message segments.
+
+split_segments() cuts the text pieces streamed by Gemini at sentence ends into WhatsApp-sized
+segments: the first one as soon as a sentence of STREAM_FIRST_SEGMENT_CHARS is complete, later
+ones once STREAM_SEGMENT_CHARS have built up (so a long reply does not arrive as a flurry of
+messages), never longer than Twilio's 1600-character limit. SegmentSender sends each segment
+through the Twilio REST API as soon as it is cut.
+
+Time to the first message is recorded as stage 'reply.first_message', separately from the whole
+generation ('gemini.stream') and from Gemini's first token ('gemini.first_token').
+
+    python streaming.py bench [--turns 20] [--interval 0.05]
+"""
+import os
+import re
+import time
+import logging
+import argparse
+from dotenv import load_dotenv
+
+from metrics import observe_stage
+from twilio_sender import get_sender
+
+load_dotenv()
+
+# --- Segmenting Configuration ---
+STREAM_FIRST_SEGMENT_CHARS = int(os.environ.get("STREAM_FIRST_SEGMENT_CHARS", 120))
+STREAM_SEGMENT_CHARS = int(os.environ.get("STREAM_SEGMENT_CHARS", 600))
+# Twilio rejects WhatsApp message bodies longer than this.
+STREAM_SEGMENT_MAX_CHARS = int(os.environ.get("STREAM_SEGMENT_MAX_CHARS", 1600))
+
+# A sentence end (Latin, Devanagari/Odia danda, Ol Chiki mucaad) followed by whitespace, or a blank line.
+SENTENCE_END = re.compile(r'[.!?।॥᱾]["\')\]*_]*(?=\s)|\n\s*\n')
+
+
+def _cut_point(buffer, min_len, max_len):
+    """Returns where to cut `buffer`, or None to wait for more text."""
+    for match in SENTENCE_END.finditer(buffer):
+        if match.end() >= min_len:
+            if match.end() <= max_len:
+                return match.end()
+            break
+    if len(buffer) < max_len:
+        return None
+    # No sentence ends in time: the last one before the limit will do, else the last space.
+    ends = [match.end() for match in SENTENCE_END.finditer(buffer, 0, max_len)]
+    if ends:
+        return ends[-1]
+    space = buffer.rfind(' ', 0, max_len)
+    return space if space > 0 else max_len
+
+def split_segments(pieces, first_len=STREAM_FIRST_SEGMENT_CHARS, min_len=STREAM_SEGMENT_CHARS,
+                   max_len=STREAM_SEGMENT_MAX_CHARS):
+    """Yields message segments cut from the text `pieces` as soon as each one is complete."""
+    buffer = ''
+    first = True
+    for piece in pieces:
+        buffer += piece
+        while True:
+            cut = _cut_point(buffer, first_len if first else min_len, max_len)
+            if cut is None:
+                break
+            segment, buffer = buffer[:cut].strip(), buffer[cut:]
+            if segment:
+                first = False
+                yield segment
+    if buffer.strip():
+        yield buffer.strip()
+
+def stream_reply(pieces, send_segment):
+    """Passes a streamed reply to send_segment() one segment at a time; returns the whole text."""
+    parts = []
+
+    def collect():
+        for piece in pieces:
+            parts.append(piece)
+            yield piece
+
+    for segment in split_segments(collect()):
+        send_segment(segment)
+    return ''.join(parts)
+
+
+class SegmentSender:
+    """
+    Sends reply segments to `to` through the Twilio REST API as they are produced. Once a send
+    fails, that segment and every later one are kept in `unsent`, for the caller to deliver instead.
+    """
+
+    def __init__(self, to, sender=None):
+        self.to = to
+        self.sender = sender or get_sender()
+        self.start = time.monotonic()
+        self.sent = 0
+        self.unsent = []
+
+    def __call__(self, segment):
+        if not self.unsent:
+            try:
+                self.sender.send(self.to, segment)
+            except Exception as e:
+                logging.error(f"Could not send a reply segment to {self.to}, the rest goes with the reply: {e}")
+            else:
+                if not self.sent:
+                    observe_stage('reply.first_message', time.monotonic() - self.start)
+                self.sent += 1
+                return
+        self.unsent.append(segment)
+
+
+# --- Benchmark ---
+def bench(turns, interval):
+    """
+    Times the first segment and the full reply over a local streaming stub. Without streaming the
+    user waits for the full reply before seeing anything.
+    """
+    from loadtest.stubs import GeminiStub
+    from loadtest.report import Recorder
+    from gemini_services import GeminiClient
+    from twilio_sender import FakeTwilioSender
+
+    stub = GeminiStub().start()
+    stub.stream_interval = interval
+    base = f"{stub.base_url}/models/stub"
+    client = GeminiClient(api_key='stub-key', url=f"{base}:generateContent", stream_url=f"{base}:streamGenerateContent?alt=sse",
+                          max_qps=0)
+    contents = [{"role": "user", "parts": [{"text": "I have had a fever for two days."}]}]
+    recorder = Recorder()
+    segments = 0
+    try:
+        for _ in range(turns):
+            sender = FakeTwilioSender()
+            first = []
+            start = time.monotonic()
+
+            def send(segment):
+                if not first:
+                    first.append(time.monotonic() - start)
+                sender.send('whatsapp:+910000000000', segment)
+
+            stream_reply(client.generate_stream(contents, "You are a health assistant."), send)
+            recorder.record('streamed.full_reply', time.monotonic() - start)
+            recorder.record('streamed.first_message', first[0])
+            segments += len(sender.sent)
+    finally:
+        stub.stop()
+    for series, summary in recorder.summary().items():
+        print(f"{series:24s} p50 {summary['p50_ms']:8.1f} ms   p95 {summary['p95_ms']:8.1f} ms")
+    print(f"{segments / turns:.1f} segments per reply")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    bench_parser = commands.add_parser('bench', help="time to first message against time to the full reply")
+    bench_parser.add_argument('--turns', type=int, default=20)
+    bench_parser.add_argument('--interval', type=float, default=0.05, help="stub delay between streamed pieces (s)")
+    args = parser.parse_args()
+    bench(args.turns, args.interval)
+
+if __name__ == "__main__":
+    main()
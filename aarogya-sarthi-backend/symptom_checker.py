@@ -1,33 +1,158 @@
+import os
+import json
 import logging
-from gemini_services import get_gemini_response
-from database import get_chat_history, save_chat_history
+import threading
+from gemini_services import get_gemini_response, stream_gemini_response, get_gemini_client
+from database import get_chat_session, get_recent_turns, append_chat_turns, save_chat_summary, start_chat_session
+from job_queue import job_handler, enqueue
+from streaming import stream_reply, split_segments
 
 # This is the "persona" for the AI. It sets the rules for the conversation.
 GEMINI_SYSTEM_PROMPT = """You are Aarogya Sarthi, a helpful AI health assistant. Your role is to understand a user's health symptoms in their chosen language (English, Hindi, Odia, Kui, or Santali) and ask 2-3 clarifying questions to better understand the situation. Respond ONLY in the language of the user's last message. Based on the conversation, provide potential next steps or things to look out for. IMPORTANT: You are not a doctor. Do not provide a diagnosis. Always end your response by strongly advising the user to consult a real medical professional for an accurate diagnosis and treatment."""
 
-def handle_symptom_checker(user, state_info, incoming_msg, lang, MESSAGES):
+SUMMARY_SYSTEM_PROMPT = """You maintain a short running summary of a health assistant's conversation with a user. Keep every symptom, duration, severity, age-relevant detail and advice already given. Write at most 120 words, in English, as plain notes."""
+
+# --- Context Window Configuration ---
+# Number of most recent messages (user and model) kept word for word when older ones are summarised.
+CONTEXT_RECENT_TURNS = int(os.environ.get("SYMPTOM_CONTEXT_TURNS", 6))
+# Rough token budget for the verbatim messages; the oldest are dropped first when over it.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("SYMPTOM_CONTEXT_TOKENS", 1500))
+# Older messages are folded into the summary once this many have piled up outside the window.
+SUMMARY_BATCH_TURNS = int(os.environ.get("SYMPTOM_SUMMARY_BATCH", 6))
+
+_stats_lock = threading.Lock()
+_context_stats = {
+    'requests': 0,
+    'payload_bytes_total': 0,
+    'prompt_tokens_total': 0,
+    'turns_loaded_total': 0,
+    'summaries': 0,
+}
+
+def estimate_tokens(text):
+    """Cheap token estimate (about four characters per token) used for budgeting and metrics."""
+    return len(text) // 4 + 1
+
+def get_context_stats():
+    """Returns payload-size and token counters for symptom-checker requests."""
+    with _stats_lock:
+        stats = dict(_context_stats)
+    if stats['requests']:
+        stats['prompt_tokens_avg'] = stats['prompt_tokens_total'] / stats['requests']
+        stats['payload_bytes_avg'] = stats['payload_bytes_total'] / stats['requests']
+    return stats
+
+def build_context(session_turns, summary):
+    """
+    Assembles what is sent to Gemini: the not-yet-summarised turns verbatim (within the token
+    budget) and a system prompt carrying the summary of everything older in this session.
+    """
+    recent = []
+    tokens = 0
+    for turn in reversed(session_turns):
+        turn_tokens = estimate_tokens(turn['text'])
+        if recent and tokens + turn_tokens > CONTEXT_TOKEN_BUDGET:
+            break
+        recent.append({"role": turn['role'], "parts": [{"text": turn['text']}]})
+        tokens += turn_tokens
+    recent.reverse()
+    # Gemini expects the conversation to open with a user turn.
+    while len(recent) > 1 and recent[0]['role'] != 'user':
+        recent.pop(0)
+
+    system_prompt = GEMINI_SYSTEM_PROMPT
+    if summary:
+        system_prompt += f"\n\nSummary of the earlier part of this conversation:\n{summary}"
+    return recent, system_prompt
+
+def _pending_summary(turns):
+    """Returns the turns that have left the verbatim window, of turns the summary does not cover yet."""
+    return turns[:-CONTEXT_RECENT_TURNS] if CONTEXT_RECENT_TURNS else turns
+
+@job_handler('chat_summary')
+def update_summary_job(payload):
+    """
+    Folds the turns that have left the verbatim window into the session's running summary. Runs
+    on the job queue, so the summary's Gemini call never holds up a reply.
+    """
+    user_id = payload['user_id']
+    session = get_chat_session(user_id)
+    if session['session_id'] != payload['session_id']:
+        return    # the user has started over since; that session's summary is no longer used
+    # Everything the summary does not cover yet, however many turns an earlier failure left behind
+    turns = get_recent_turns(user_id, session['session_id'], None, after_seq=session['summarized_upto'])
+    pending = _pending_summary(turns)
+    if len(pending) < SUMMARY_BATCH_TURNS:
+        return
+    summary = session['summary']
+    transcript = '\n'.join(f"{turn['role']}: {turn['text']}" for turn in pending)
+    prompt = (
+        f"Current summary:\n{summary or '(none)'}\n\n"
+        f"New conversation turns:\n{transcript}\n\n"
+        f"Reply with the updated summary only."
+    )
+    # Uses the raising API so a failed call never gets saved as the summary.
+    summary = get_gemini_client().generate([{"role": "user", "parts": [{"text": prompt}]}], SUMMARY_SYSTEM_PROMPT)
+    save_chat_summary(user_id, session['session_id'], summary.strip(), pending[-1]['seq'])
+    with _stats_lock:
+        _context_stats['summaries'] += 1
+
+def handle_symptom_checker(user, state_info, incoming_msg, lang, MESSAGES, send_segment=None, turn_id=None):
     """
     Manages the state and conversation flow for the symptom checker feature using the database.
+    With `send_segment`, Gemini's reply is streamed and passed to send_segment() one message
+    segment at a time as it is generated; the whole reply is still returned at the end.
+    `turn_id` identifies a queued turn: when it runs again, the reply stored the first time is reused.
     """
-    user_id = user[0] # The user's primary key ID is at index 0
+    user_id = user.id
 
-    # If the user wants to exit, simply return them to the main menu message.
+    # If the user wants to exit, close this checker session and return them to the main menu.
     if incoming_msg.lower() == 'exit':
+        start_chat_session(user_id)
         return MESSAGES[lang]['main_menu']
 
-    # Retrieve the user's chat history from the database
-    chat_history = get_chat_history(user_id)
-    
-    # Add the user's new message to the history
-    chat_history.append({"role": "user", "parts": [{"text": incoming_msg}]})
-    
-    # Get the AI's response
-    ai_response = get_gemini_response(chat_history, GEMINI_SYSTEM_PROMPT)
-    
-    # Add the AI's response to the history
-    chat_history.append({"role": "model", "parts": [{"text": ai_response}]})
-    
-    # Save the updated history back to the database
-    save_chat_history(user_id, chat_history)
-    
-    return ai_response
\ No newline at end of file
+    # Load only the session's turns that the summary does not cover yet
+    session = get_chat_session(user_id)
+    turns = get_recent_turns(
+        user_id, session['session_id'], CONTEXT_RECENT_TURNS + SUMMARY_BATCH_TURNS, after_seq=session['summarized_upto']
+    )
+
+    # A retried turn finds its reply already stored, and neither calls Gemini nor appends again
+    stored = [turn['text'] for turn in turns if turn_id is not None and turn.get('turn_id') == turn_id and turn['role'] == 'model']
+    if stored:
+        for segment in (split_segments([stored[-1]]) if send_segment is not None else ()):
+            send_segment(segment)
+        return stored[-1]
+
+    # Add the user's new message to the turns
+    turns.append({'seq': None, 'role': 'user', 'text': incoming_msg})
+
+    # Send only the recent turns plus a summary of the rest of this session
+    context, system_prompt = build_context(turns, session['summary'])
+    if send_segment is None:
+        ai_response = get_gemini_response(context, system_prompt, lang)
+    else:
+        ai_response = stream_reply(stream_gemini_response(context, system_prompt, lang), send_segment)
+
+    payload_bytes = len(json.dumps(context, ensure_ascii=False).encode('utf-8')) + len(system_prompt.encode('utf-8'))
+    with _stats_lock:
+        _context_stats['requests'] += 1
+        _context_stats['payload_bytes_total'] += payload_bytes
+        _context_stats['prompt_tokens_total'] += estimate_tokens(system_prompt) + sum(estimate_tokens(t['parts'][0]['text']) for t in context)
+        _context_stats['turns_loaded_total'] += len(turns) - 1
+
+    # Append both turns of the exchange in one round-trip
+    user_seq, model_seq = append_chat_turns(
+        user_id, session['session_id'], [('user', incoming_msg), ('model', ai_response)], turn_id=turn_id
+    )
+    turns[-1]['seq'] = user_seq
+    turns.append({'seq': model_seq, 'role': 'model', 'text': ai_response})
+
+    # Turns loaded here are capped, so the job reloads everything after the summary mark itself
+    if len(_pending_summary(turns)) >= SUMMARY_BATCH_TURNS:
+        try:
+            enqueue('chat_summary', {'user_id': user_id, 'session_id': session['session_id']}, key=f"summary:{user_id}")
+        except Exception as e:
+            logging.error(f"Could not queue a symptom chat summary for user {user_id}: {e}")
+
+    return ai_response
@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Module-level configuration is read at import time: keep the suite's SQLite files out of the tree.
+_workdir = tempfile.mkdtemp(prefix='aarogya-tests-')
+os.environ.setdefault('JOB_QUEUE_PATH', os.path.join(_workdir, 'jobs.db'))
+os.environ.setdefault('CLINIC_INDEX_PATH', os.path.join(_workdir, 'clinic_index.db'))
+
+import database
+from loadtest.memory_db import MemoryDatabase
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """A MemoryDatabase standing in for database.py everywhere it has been imported, for one test."""
+    db = MemoryDatabase()
+    for name in db.FUNCTIONS:
+        original = getattr(database, name)
+        for module in list(sys.modules.values()):
+            if getattr(module, name, None) is original:
+                monkeypatch.setattr(module, name, getattr(db, name))
+    monkeypatch.setattr(database, '_start_user_cache_listener', lambda: None)
+    database._user_cache.clear()
+    yield db
+    database._user_cache.clear()
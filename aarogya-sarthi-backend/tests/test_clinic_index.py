@@ -0,0 +1,66 @@
+import pytest
+
+import vaccination_reminders
+from clinic_index import ClinicIndex
+from vaccination_reminders import search_places, find_nearby_centers, PlacesError
+
+MESSAGES = {'en': {'api_key_error': 'not configured', 'api_request_error': 'trouble', 'no_clinics_found': 'none'}}
+CLINICS = [{'name': 'PHC Khordha', 'address': 'Khordha, Odisha'}]
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def places(monkeypatch):
+    replies = []
+    monkeypatch.setattr(vaccination_reminders, 'GOOGLE_MAPS_API_KEY', 'test-key')
+    monkeypatch.setattr(vaccination_reminders.requests, 'get', lambda url, params, timeout: FakeResponse(replies.pop(0)))
+    return replies
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    index = ClinicIndex(fetch=search_places, path=str(tmp_path / 'clinics.db'), ttl=60)
+    monkeypatch.setattr(vaccination_reminders, '_clinic_index', index)
+    return index
+
+
+def test_error_status_in_a_200_reply_raises(places):
+    places.append({'status': 'OVER_QUERY_LIMIT', 'error_message': 'quota', 'results': []})
+    with pytest.raises(PlacesError):
+        search_places('BCG', 'Khordha')
+
+
+def test_zero_results_is_a_real_empty_answer(places):
+    places.append({'status': 'ZERO_RESULTS', 'results': []})
+    assert search_places('BCG', 'Khordha') == []
+
+
+def test_failed_refresh_keeps_the_indexed_clinics(places, index):
+    index.store('BCG', 'Khordha', CLINICS)
+    places.append({'status': 'REQUEST_DENIED', 'results': []})
+    with pytest.raises(PlacesError):
+        index.refresh('BCG', 'Khordha')
+    assert index.get_cached('BCG', 'Khordha')[0] == CLINICS
+
+
+def test_indexed_district_is_served_without_an_api_key(index, monkeypatch):
+    monkeypatch.setattr(vaccination_reminders, 'GOOGLE_MAPS_API_KEY', None)
+    index.store('BCG', 'Khordha', CLINICS)
+    assert 'PHC Khordha' in find_nearby_centers('BCG', 'Khordha', 'en', MESSAGES)
+    assert find_nearby_centers('BCG', 'Puri', 'en', MESSAGES) == 'not configured'
+
+
+def test_places_failure_on_a_miss_is_reported(places, index):
+    places.append({'status': 'OVER_QUERY_LIMIT', 'results': []})
+    assert find_nearby_centers('BCG', 'Puri', 'en', MESSAGES) == 'trouble'
+    assert index.get_cached('BCG', 'Puri') is None
@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import Future
+
+import enrichment
+from enrichment import run_enrichments
+
+
+def test_on_time_results_keep_task_order():
+    results = run_enrichments([('a', lambda: 'alert'), ('b', lambda: None), ('c', lambda: 'tip')], deadline_ms=1000)
+    assert results == ['alert', 'tip']
+
+
+def test_late_result_is_deferred_off_the_request_thread():
+    release = threading.Event()
+    delivered = []
+    done = threading.Event()
+
+    def on_late(name, result):
+        delivered.append((name, result, threading.current_thread()))
+        done.set()
+
+    results = run_enrichments([('slow', lambda: release.wait(5) and 'late alert')], deadline_ms=10, on_late=on_late)
+    release.set()
+    assert results == []
+    assert done.wait(2)
+    assert delivered[0][:2] == ('slow', 'late alert')
+    assert delivered[0][2] is not threading.current_thread()
+
+
+class _FinishedAtDeadline(Future):
+    """Already finished, but looked still running when the deadline was checked."""
+
+    def done(self):
+        return False
+
+
+def test_result_finishing_at_the_deadline_does_not_deadlock_the_request(monkeypatch):
+    # The request thread holds the number's conversation lock while it runs the enrichments, and
+    # on_late needs that lock. add_done_callback() on a future that has finished in the meantime
+    # runs the callback at once, in the request thread.
+    conversation_lock = threading.Lock()
+    delivered = threading.Event()
+    future = _FinishedAtDeadline()
+    future.set_result('late alert')
+    monkeypatch.setattr(enrichment, '_submit', lambda name, fn: future)
+
+    def on_late(name, result):
+        with conversation_lock:
+            delivered.set()
+
+    def request():
+        with conversation_lock:
+            run_enrichments([('outbreak_alert', None)], deadline_ms=0, on_late=on_late)
+
+    thread = threading.Thread(target=request, daemon=True)
+    thread.start()
+    thread.join(2)
+    assert not thread.is_alive(), "the request thread deadlocked on its own conversation lock"
+    assert delivered.wait(2)
+
+
+def test_failures_are_counted_not_raised():
+    def fail():
+        raise RuntimeError('feed down')
+    assert run_enrichments([('failing', fail)], deadline_ms=1000) == []
+    assert enrichment.get_enrichment_stats()['failing']['failed'] >= 1
@@ -0,0 +1,103 @@
+import time
+import threading
+
+import pytest
+
+from cache import SingleFlight, FlightTimeout
+from idempotency import IdempotencyCache, SQLiteIdempotencyCache, STILL_RUNNING
+
+
+def _start_slow(cache, key, release, response=b'<Response/>'):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return response
+
+    thread = threading.Thread(target=cache.run, args=(key, fn))
+    thread.start()
+    while not calls:
+        time.sleep(0.001)
+    return thread, calls
+
+
+def test_retry_joining_the_original_gives_up_after_wait():
+    cache = IdempotencyCache(wait=0.1)
+    release = threading.Event()
+    original, calls = _start_slow(cache, 'SM1', release)
+    start = time.monotonic()
+    assert cache.run('SM1', lambda: b'again') is STILL_RUNNING
+    assert time.monotonic() - start < 1
+    release.set()
+    original.join()
+    assert calls == [1]
+    assert cache.stats()['timed_out'] == 1
+
+
+def test_retry_after_the_original_replays_its_response():
+    cache = IdempotencyCache(wait=1)
+    release = threading.Event()
+    original, _ = _start_slow(cache, 'SM1', release)
+    release.set()
+    original.join()
+    assert cache.run('SM1', lambda: b'again') == b'<Response/>'
+    assert cache.stats()['executed'] == 1
+
+
+def test_retry_joining_in_time_shares_the_response():
+    cache = IdempotencyCache(wait=5)
+    release = threading.Event()
+    original, _ = _start_slow(cache, 'SM1', release)
+    threading.Timer(0.05, release.set).start()
+    assert cache.run('SM1', lambda: b'again') == b'<Response/>'
+    original.join()
+
+
+def test_sqlite_backend_shares_responses_between_instances(tmp_path):
+    path = str(tmp_path / 'idempotency.db')
+    first, second = SQLiteIdempotencyCache(path=path), SQLiteIdempotencyCache(path=path)
+    assert first.run('SM1', lambda: b'first') == b'first'
+    assert second.run('SM1', lambda: b'second') == b'first'
+
+
+def test_single_flight_timeout_only_applies_to_joiners():
+    flights = SingleFlight()
+    release = threading.Event()
+    owner = threading.Thread(target=flights.do, args=('k', lambda: release.wait(5) and 'done', 0.01))
+    owner.start()
+    while not flights.in_flight('k'):
+        time.sleep(0.001)
+    with pytest.raises(FlightTimeout):
+        flights.do('k', lambda: 'joiner', timeout=0.05)
+    release.set()
+    owner.join()
+    assert not flights.in_flight('k')
+
+
+def test_single_flight_shares_the_owners_exception():
+    flights = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fail():
+        release.wait(5)
+        raise TimeoutError('upstream')
+
+    def own():
+        try:
+            flights.do('k', fail)
+        except TimeoutError as e:
+            errors.append(e)
+
+    owner = threading.Thread(target=own)
+    owner.start()
+    while not flights.in_flight('k'):
+        time.sleep(0.001)
+    threading.Timer(0.05, release.set).start()
+    # The owner's own TimeoutError is not mistaken for the joiner giving up.
+    with pytest.raises(TimeoutError) as raised:
+        flights.do('k', lambda: 'joiner', timeout=5)
+    assert not isinstance(raised.value, FlightTimeout)
+    owner.join()
+    assert errors
@@ -0,0 +1,79 @@
+import job_queue
+from job_queue import JobQueue, job_handler
+
+
+def _queue(tmp_path):
+    # No worker threads: the tests drain the queue with run_pending().
+    return JobQueue(path=str(tmp_path / 'jobs.db'), workers=0, max_attempts=3)
+
+
+def _drain(queue):
+    while queue.run_pending():
+        pass
+
+
+def test_keyed_jobs_run_in_enqueue_order(tmp_path):
+    queue = _queue(tmp_path)
+    ran = []
+    job_handler('test_record')(lambda payload: ran.append(payload['n']))
+    for n in range(5):
+        queue.enqueue('test_record', {'n': n}, key='symptoms:whatsapp:+911')
+    _drain(queue)
+    assert ran == [0, 1, 2, 3, 4]
+
+
+def test_retry_keeps_its_place_in_the_key(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+    ran = []
+
+    def flaky(payload):
+        if payload['n'] == 1 and not payload.get('retried'):
+            payload['retried'] = True
+            raise RuntimeError('Twilio timed out')
+        ran.append(payload['n'])
+
+    job_handler('test_flaky')(flaky)
+    for n in range(3):
+        queue.enqueue('test_flaky', {'n': n}, key='send:whatsapp:+911')
+    queue.enqueue('test_flaky', {'n': 99}, key='send:whatsapp:+912')
+    # The backoff puts the retry in the future; jobs of other keys still run meanwhile.
+    assert queue.run_pending() and queue.run_pending() and queue.run_pending()
+    assert ran == [0, 99]
+    assert not queue.run_pending()
+    monkeypatch.setattr(job_queue.time, 'time', lambda real=job_queue.time.time: real() + 3600)
+    _drain(queue)
+    assert ran == [0, 99, 1, 2]
+
+
+def test_payload_changes_are_saved_with_the_retry(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+    seen = []
+
+    def resume(payload):
+        seen.append(list(payload['messages']))
+        payload['messages'].pop(0)
+        if payload['messages'] and len(seen) == 1:
+            raise RuntimeError('second message failed')
+
+    job_handler('test_resume')(resume)
+    queue.enqueue('test_resume', {'messages': ['a', 'b']})
+    queue.run_pending()
+    monkeypatch.setattr(job_queue.time, 'time', lambda real=job_queue.time.time: real() + 3600)
+    _drain(queue)
+    assert seen == [['a', 'b'], ['b']]
+
+
+def test_job_fails_permanently_after_max_attempts(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+
+    def always_fail(payload):
+        raise RuntimeError('broken')
+
+    job_handler('test_broken')(always_fail)
+    queue.enqueue('test_broken', {})
+    offset = [0]
+    monkeypatch.setattr(job_queue.time, 'time', lambda real=job_queue.time.time: real() + offset[0])
+    for _ in range(3):
+        queue.run_pending()
+        offset[0] += 3600
+    assert queue.stats() == {'failed': 1}
@@ -0,0 +1,65 @@
+from datetime import date, timedelta
+
+import database
+from loadtest.memory_db import MemoryDatabase
+from vaccination_schedule import plan_user_job, plan_all, send_reminders, PostgresReminderStore
+from twilio_sender import FakeTwilioSender
+
+
+def test_stands_in_for_every_listed_function():
+    for name in MemoryDatabase.FUNCTIONS:
+        assert callable(getattr(database, name)), name
+        assert callable(getattr(MemoryDatabase, name)), name
+
+
+def test_covers_the_vaccination_schedule():
+    used = {'get_users_to_plan', 'save_vaccination_due', 'get_due_vaccinations', 'mark_vaccinations_reminded'}
+    assert used <= set(MemoryDatabase.FUNCTIONS)
+
+
+def _register(mobile='whatsapp:+911', age=0):
+    return database.add_user(mobile, 'Asha', age, 'Female', 'Odisha', 'Khordha', 'hi')
+
+
+def test_registration_job_plans_due_dates(memory_db):
+    user_id = _register()
+    plan_user_job({'user_id': user_id, 'age': 0, 'recorded_on': date.today().isoformat()})
+    assert memory_db.vaccinations
+    assert all(row['due_on'] >= date.today() for row in memory_db.vaccinations.values())
+    # Planning everyone again keeps the same dates.
+    before = {key: row['due_on'] for key, row in memory_db.vaccinations.items()}
+    assert plan_all() == (1, len(before))
+    assert {key: row['due_on'] for key, row in memory_db.vaccinations.items()} == before
+
+
+def test_due_reminders_are_sent_once(memory_db, monkeypatch):
+    first, second = _register('whatsapp:+911'), _register('whatsapp:+912')
+    due_on = date.today() + timedelta(days=1)
+    database.save_vaccination_due([(first, 'MR-1', due_on), (first, 'PCV booster', due_on), (second, 'MR-1', due_on)])
+    assert database.get_due_vaccinations(due_on, 0, 10) == [
+        (first, 'whatsapp:+911', 'hi', ['MR-1', 'PCV booster']),
+        (second, 'whatsapp:+912', 'hi', ['MR-1']),
+    ]
+    assert database.get_due_vaccinations(due_on, first, 10)[0][0] == second
+
+    class Store(PostgresReminderStore):
+        def claim(self, run_id, owner):
+            return {'last_user_id': 0, 'sent': 0, 'failed': 0}
+
+        def checkpoint(self, *args, **kwargs):
+            return True
+
+    sender = FakeTwilioSender()
+    send_reminders(due_on, store=Store(), sender=sender, rate=0)
+    assert len(sender.sent) == 2
+    assert database.get_due_vaccinations(due_on, 0, 10) == []
+    # A reminded dose keeps its date when planned again.
+    database.save_vaccination_due([(first, 'MR-1', due_on + timedelta(days=3))])
+    assert memory_db.vaccinations[(first, 'MR-1')]['due_on'] == due_on
+
+
+def test_deleting_a_user_drops_their_due_dates(memory_db):
+    user_id = _register()
+    database.save_vaccination_due([(user_id, 'MR-1', date.today())])
+    database.delete_user('whatsapp:+911')
+    assert memory_db.vaccinations == {}
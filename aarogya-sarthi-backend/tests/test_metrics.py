@@ -0,0 +1,22 @@
+import metrics
+
+
+def test_collector_counters_get_total_suffix_and_type(monkeypatch):
+    monkeypatch.setattr(metrics, '_collectors', [])
+    metrics.register_collector(lambda: {
+        'aarogya_test_in_use': ("Slots in use.", 3),
+        'aarogya_test_rejected': ("Rejections.", 5, 'counter'),
+        'aarogya_test_bytes_total': ("Bytes sent.", 7, 'counter'),
+    })
+    text = metrics.render_metrics()
+    assert "# TYPE aarogya_test_in_use gauge\naarogya_test_in_use 3\n" in text
+    assert "# TYPE aarogya_test_rejected_total counter\naarogya_test_rejected_total 5\n" in text
+    assert "# TYPE aarogya_test_bytes_total counter\naarogya_test_bytes_total 7\n" in text
+    assert "_total_total" not in text
+
+
+def test_failing_collector_is_skipped(monkeypatch):
+    monkeypatch.setattr(metrics, '_collectors', [])
+    metrics.register_collector(lambda: 1 / 0)
+    metrics.register_collector(lambda: {'aarogya_test_ok': ("Still rendered.", 1)})
+    assert "aarogya_test_ok 1" in metrics.render_metrics()
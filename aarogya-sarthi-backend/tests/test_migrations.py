@@ -0,0 +1,99 @@
+import inspect
+
+import database
+from migrations import MIGRATIONS, QUERY_CHECKS, migrate, query_functions, seq_scans
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+        if sql.startswith('SELECT version FROM schema_migrations'):
+            self.rows = [(version,) for version in self.conn.applied]
+        elif sql.startswith('INSERT INTO schema_migrations'):
+            self.conn.applied.add(params[0])
+        elif sql.startswith('SELECT pg_advisory_xact_lock') and self.conn.on_lock:
+            self.conn.on_lock(self.conn)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    """Records statements; schema_migrations is a set of versions."""
+
+    def __init__(self, applied=(), on_lock=None):
+        self.applied = set(applied)
+        self.executed = []
+        self.on_lock = on_lock
+        self.notices = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+def test_versions_are_unique_and_in_order():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == list(range(1, len(MIGRATIONS) + 1))
+
+
+def test_migrate_applies_only_pending_versions_in_order():
+    conn = FakeConnection(applied={1, 2})
+    assert migrate(conn) == [version for version, _, _ in MIGRATIONS[2:]]
+    applied = [sql for sql in conn.executed if any(sql is migration[2] for migration in MIGRATIONS)]
+    assert applied == [sql for _, _, sql in MIGRATIONS[2:]]
+
+
+def test_migrate_stops_at_target():
+    conn = FakeConnection()
+    assert migrate(conn, target=3) == [1, 2, 3]
+    assert conn.applied == {1, 2, 3}
+
+
+def test_migration_applied_by_another_process_meanwhile_is_skipped():
+    # Another deploy applies version 1 while this one waits for the advisory lock.
+    def other_deploy(conn):
+        conn.applied.add(1)
+        conn.on_lock = None
+
+    conn = FakeConnection(on_lock=other_deploy)
+    done = migrate(conn)
+    assert 1 not in done
+    assert MIGRATIONS[0][2] not in conn.executed
+
+
+def test_every_query_function_has_a_plan_check():
+    functions = query_functions()
+    assert 'append_chat_turns' in functions
+    assert [name for name in functions if name not in QUERY_CHECKS] == []
+    assert [name for name in QUERY_CHECKS if not inspect.isfunction(getattr(database, name, None))] == []
+
+
+def test_seq_scans_walks_nested_plans():
+    plan = {'Node Type': 'Nested Loop', 'Plans': [
+        {'Node Type': 'Index Scan', 'Relation Name': 'users'},
+        {'Node Type': 'Hash', 'Plans': [{'Node Type': 'Seq Scan', 'Relation Name': 'vaccination_due'}]},
+    ]}
+    assert list(seq_scans(plan)) == ['vaccination_due']
+
+
+def test_duplicate_numbers_are_merged_before_the_unique_index():
+    sql = dict((version, sql) for version, _, sql in MIGRATIONS)[4]
+    merge = sql.index('DELETE FROM users u USING duplicate_users')
+    assert sql.index('UPDATE user_alerts_seen s SET user_id = d.keep_id') < merge
+    assert merge < sql.index('CREATE UNIQUE INDEX IF NOT EXISTS users_mobile_number_key')
@@ -0,0 +1,28 @@
+import outbreak_alerts
+
+
+def test_retain_translations_drops_alerts_that_left_the_feed(monkeypatch):
+    monkeypatch.setattr(outbreak_alerts, '_translations', {
+        ('old', 'hi'): ("purana", "saar"), ('live', 'hi'): ("naya", "saar"), ('live', 'od'): ("nua", "saar"),
+    })
+    monkeypatch.setattr(outbreak_alerts, '_warmed_alert_ids', {'old', 'live'})
+    outbreak_alerts.retain_translations({'live'})
+    assert set(outbreak_alerts._translations) == {('live', 'hi'), ('live', 'od')}
+    assert outbreak_alerts._warmed_alert_ids == {'live'}
+
+
+def test_found_alert_is_only_seen_once_marked(memory_db, monkeypatch):
+    alert = {'id': 'who-1', 'title': "Dengue in India", 'summary': "Cases rising.", 'published': None}
+    monkeypatch.setattr(outbreak_alerts, 'fetch_live_alerts', lambda: [alert])
+    monkeypatch.setattr(outbreak_alerts, 'seen_alerts', outbreak_alerts.SeenAlertIndex())
+    memory_db.add_user('+910000000001', 'Asha', 30, 'F', 'Odisha', 'Khordha', 'en')
+    user = memory_db.get_user('+910000000001')
+
+    found, message = outbreak_alerts.find_outbreak_alert(user, 'en')
+    assert found is alert and "Dengue in India" in message
+    # Not sent yet: asking again finds the same alert.
+    assert outbreak_alerts.find_outbreak_alert(user, 'en')[0] is alert
+
+    outbreak_alerts.mark_outbreak_alert_seen(user.id, {'id': 'who-1', 'published': None})
+    assert outbreak_alerts.find_outbreak_alert(user, 'en') is None
+    assert memory_db.alerts_seen[user.id] == {'who-1'}
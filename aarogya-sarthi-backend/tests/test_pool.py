@@ -0,0 +1,137 @@
+import threading
+
+import psycopg2
+import pytest
+
+import database
+from database import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.stale = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        conn = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql, params=None):
+                if conn.stale:
+                    raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+        return Cursor()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeThreadedPool:
+    """psycopg2's ThreadedConnectionPool without a server: opens FakeConnections on demand."""
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        self._pool = []
+        self._used = {}
+        self.opened = []
+
+    def getconn(self):
+        conn = self._pool.pop() if self._pool else None
+        if conn is None:
+            conn = FakeConnection()
+            self.opened.append(conn)
+        self._used[id(conn)] = conn
+        return conn
+
+    def putconn(self, conn, close=False):
+        self._used.pop(id(conn), None)
+        if close:
+            conn.closed = 1
+        else:
+            self._pool.append(conn)
+
+    def closeall(self):
+        for conn in self._pool:
+            conn.closed = 1
+
+
+@pytest.fixture(autouse=True)
+def fake_psycopg2_pool(monkeypatch):
+    monkeypatch.setattr(database.pg_pool, 'ThreadedConnectionPool', FakeThreadedPool)
+    monkeypatch.setattr(database, '_pool', None)
+    monkeypatch.setattr(database, '_pool_pid', None)
+
+
+def test_stale_connection_is_replaced():
+    pool = ConnectionPool(1, 2, timeout=1, healthcheck_after=0)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.stale = True       # e.g. the Cloud SQL proxy restarted while it sat idle
+    fresh = pool.getconn()
+    assert fresh is not conn
+    assert conn.closed
+    assert pool.stats()['stale_replaced'] == 1
+
+
+def test_recently_used_connection_is_not_pinged():
+    pool = ConnectionPool(1, 2, timeout=1, healthcheck_after=60)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.stale = True
+    assert pool.getconn() is conn
+
+
+def test_exhausted_pool_raises_pool_timeout():
+    pool = ConnectionPool(1, 1, timeout=0.05, healthcheck_after=60)
+    conn = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert pool.stats()['timeouts'] == 1
+    pool.putconn(conn)
+    pool.putconn(pool.getconn())
+    assert pool.stats()['checked_out'] == 0
+
+
+def test_waiting_caller_gets_the_connection_given_back():
+    pool = ConnectionPool(1, 1, timeout=2, healthcheck_after=60)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, args=(conn,)).start()
+    assert pool.getconn() is conn
+    assert pool.stats()['wait_time_max'] > 0
+
+
+def test_pool_is_recreated_after_fork(monkeypatch):
+    parent = database._get_pool()
+    assert database._get_pool() is parent
+    monkeypatch.setattr(database.os, 'getpid', lambda: -1)     # as seen from a forked worker
+    child = database._get_pool()
+    assert child is not parent
+    assert not any(conn.closed for conn in parent._pool.opened)
+
+
+def test_connection_commits_or_rolls_back_and_drops_broken_ones():
+    with database.get_db_connection() as conn:
+        pass
+    assert conn.commits == 1
+    with pytest.raises(ValueError):
+        with database.get_db_connection() as conn:
+            raise ValueError('bad row')
+    assert conn.rollbacks >= 1 and not conn.closed
+    with pytest.raises(psycopg2.OperationalError):
+        with database.get_db_connection() as conn:
+            raise psycopg2.OperationalError('connection lost')
+    assert conn.closed
+    assert database.get_pool_stats()['checked_out'] == 0
@@ -0,0 +1,34 @@
+import json
+
+from preventive_healthcare_tips import TipsEngine
+
+MESSAGES = {
+    'en': {'preventive_tips_intro': "Tip:", 'preventive_tips_header': "{title} for {district}"},
+    'hi': {'preventive_tips_intro': "सुझाव:", 'preventive_tips_header': "{district} के लिए {title}"},
+}
+
+
+def _engine(tmp_path, tip="Sleep under a net."):
+    path = tmp_path / 'tips.json'
+    path.write_text(json.dumps({'tips': [
+        {'season': 'monsoon', 'title': {'en': "Malaria", 'hi': "मलेरिया"}, 'tip': {'en': tip, 'hi': tip}},
+    ]}), encoding='utf-8')
+    return TipsEngine(path=str(path), states_and_districts={'Odisha': ['Koraput']}), path
+
+
+def test_header_follows_the_language_template(tmp_path):
+    engine, _ = _engine(tmp_path)
+    engine.prerender(MESSAGES)
+    assert "*Malaria for Koraput*" in engine.get('monsoon', 'Odisha', 'Koraput', 'en', MESSAGES)
+    hindi = engine.get('monsoon', 'Odisha', 'Koraput', 'hi', MESSAGES)
+    assert "*Koraput के लिए मलेरिया*" in hindi and " for " not in hindi
+
+
+def test_on_demand_render_is_kept_in_the_reloaded_tips(tmp_path):
+    engine, path = _engine(tmp_path)
+    engine.prerender(MESSAGES)
+    assert "Sleep under a net." in engine.get('monsoon', 'Odisha', 'Puri', 'en', MESSAGES)
+    path.write_text(path.read_text(encoding='utf-8').replace("Sleep under a net.", "Drain standing water."), encoding='utf-8')
+    engine.load()
+    assert "Drain standing water." in engine.get('monsoon', 'Odisha', 'Puri', 'en', MESSAGES)
+    assert ('monsoon', 'Odisha', 'Puri', 'en') in engine._rendered
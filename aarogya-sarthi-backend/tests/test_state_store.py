@@ -0,0 +1,85 @@
+import time
+import threading
+
+from state_store import MemoryStateStore, SQLiteStateStore
+
+
+def _count_concurrently(store, number, threads=8, rounds=25):
+    def bump():
+        for _ in range(rounds):
+            with store.session(number) as state:
+                state['count'] = state.get('count', 0) + 1
+    workers = [threading.Thread(target=bump) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return store.get(number).get('count')
+
+
+def test_memory_session_serialises_read_modify_write():
+    assert _count_concurrently(MemoryStateStore(), 'whatsapp:+911') == 200
+
+
+def test_sqlite_session_serialises_read_modify_write(tmp_path):
+    assert _count_concurrently(SQLiteStateStore(path=str(tmp_path / 'state.db')), 'whatsapp:+911') == 200
+
+
+def test_sqlite_lock_holds_across_store_instances(tmp_path):
+    # Two instances on one file stand in for two worker processes: the stripes are not shared.
+    path = str(tmp_path / 'state.db')
+    first, second = SQLiteStateStore(path=path), SQLiteStateStore(path=path)
+    acquired = threading.Event()
+
+    def take():
+        with second.lock('whatsapp:+911'):
+            acquired.set()
+
+    with first.lock('whatsapp:+911'):
+        waiter = threading.Thread(target=take)
+        waiter.start()
+        assert not acquired.wait(0.2)
+    assert acquired.wait(2)
+    waiter.join()
+
+
+def test_sqlite_lock_is_taken_over_after_its_lease(tmp_path):
+    store = SQLiteStateStore(path=str(tmp_path / 'state.db'), lease=0.1)
+    # A lease left behind by a worker that died: nobody renews it.
+    store._conn().execute("INSERT INTO conversation_locks (number, owner, expires_at) VALUES (?, 'dead', ?)",
+                          ('whatsapp:+911', time.time() + 0.1))
+    with store.lock('whatsapp:+911'):
+        pass
+
+
+def test_sqlite_lock_is_renewed_while_held(tmp_path):
+    path = str(tmp_path / 'state.db')
+    holder, other = SQLiteStateStore(path=path, lease=0.15), SQLiteStateStore(path=path, lease=0.15)
+    acquired = threading.Event()
+
+    def take():
+        with other.lock('whatsapp:+911'):
+            acquired.set()
+
+    with holder.lock('whatsapp:+911'):
+        waiter = threading.Thread(target=take)
+        waiter.start()
+        # A slow turn, well past the lease.
+        assert not acquired.wait(0.6)
+    assert acquired.wait(2)
+    waiter.join()
+
+
+def test_session_deletes_emptied_state():
+    store = MemoryStateStore()
+    store.set('whatsapp:+911', {'state': 'awaiting_menu_choice'})
+    with store.session('whatsapp:+911') as state:
+        state.clear()
+    assert store.get('whatsapp:+911') == {}
+
+
+def test_memory_get_returns_a_copy():
+    store = MemoryStateStore()
+    store.set('whatsapp:+911', {'lang': 'hi'})
+    store.get('whatsapp:+911')['lang'] = 'en'
+    assert store.get('whatsapp:+911') == {'lang': 'hi'}
@@ -0,0 +1,116 @@
+import pytest
+
+import database
+import symptom_checker
+from symptom_checker import handle_symptom_checker, update_summary_job, CONTEXT_RECENT_TURNS, SUMMARY_BATCH_TURNS
+
+MESSAGES = {'en': {'main_menu': 'Main menu'}}
+
+
+class FakeGemini:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.prompts = []
+
+    def generate(self, contents, system_prompt):
+        self.prompts.append(contents[0]['parts'][0]['text'])
+        if self.fail:
+            raise RuntimeError('Gemini unavailable')
+        return 'Summary so far.'
+
+
+@pytest.fixture
+def chat(memory_db, monkeypatch):
+    replies = []
+    queued = []
+    monkeypatch.setattr(symptom_checker, 'get_gemini_response',
+                        lambda contents, prompt, lang: replies.append(contents) or f"reply {len(replies)}")
+    monkeypatch.setattr(symptom_checker, 'enqueue', lambda kind, payload, key=None: queued.append((kind, payload, key)))
+    user_id = database.add_user('whatsapp:+911', 'Asha', 30, 'Female', 'Odisha', 'Khordha', 'en')
+    user = database.get_user('whatsapp:+911')
+    assert user.id == user_id
+    return user, replies, queued
+
+
+def test_a_retried_turn_reuses_its_stored_reply(chat, memory_db):
+    user, replies, _ = chat
+    first = handle_symptom_checker(user, {}, 'I have a fever', 'en', MESSAGES, turn_id='turn-1')
+    again = handle_symptom_checker(user, {}, 'I have a fever', 'en', MESSAGES, turn_id='turn-1')
+    assert again == first
+    assert len(replies) == 1
+    assert [turn['text'] for turn in memory_db.turns[(user.id, 1)]] == ['I have a fever', first]
+
+
+def test_append_with_a_known_turn_id_returns_the_stored_seqs(memory_db):
+    database.get_chat_session(1)
+    assert database.append_chat_turns(1, 1, [('user', 'a'), ('model', 'b')], turn_id='t1') == [1, 2]
+    assert database.append_chat_turns(1, 1, [('user', 'a'), ('model', 'b')], turn_id='t1') == [1, 2]
+    assert database.append_chat_turns(1, 1, [('user', 'c'), ('model', 'd')]) == [3, 4]
+
+
+def test_streamed_retry_resends_the_stored_reply(chat):
+    user, replies, _ = chat
+    first = handle_symptom_checker(user, {}, 'I have a cough', 'en', MESSAGES, turn_id='turn-1')
+    segments = []
+    assert handle_symptom_checker(user, {}, 'I have a cough', 'en', MESSAGES, send_segment=segments.append,
+                                  turn_id='turn-1') == first
+    assert ''.join(segments) == first
+    assert len(replies) == 1
+
+
+def test_summary_is_queued_not_run_in_the_turn(chat, monkeypatch):
+    user, _, queued = chat
+    gemini = FakeGemini()
+    monkeypatch.setattr(symptom_checker, 'get_gemini_client', lambda: gemini)
+    for n in range((CONTEXT_RECENT_TURNS + SUMMARY_BATCH_TURNS) // 2):
+        handle_symptom_checker(user, {}, f'message {n}', 'en', MESSAGES)
+    assert gemini.prompts == []
+    assert queued[-1] == ('chat_summary', {'user_id': user.id, 'session_id': 1}, f"summary:{user.id}")
+
+
+def test_summary_job_covers_turns_left_by_failed_summaries(memory_db, monkeypatch):
+    database.get_chat_session(1)
+    for n in range(20):
+        database.append_chat_turns(1, 1, [('user', f'message {n}'), ('model', f'reply {n}')])
+    monkeypatch.setattr(symptom_checker, 'get_gemini_client', lambda: FakeGemini(fail=True))
+    with pytest.raises(RuntimeError):
+        update_summary_job({'user_id': 1, 'session_id': 1})
+    assert database.get_chat_session(1)['summarized_upto'] == 0
+
+    gemini = FakeGemini()
+    monkeypatch.setattr(symptom_checker, 'get_gemini_client', lambda: gemini)
+    update_summary_job({'user_id': 1, 'session_id': 1})
+    session = database.get_chat_session(1)
+    assert session['summary'] == 'Summary so far.'
+    assert session['summarized_upto'] == 40 - CONTEXT_RECENT_TURNS
+    assert 'message 0' in gemini.prompts[0]
+
+
+def test_summary_job_skips_a_session_the_user_has_left(memory_db, monkeypatch):
+    database.get_chat_session(1)
+    for n in range(20):
+        database.append_chat_turns(1, 1, [('user', f'message {n}'), ('model', f'reply {n}')])
+    database.start_chat_session(1)
+    gemini = FakeGemini()
+    monkeypatch.setattr(symptom_checker, 'get_gemini_client', lambda: gemini)
+    update_summary_job({'user_id': 1, 'session_id': 1})
+    assert gemini.prompts == []
+    assert database.get_chat_session(1) == {'session_id': 2, 'summary': None, 'summarized_upto': 0}
+
+
+def test_each_exchange_appends_two_turns(chat, memory_db):
+    user, replies, _ = chat
+    for n in range(3):
+        handle_symptom_checker(user, {}, f'message {n}', 'en', MESSAGES)
+    assert [(turn['seq'], turn['role']) for turn in memory_db.turns[(user.id, 1)]] == [
+        (1, 'user'), (2, 'model'), (3, 'user'), (4, 'model'), (5, 'user'), (6, 'model')]
+    # The last request saw the earlier exchanges, oldest first, ending with the new message.
+    assert [turn['parts'][0]['text'] for turn in replies[-1]] == ['message 0', 'reply 1', 'message 1', 'reply 2', 'message 2']
+    assert [turn['seq'] for turn in database.get_recent_turns(user.id, 1, 3, after_seq=2)] == [4, 5, 6]
+
+
+def test_exit_closes_the_session(chat):
+    user, replies, _ = chat
+    handle_symptom_checker(user, {}, 'I have a fever', 'en', MESSAGES)
+    assert handle_symptom_checker(user, {}, 'exit', 'en', MESSAGES) == 'Main menu'
+    assert database.get_chat_session(user.id)['session_id'] == 2
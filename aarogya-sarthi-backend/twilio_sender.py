@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Twilio REST Configuration ---
+TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
+# The bot's own WhatsApp sender, e.g. "whatsapp:+14155238886".
+TWILIO_WHATSAPP_FROM = os.environ.get("TWILIO_WHATSAPP_FROM")
+# Point at a local stub server to test without the real API, e.g. "http://127.0.0.1:8004".
+TWILIO_API_BASE = os.environ.get("TWILIO_API_BASE")
+# Set to "fake" to record outgoing messages instead of sending them (tests, benchmarks).
+TWILIO_SENDER = os.environ.get("TWILIO_SENDER", "twilio")
+
+
+class TwilioSender:
+    """Sends WhatsApp messages outside a webhook reply through Twilio's REST messages API."""
+
+    def __init__(self, account_sid=TWILIO_ACCOUNT_SID, auth_token=TWILIO_AUTH_TOKEN, from_number=TWILIO_WHATSAPP_FROM):
+        from twilio.rest import Client
+        self.client = Client(account_sid, auth_token)
+        if TWILIO_API_BASE:
+            self.client.api.base_url = TWILIO_API_BASE
+        self.from_number = from_number
+
+    def send(self, to, body):
+        """Sends one message and returns its Twilio SID. Raises on API errors so callers can retry."""
+        message = self.client.messages.create(from_=self.from_number, to=to, body=body)
+        return message.sid
+
+
+class FakeTwilioSender:
+    """
+    Stand-in sender that records messages in memory, optionally with artificial latency.
+    With `record=False` it only counts them, for benchmarks with very many sends.
+    """
+
+    def __init__(self, latency=0.0, record=True):
+        self.latency = latency
+        self.record = record
+        self.sent = []
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def send(self, to, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.count += 1
+            if self.record:
+                self.sent.append((to, body))
+            return f"FAKE{self.count:032d}"
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+def get_sender():
+    """Returns the process-wide sender selected by TWILIO_SENDER."""
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            if TWILIO_SENDER == 'fake':
+                _sender = FakeTwilioSender()
+            else:
+                if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_WHATSAPP_FROM):
+                    logging.error("Twilio REST credentials are not set. Please add them to the .env file.")
+                _sender = TwilioSender()
+        return _sender
+
+def set_sender(sender):
+    """Replaces the process-wide sender, e.g. with a FakeTwilioSender in tests."""
+    global _sender
+    with _sender_lock:
+        _sender = sender
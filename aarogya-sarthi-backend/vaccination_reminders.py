@@ -1,14 +1,19 @@
 import os
 import requests
 import logging
+import threading
 from dotenv import load_dotenv
 
+from clinic_index import ClinicIndex
+from metrics import timed
+
 # Load environment variables from .env file
 load_dotenv()
 
 # --- Google Maps API Configuration ---
 GOOGLE_MAPS_API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY")
-GOOGLE_PLACES_API_URL = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+# Point at a local stub server to test without the real API.
+GOOGLE_PLACES_API_URL = os.environ.get("GOOGLE_PLACES_API_URL", "https://maps.googleapis.com/maps/api/place/textsearch/json")
 
 
 # --- Vaccine Data Structure ---
@@ -44,7 +49,7 @@ def get_vaccine_list(user, lang, MESSAGES):
     Determines the correct vaccine schedule based on user's age and returns a formatted list.
     """
     try:
-        user_age = int(user[3])  # Assuming age is at index 3 of the user tuple
+        user_age = int(user.age)
         age_group = 'adult'
         if user_age <= 1: age_group = 'infant'
         elif user_age <= 10: age_group = 'child'
@@ -61,26 +66,54 @@ def get_vaccine_list(user, lang, MESSAGES):
         response_text += f"\n{MESSAGES[lang].get('return_to_menu', 'Reply menu to return to the main menu.')}"
         return response_text, vaccine_info['vaccines']
 
-    except (ValueError, IndexError) as e:
+    except (ValueError, TypeError) as e:
         logging.error(f"Could not determine user age for vaccine reminders: {e}")
         return MESSAGES[lang].get('age_error', "Sorry, I couldn't retrieve your age from the database to suggest vaccines."), None
 
 
-def find_nearby_centers(vaccine_name, user_district, lang, MESSAGES):
+class PlacesNotConfigured(Exception):
+    """Raised instead of calling Google Places when GOOGLE_MAPS_API_KEY is not set."""
+
+class PlacesError(requests.exceptions.RequestException):
+    """Google Places answered, but with an error status such as OVER_QUERY_LIMIT or REQUEST_DENIED."""
+
+
+@timed('places')
+def search_places(vaccine_name, user_district):
     """
-    Uses Google Places API to find nearby vaccination centers.
+    Uses Google Places API to find vaccination centers. Returns [{'name', 'address'}];
+    raises requests.exceptions.RequestException if the API call fails.
     """
     if not GOOGLE_MAPS_API_KEY:
-        logging.error("GOOGLE_MAPS_API_KEY is not set. Please add it to the .env file.")
-        return MESSAGES[lang].get('api_key_error', "Sorry, the clinic finder service is not configured correctly.")
-
+        raise PlacesNotConfigured("GOOGLE_MAPS_API_KEY is not set")
     query = f"hospitals or clinics with {vaccine_name} vaccine in {user_district}"
     params = {'query': query, 'key': GOOGLE_MAPS_API_KEY}
-    
+    response = requests.get(GOOGLE_PLACES_API_URL, params=params, timeout=10)
+    response.raise_for_status()
+    result = response.json()
+    # Places reports quota and key problems in an HTTP 200; only these two mean the list is real.
+    if result.get('status') not in ('OK', 'ZERO_RESULTS'):
+        raise PlacesError(f"Places API returned {result.get('status')}: {result.get('error_message', '')}")
+    return [{'name': place.get('name'), 'address': place.get('formatted_address')} for place in result.get('results', [])]
+
+_clinic_index = None
+_clinic_index_lock = threading.Lock()
+
+def get_clinic_index():
+    """Returns the process-wide clinic index, opening its SQLite file (CLINIC_INDEX_PATH) on first use."""
+    global _clinic_index
+    with _clinic_index_lock:
+        if _clinic_index is None:
+            _clinic_index = ClinicIndex(fetch=search_places)
+        return _clinic_index
+
+def find_nearby_centers(vaccine_name, user_district, lang, MESSAGES):
+    """
+    Finds nearby vaccination centers from the clinic index (Google Places on a miss).
+    Districts already indexed are served even without an API key.
+    """
     try:
-        response = requests.get(GOOGLE_PLACES_API_URL, params=params)
-        response.raise_for_status()
-        results = response.json().get('results', [])
+        results = get_clinic_index().lookup(vaccine_name, user_district)
 
         if not results:
             return MESSAGES[lang].get('no_clinics_found', "Sorry, I couldn't find any centers with that vaccine near you. Please check with local health authorities.")
@@ -88,22 +121,26 @@ def find_nearby_centers(vaccine_name, user_district, lang, MESSAGES):
         response_text = MESSAGES[lang].get('clinics_found_intro', "Here are some centers near you:") + "\n\n"
         for i, place in enumerate(results[:3], 1):
             name = place.get('name')
-            address = place.get('formatted_address')
-            maps_url = f"https://www.google.com/maps/search/?api=1&query={requests.utils.quote(address)}"
+            address = place.get('address')
+            maps_url = f"https://www.google.com/maps/search/?api=1&query={requests.utils.quote(address or '')}"
             response_text += f"{i}. *{name}*\n{MESSAGES[lang].get('address_label', 'Address')}: {address}\nGoogle Maps: {maps_url}\n\n"
         
         response_text += MESSAGES[lang].get('call_ahead_note', "Please call ahead to confirm vaccine availability.")
         return response_text
 
+    except PlacesNotConfigured:
+        logging.error("GOOGLE_MAPS_API_KEY is not set. Please add it to the .env file.")
+        return MESSAGES[lang].get('api_key_error', "Sorry, the clinic finder service is not configured correctly.")
     except requests.exceptions.RequestException as e:
         logging.error(f"Google Maps API request failed: {e}")
         return MESSAGES[lang].get('api_request_error', "Sorry, I'm having trouble searching for clinics right now.")
 
 
 # --- NEW: The Main Handler Function ---
-def handle_vaccination_reminders(user, state_info, incoming_msg, lang, MESSAGES):
+def handle_vaccination_reminders(user, state_info, incoming_msg, lang, MESSAGES, find_centers=find_nearby_centers):
     """
     The main controller for the vaccination reminders feature.
+    `find_centers` may hand the clinic search off elsewhere and return None instead of a reply.
     """
     # Check if this is the start of the conversation for this feature
     if incoming_msg == "start":
@@ -121,10 +158,10 @@ def handle_vaccination_reminders(user, state_info, incoming_msg, lang, MESSAGES)
             
             if 1 <= choice <= len(vaccines):
                 selected_vaccine = vaccines[choice - 1]
-                user_district = user[6] # Assuming district is at index 6
+                user_district = user.district
                 
                 # Find clinics and clear the state
-                response_text = find_nearby_centers(selected_vaccine, user_district, lang, MESSAGES)
+                response_text = find_centers(selected_vaccine, user_district, lang, MESSAGES)
                 del state_info['state'] # Exit the vaccine flow
                 return response_text
             else:
@@ -0,0 +1,278 @@
+"""
+Vaccination due dates and the daily reminder run.
+
+Every dose of DOSE_SCHEDULE gets a due date per user in vaccination_due, counted from the user's
+date of birth or, without one, from a birth date estimated from the age they registered with.
+Only doses still to come are stored. New registrations are planned by a 'plan_vaccinations' job
+queued as they sign up; `plan` (re)plans every user, e.g. after a roster import, and is safe to repeat.
+
+The daily `remind` run sends tomorrow's reminders (and those of the last VACCINATION_CATCHUP_DAYS
+days, if a run was missed). It reads each due day's unsent reminders from the partial
+(due_on, user_id) index in keyset batches, one localised message per user, with sends rate
+limited to VACCINATION_REMINDER_RATE per second. Each batch is marked as reminded in one UPDATE
+followed by a checkpoint, so a crashed run resumes after the last completed batch. Users whose
+send failed are not marked and are not retried for that day.
+
+    python vaccination_schedule.py plan [--batch-size 5000]
+    python vaccination_schedule.py remind [--day 2026-01-31]
+    python vaccination_schedule.py bench [--users 1000000] [--rate 0] [--latency 0]
+"""
+import os
+import time
+import socket
+import logging
+import argparse
+import calendar
+import threading
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from database import (get_users_to_plan, save_vaccination_due, get_due_vaccinations, mark_vaccinations_reminded,
+                      claim_broadcast, save_broadcast_checkpoint)
+from outbreak_alerts import SUPPORTED_LANGS
+from job_queue import job_handler
+from rate_limit import TokenBucket
+from twilio_sender import get_sender, FakeTwilioSender
+
+load_dotenv()
+
+# --- Reminder Configuration ---
+# Messages per second across all send workers; 0 means unlimited.
+VACCINATION_REMINDER_RATE = float(os.environ.get("VACCINATION_REMINDER_RATE", 50))
+VACCINATION_BATCH_SIZE = int(os.environ.get("VACCINATION_BATCH_SIZE", 1000))
+VACCINATION_WORKERS = int(os.environ.get("VACCINATION_WORKERS", 8))
+# A claimed run whose owner has not checkpointed for this long is taken over.
+VACCINATION_LEASE = int(os.environ.get("VACCINATION_LEASE", 300))
+# Due days before today that a run still reminds for, in case earlier runs were missed.
+VACCINATION_CATCHUP_DAYS = int(os.environ.get("VACCINATION_CATCHUP_DAYS", 3))
+
+
+# --- Dose Schedule ---
+# (dose, weeks, months) after birth, following India's Universal Immunization Programme.
+DOSE_SCHEDULE = [
+    ("BCG", 0, 0), ("Hepatitis B (birth dose)", 0, 0), ("OPV-0", 0, 0),
+    ("OPV-1", 6, 0), ("Pentavalent-1", 6, 0), ("Rotavirus-1", 6, 0), ("fIPV-1", 6, 0), ("PCV-1", 6, 0),
+    ("OPV-2", 10, 0), ("Pentavalent-2", 10, 0), ("Rotavirus-2", 10, 0),
+    ("OPV-3", 14, 0), ("Pentavalent-3", 14, 0), ("Rotavirus-3", 14, 0), ("fIPV-2", 14, 0), ("PCV-2", 14, 0),
+    ("MR-1", 0, 9), ("PCV booster", 0, 9), ("fIPV-3", 0, 9),
+    ("MR-2", 0, 16), ("DPT booster-1", 0, 16), ("OPV booster", 0, 16),
+    ("DPT booster-2", 0, 60),
+    ("Td (10 years)", 0, 120), ("Td (16 years)", 0, 192),
+]
+
+REMINDER_TEXT = {
+    'en': "💉 *Vaccination reminder*\n{doses} due on {date}. Please visit your nearest health centre or ASHA worker.\n"
+          "Reply 2 to find a vaccination centre near you.",
+    'hi': "💉 *टीकाकरण अनुस्मारक*\n{doses} की तारीख {date} है। कृपया अपने नज़दीकी स्वास्थ्य केंद्र या आशा कार्यकर्ता से मिलें।\n"
+          "अपने पास टीकाकरण केंद्र खोजने के लिए 2 भेजें।",
+    'od': "💉 *ଟିକାକରଣ ସ୍ମାରକ*\n{doses} ର ତାରିଖ {date}। ଦୟାକରି ଆପଣଙ୍କ ନିକଟସ୍ଥ ସ୍ୱାସ୍ଥ୍ୟ କେନ୍ଦ୍ର କିମ୍ବା ଆଶା କର୍ମୀଙ୍କୁ ଭେଟନ୍ତୁ।\n"
+          "ନିକଟସ୍ଥ ଟିକାକରଣ କେନ୍ଦ୍ର ଖୋଜିବାକୁ 2 ପଠାନ୍ତୁ।",
+    'kui': "💉 *ଟିକା ମନେ ପକାଉଛୁ*\n{doses} ର ଦିନ୍ {date}। ଦୟାକରି ପାଖର୍ ସ୍ୱାସ୍ଥ୍ୟ କେନ୍ଦ୍ର କି ଆଶା ଦିଦିଙ୍କ ପାଖେ ଯାଆନ୍ତୁ।\n"
+           "ପାଖର୍ ଟିକା କେନ୍ଦ୍ର ଖୋଜବାକେ 2 ପଠାନ୍ତୁ।",
+    'sa': "💉 *ᱴᱤᱠᱟᱹ ᱩᱭᱦᱟᱹᱨ*\n{doses} ᱨᱮᱭᱟᱜ ᱢᱟᱦᱟᱸ {date}᱾ ᱫᱟᱭᱟᱠᱟᱛᱮ ᱟᱢᱟᱜ ᱥᱮᱴᱮᱨ ᱦᱚᱨᱚᱢ ᱠᱷᱟᱹᱛᱤᱨ ᱥᱮᱱᱴᱚᱨ ᱥᱮᱱ ᱢᱮ᱾\n"
+          "ᱴᱤᱠᱟᱹ ᱥᱮᱱᱴᱚᱨ ᱯᱟᱱᱛᱮ ᱞᱟᱹᱜᱤᱫ 2 ᱠᱩᱞ ᱢᱮ᱾",
+}
+
+def add_months(day, months):
+    """`day` moved on by `months` calendar months, clamped to the end of a shorter month."""
+    total = day.year * 12 + day.month - 1 + months
+    year, month = total // 12, total % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def estimated_birth_date(age, recorded_on):
+    """Someone `age` on `recorded_on` was born between age and age + 1 years earlier; takes the middle."""
+    return add_months(recorded_on, -12 * age - 6)
+
+def due_dates(date_of_birth, age, age_recorded_on, today):
+    """Returns [(dose, due_on)] for the doses due on or after `today`; [] if neither birth date nor age is known."""
+    if date_of_birth is None:
+        if age is None:
+            return []
+        date_of_birth = estimated_birth_date(age, age_recorded_on or today)
+    dates = [(dose, add_months(date_of_birth, months) + timedelta(weeks=weeks)) for dose, weeks, months in DOSE_SCHEDULE]
+    return [(dose, due_on) for dose, due_on in dates if due_on >= today]
+
+def render_reminder(doses, due_on, lang):
+    return REMINDER_TEXT.get(lang, REMINDER_TEXT['en']).format(doses=', '.join(doses), date=f"{due_on:%d-%m-%Y}")
+
+
+# --- Planning ---
+@job_handler('plan_vaccinations')
+def plan_user_job(payload):
+    """
+    Stores the upcoming due dates of a newly registered user. The payload carries the age and
+    the day it was given on ('recorded_on'), and optionally an ISO 'date_of_birth'.
+    """
+    date_of_birth = payload.get('date_of_birth')
+    due = due_dates(date.fromisoformat(date_of_birth) if date_of_birth else None, payload['age'],
+                    date.fromisoformat(payload['recorded_on']), date.today())
+    save_vaccination_due([(payload['user_id'], dose, due_on) for dose, due_on in due])
+
+def plan_all(batch_size=5000, today=None):
+    """(Re)computes the due dates of every user, in keyset batches by user id. Returns (users, doses)."""
+    today = today or date.today()
+    after_id = users = doses = 0
+    while True:
+        rows = get_users_to_plan(after_id, batch_size)
+        if not rows:
+            return users, doses
+        due = [
+            (user_id, dose, due_on)
+            for user_id, date_of_birth, age, age_recorded_on in rows
+            for dose, due_on in due_dates(date_of_birth, age, age_recorded_on, today)
+        ]
+        save_vaccination_due(due)
+        after_id = rows[-1][0]
+        users += len(rows)
+        doses += len(due)
+        logging.info(f"Planned {users} users ({doses} upcoming doses)...")
+
+
+# --- Reminder Stores ---
+class PostgresReminderStore:
+    """Due reminders, reminded-marks and run checkpoints in the bot's database."""
+
+    def claim(self, run_id, owner):
+        return claim_broadcast(run_id, owner, VACCINATION_LEASE)
+
+    def due(self, due_on, after_user_id, limit):
+        return get_due_vaccinations(due_on, after_user_id, limit)
+
+    def mark_reminded(self, due_on, user_ids):
+        mark_vaccinations_reminded(due_on, user_ids)
+
+    def checkpoint(self, run_id, owner, last_user_id, sent, failed, status='running'):
+        return save_broadcast_checkpoint(run_id, owner, last_user_id, sent, failed, status)
+
+
+class DryRunReminderStore:
+    """Synthetic users 1..`users` each due one or two doses (languages cycled), with in-memory bookkeeping."""
+
+    def __init__(self, users):
+        self.users = users
+        self.marked = 0
+        self.checkpoints = 0
+
+    def claim(self, run_id, owner):
+        return {'last_user_id': 0, 'sent': 0, 'failed': 0}
+
+    def due(self, due_on, after_user_id, limit):
+        last = min(after_user_id + limit, self.users)
+        return [
+            (user_id, f"whatsapp:+91{7000000000 + user_id}", SUPPORTED_LANGS[user_id % len(SUPPORTED_LANGS)],
+             ["OPV-1", "Pentavalent-1"] if user_id % 2 else ["MR-1"])
+            for user_id in range(after_user_id + 1, last + 1)
+        ]
+
+    def mark_reminded(self, due_on, user_ids):
+        self.marked += len(user_ids)
+
+    def checkpoint(self, run_id, owner, last_user_id, sent, failed, status='running'):
+        self.checkpoints += 1
+        return True
+
+
+# --- Reminder Run ---
+def send_reminders(due_on, store=None, sender=None, rate=VACCINATION_REMINDER_RATE, batch_size=VACCINATION_BATCH_SIZE,
+                   workers=VACCINATION_WORKERS):
+    """
+    Reminds every user with unsent reminders for doses due on `due_on`. Returns a stats dict, or
+    None if another process owns this day's run or it has already finished.
+    """
+    store = store or PostgresReminderStore()
+    sender = sender or get_sender()
+    run_id = f"vaccination:{due_on.isoformat()}"
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    checkpoint = store.claim(run_id, owner)
+    if checkpoint is None:
+        logging.info(f"Reminders for doses due on {due_on} are finished or owned elsewhere; skipping.")
+        return None
+
+    last_user_id, sent, failed = checkpoint['last_user_id'], checkpoint['sent'], checkpoint['failed']
+    bucket = TokenBucket(rate)
+    batches = 0
+    finished = False
+    started = time.monotonic()
+
+    def send(row):
+        user_id, mobile_number, lang, doses = row
+        bucket.acquire()
+        try:
+            sender.send(mobile_number, render_reminder(doses, due_on, lang))
+            return user_id
+        except Exception as e:
+            logging.error(f"Vaccination reminder to user {user_id} failed: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = store.due(due_on, last_user_id, batch_size)
+            if not rows:
+                finished = True
+                break
+            delivered = [user_id for user_id in executor.map(send, rows) if user_id is not None]
+            store.mark_reminded(due_on, delivered)
+
+            last_user_id = rows[-1][0]
+            sent += len(delivered)
+            failed += len(rows) - len(delivered)
+            batches += 1
+            if not store.checkpoint(run_id, owner, last_user_id, sent, failed):
+                logging.warning(f"Lost the claim on reminders due {due_on} after user {last_user_id}; stopping.")
+                break
+    if finished:
+        store.checkpoint(run_id, owner, last_user_id, sent, failed, status='done')
+
+    elapsed = time.monotonic() - started
+    stats = {
+        'due_on': due_on.isoformat(), 'sent': sent, 'failed': failed, 'batches': batches,
+        'elapsed': round(elapsed, 3), 'messages_per_second': round(sent / elapsed, 1) if elapsed else None,
+    }
+    logging.info(f"Vaccination reminders: {stats}")
+    return stats
+
+def remind_due(today=None, **kwargs):
+    """The daily run: reminders for doses due tomorrow, plus any missed in the last catch-up days."""
+    today = today or date.today()
+    days = [today + timedelta(days=offset) for offset in range(-VACCINATION_CATCHUP_DAYS + 1, 2)]
+    return [stats for stats in (send_reminders(day, **kwargs) for day in days) if stats]
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    plan_parser = subcommands.add_parser('plan', help="compute the due dates of every user")
+    plan_parser.add_argument('--batch-size', type=int, default=5000)
+    remind_parser = subcommands.add_parser('remind', help="send the reminders of the daily run")
+    remind_parser.add_argument('--day', type=date.fromisoformat, help="only this due date (default: tomorrow and catch-up days)")
+    bench_parser = subcommands.add_parser('bench', help="dry-run reminders to synthetic users with a fake sender")
+    bench_parser.add_argument('--users', type=int, default=1000000)
+    bench_parser.add_argument('--latency', type=float, default=0.0, help="simulated seconds per Twilio call")
+    for sub in (remind_parser, bench_parser):
+        sub.add_argument('--rate', type=float, default=None, help="messages per second, 0 for unlimited")
+        sub.add_argument('--batch-size', type=int, default=VACCINATION_BATCH_SIZE)
+        sub.add_argument('--workers', type=int, default=VACCINATION_WORKERS)
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        users, doses = plan_all(args.batch_size)
+        logging.info(f"Planned {doses} upcoming doses for {users} users.")
+    elif args.command == 'remind':
+        options = {'rate': VACCINATION_REMINDER_RATE if args.rate is None else args.rate,
+                   'batch_size': args.batch_size, 'workers': args.workers}
+        if args.day:
+            send_reminders(args.day, **options)
+        else:
+            remind_due(**options)
+    else:
+        store = DryRunReminderStore(args.users)
+        sender = FakeTwilioSender(latency=args.latency, record=False)
+        stats = send_reminders(date.today() + timedelta(days=1), store=store, sender=sender,
+                               rate=0 if args.rate is None else args.rate, batch_size=args.batch_size, workers=args.workers)
+        print(f"{stats['sent']} sent, {stats['failed']} failed, {store.marked} marked reminded, "
+              f"{stats['batches']} batches in {stats['elapsed']}s ({stats['messages_per_second']} msg/s)")
+
+if __name__ == "__main__":
+    main()